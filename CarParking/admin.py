@@ -7,3 +7,7 @@ class ContactInfoAdmin(admin.ModelAdmin):
     list_display = ('company_name', 'email', 'phone', 'updated_at')
     readonly_fields = ('created_at', 'updated_at')
     search_fields = ('company_name', 'email', 'phone')
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        ContactInfo.changed()
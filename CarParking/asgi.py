@@ -3,6 +3,11 @@ ASGI config for CarParking project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project through this module (e.g. ``uvicorn CarParking.asgi:application``)
+in production: the live occupancy stream (``/parking/api/slot_statuses/stream/``)
+is an async view, and under ASGI its idle connections cost an asyncio task each
+instead of a worker thread.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
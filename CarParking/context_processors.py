@@ -11,7 +11,8 @@ def site_settings(request):
     try:
         # Import locally to avoid circular import at startup
         from .models import ContactInfo
-        contact = ContactInfo.objects.order_by('-updated_at').first()
+        # In-process copy; costs no query until contact info changes
+        contact = ContactInfo.cached_current()
     except Exception:
         contact = None
 
@@ -1,6 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
+from parking.versioning import VersionStamp
+
 # --- 1. Custom User Manager ---
 class UserManager(BaseUserManager):
     """
@@ -115,6 +117,37 @@ class ContactInfo(models.Model):
     def __str__(self):
         return self.company_name
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _contact_version.changed()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        _contact_version.changed()
+        return result
+
+    @classmethod
+    def cached_current(cls):
+        """Return the most recently updated ContactInfo (or None) from an
+        in-process copy, reloaded (one query) only after contact info was saved
+        or deleted, here or in another worker."""
+        global _contact_cache
+        version = _contact_version.current()
+        cached_version, contact = _contact_cache
+        if cached_version != version:
+            contact = cls.objects.order_by('-updated_at').first()
+            _contact_cache = (version, contact)
+        return contact
+
+    @classmethod
+    def changed(cls):
+        """Invalidate cached_current() after writes that bypass save()/delete()."""
+        _contact_version.changed()
+
     class Meta:
         verbose_name = 'Contact Information'
         verbose_name_plural = 'Contact Information'
+
+
+_contact_version = VersionStamp('carparking:contactinfo:version')
+_contact_cache = (None, None)
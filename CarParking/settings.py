@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Per-view query/timing stats; inactive unless QUERY_STATS=True (see parking/querystats.py)
+    'parking.middleware.query_stats_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,6 +52,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Frees/occupies slots when bookings start or end (see parking/occupants.py)
+    'parking.middleware.occupancy_middleware',
 ]
 
 ROOT_URLCONF = 'CarParking.urls'
@@ -78,6 +82,14 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Background threads (STK push workers, scheduler, callback drain) write
+        # alongside requests. IMMEDIATE transactions take the write lock up front
+        # and wait for it, instead of failing with "database is locked" when a
+        # read-then-write transaction cannot upgrade its lock.
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -201,6 +213,11 @@ MPESA_SHORTCODE = config('MPESA_SHORTCODE', default='')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
 # When True, STK push calls are simulated and payment confirmation is scheduled locally.
 MPESA_SIMULATE = config('MPESA_SIMULATE', default=True, cast=bool)
+# Simulated payments arrive as callbacks after MPESA_SIMULATE_DELAY +/- MPESA_SIMULATE_DELAY_JITTER
+# seconds; MPESA_SIMULATE_FAILURE_RATE of them fail (see parkingpayments/simulator.py).
+MPESA_SIMULATE_DELAY = config('MPESA_SIMULATE_DELAY', default=5.0, cast=float)
+MPESA_SIMULATE_DELAY_JITTER = config('MPESA_SIMULATE_DELAY_JITTER', default=0.0, cast=float)
+MPESA_SIMULATE_FAILURE_RATE = config('MPESA_SIMULATE_FAILURE_RATE', default=0.0, cast=float)
 # Optional: override API base (use sandbox by default)
 # Optional: override API base (use sandbox by default). Support legacy env `BASE_URL`.
 MPESA_API_BASE = config('MPESA_API_BASE', default=config('BASE_URL', default='https://sandbox.safaricom.co.ke'))
@@ -211,6 +228,19 @@ MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default=config('CALLBACK_URL',
 # Optional secret to validate incoming MPesa callbacks (set in .env and in the Daraja sandbox if supported)
 MPESA_CALLBACK_SECRET = config('MPESA_CALLBACK_SECRET', default='')
 
+# STK pushes are sent by a pool of background threads (see parkingpayments/dispatch.py)
+# so booking requests do not wait on Safaricom. Set MPESA_PUSH_ASYNC=False to send inline.
+MPESA_PUSH_ASYNC = config('MPESA_PUSH_ASYNC', default=True, cast=bool)
+MPESA_PUSH_WORKERS = config('MPESA_PUSH_WORKERS', default=4, cast=int)
+MPESA_PUSH_QUEUE_SIZE = config('MPESA_PUSH_QUEUE_SIZE', default=100, cast=int)
+MPESA_PUSH_RETRIES = config('MPESA_PUSH_RETRIES', default=3, cast=int)
+MPESA_PUSH_BACKOFF = config('MPESA_PUSH_BACKOFF', default=1.0, cast=float)
+
+# Callbacks are stored by the webhook and applied in batches (see parkingpayments/inbox.py).
+# With autodrain on, a background thread applies them shortly after they arrive; otherwise
+# run `python manage.py drain_callbacks --loop` as a separate process.
+MPESA_CALLBACK_AUTODRAIN = config('MPESA_CALLBACK_AUTODRAIN', default=True, cast=bool)
+
 # CSRF: trusted origins for deployments where the Host/Origin may include
 # an explicit scheme or different hostname (common in Docker, tunnelling,
 # or when using an IP address). Allow overriding via env var.
@@ -220,5 +250,43 @@ CSRF_TRUSTED_ORIGINS = config(
     cast=lambda v: [s.strip() for s in v.split(',') if s.strip()]
 )
 
+# Slot occupancy is derived from PAID booking intervals (parking/occupants.py). Every
+# process re-checks it at least this often (seconds), in case a booking started or
+# ended in another process.
+OCCUPANCY_REFRESH_INTERVAL = config('OCCUPANCY_REFRESH_INTERVAL', default=60, cast=int)
+
+# Per-view query counts, DB/template time and response sizes (parking/querystats.py).
+# Off by default; staff can read the numbers at /parking/api/query_stats/.
+QUERY_STATS = config('QUERY_STATS', default=False, cast=bool)
+QUERY_STATS_LOG_INTERVAL = config('QUERY_STATS_LOG_INTERVAL', default=300, cast=int)
+# Requests over budget are logged; QUERY_BUDGET_STRICT raises instead (used by the tests).
+QUERY_BUDGET_STRICT = config('QUERY_BUDGET_STRICT', default=False, cast=bool)
+# Query budgets per view, measured with a handful of rows. The first request after a
+# booking boundary also pays for an occupancy refresh (about 4 queries).
+QUERY_BUDGETS = {
+    'parking:driver_slots': 15,
+    'parking:admin_activities': 10,
+    'parking:admin_booking_list': 10,
+}
+
 # Expire sessions on browser close so users are logged out when they close the browser
-SESSION_EXPIRE_AT_BROWSER_CLOSE = config('SESSION_EXPIRE_AT_BROWSER_CLOSE', default=True, cast=bool)
\ No newline at end of file
+SESSION_EXPIRE_AT_BROWSER_CLOSE = config('SESSION_EXPIRE_AT_BROWSER_CLOSE', default=True, cast=bool)
+
+# --- 11. CACHES ---
+# Version stamps for the in-process caches (occupancy snapshot, pricing rates) are
+# kept in the default cache. With the local-memory backend each worker process only
+# sees its own changes; set REDIS_URL when running several workers so they converge.
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
@@ -0,0 +1,53 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .context_processors import site_settings
+from .models import ContactInfo
+
+
+class SiteSettingsCacheTests(TestCase):
+	def setUp(self):
+		self.request = RequestFactory().get('/')
+		# Test transactions roll back without save()/delete() bumps reaching the
+		# cache (their on_commit callbacks never run); drop any cached copy
+		cache.clear()
+
+	def test_contact_info_is_cached_until_saved_or_deleted(self):
+		contact = ContactInfo.objects.create(company_name='Old Park', email='old@example.com')
+		self.assertEqual(site_settings(self.request)['CONTACT_INFO']['company_name'], 'Old Park')
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertEqual(site_settings(self.request)['CONTACT_INFO']['email'], 'old@example.com')
+		self.assertEqual(len(ctx.captured_queries), 0)
+
+		contact.company_name = 'New Park'
+		with self.captureOnCommitCallbacks(execute=True):
+			contact.save()
+		self.assertEqual(site_settings(self.request)['CONTACT_INFO']['company_name'], 'New Park')
+
+		with self.captureOnCommitCallbacks(execute=True):
+			contact.delete()
+		self.assertEqual(site_settings(self.request)['CONTACT_INFO']['email'], 'info@smartpark.example')
+
+	def test_admin_bulk_delete_invalidates_cache(self):
+		ContactInfo.objects.create(company_name='Bulk Park')
+		self.assertEqual(site_settings(self.request)['CONTACT_INFO']['company_name'], 'Bulk Park')
+		admin = get_user_model().objects.create_superuser(
+			email='contact-admin@example.com',
+			username='contact-admin',
+			phone_number='254700000095',
+			vehicle_plate='CI-1',
+			password='pass'
+		)
+		self.client.force_login(admin)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.post(reverse('admin:CarParking_contactinfo_changelist'), {
+				'action': 'delete_selected',
+				'_selected_action': list(ContactInfo.objects.values_list('pk', flat=True)),
+				'post': 'yes',
+			})
+		self.assertFalse(ContactInfo.objects.exists())
+		self.assertEqual(site_settings(self.request)['CONTACT_INFO']['company_name'], 'SmartPark')
@@ -39,38 +39,10 @@ def register_view(request):
 
 def home_view(request):
     """Simple homepage view for verifying template loading at root URL ('/')."""
-    from parking.models import ParkingSlot
-    
-    # Get all parking slots
-    all_slots = ParkingSlot.objects.all()
-    total_slots = all_slots.count()
-    occupied_count = all_slots.filter(is_occupied=True).count()
-    available_count = total_slots - occupied_count
-    availability_percentage = (available_count / total_slots * 100) if total_slots > 0 else 0
-    
-    context = {
-        'total_slots': total_slots,
-        'occupied_count': occupied_count,
-        'available_count': available_count,
-        'availability_percentage': availability_percentage,
-    }
-    return render(request, 'accounts/home.html', context)
-    from parking.models import ParkingSlot
-    
-    # Get all parking slots
-    all_slots = ParkingSlot.objects.all()
-    total_slots = all_slots.count()
-    occupied_count = all_slots.filter(is_occupied=True).count()
-    available_count = total_slots - occupied_count
-    availability_percentage = (available_count / total_slots * 100) if total_slots > 0 else 0
-    
-    context = {
-        'total_slots': total_slots,
-        'occupied_count': occupied_count,
-        'available_count': available_count,
-        'availability_percentage': availability_percentage,
-    }
-    return render(request, 'accounts/home.html', context)
+    from parking import counters
+
+    # Slot totals come from the maintained counters, one small query
+    return render(request, 'accounts/home.html', counters.summary().as_context())
 
 # --- 2. Login View: Handles User Authentication ---
 def login_view(request):
@@ -13,9 +13,8 @@ from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from accounts.forms import RegistrationForm, LoginForm, DriverUpdateForm
-from parking.models import ParkingSlot, Booking
 from parking.models import Subscription
-from parking.forms import BookingForm
+from parking import counters, occupancy, reports
 from django.utils import timezone
 from django.http import JsonResponse
 from django.conf import settings
@@ -70,8 +69,9 @@ def home_view(request):
         if request.user.is_staff or request.user.is_superuser:
             return redirect('admin_dashboard')
         return redirect('driver_dashboard')
-    
-    return render(request, 'accounts/home.html', {})
+
+    # Stats tiles come from the maintained slot counters (one small query)
+    return render(request, 'accounts/home.html', counters.summary().as_context())
 
 
 # ------------------------------------------------
@@ -126,31 +126,8 @@ def driver_dashboard(request):
     Displays all parking slots for drivers with their current status.
     Also provides booking form to reserve available slots.
     """
-    # Get ALL slots so drivers can see the full parking layout with states
-    all_slots = ParkingSlot.objects.all().order_by('level', 'slot_id')
-    available_slots = ParkingSlot.objects.filter(is_occupied=False).order_by('level', 'slot_id')
-    booking_form = BookingForm()
-
-    # Get driver's recent bookings
-    user_bookings = Booking.objects.filter(user=request.user).order_by('-start_time')[:5]
-
-    # Determine user's occupancy status: PENDING (awaiting payment), OCCUPIED (paid), or FREE
-    now = timezone.now()
-    occupancy_status = 'FREE'
-    if Booking.objects.filter(user=request.user, payment_status=Booking.STATUS_PENDING).exists():
-        occupancy_status = 'PENDING'
-    elif Booking.objects.filter(user=request.user, payment_status=Booking.STATUS_PAID, end_time__gte=now).exists():
-        occupancy_status = 'OCCUPIED'
-
-    # Calculate parking statistics
-    total_slots = all_slots.count()
-    occupied_count = ParkingSlot.objects.filter(is_occupied=True).count()
-    available_count = total_slots - occupied_count
-    availability_percentage = (available_count / total_slots * 100) if total_slots > 0 else 0
-
     # To keep a single canonical dashboard route, redirect to the parking app's
     # `driver_slots` view which renders the same `accounts/driver_dashboard.html`.
-    from django.shortcuts import redirect
     return redirect('parking:driver_slots')
 
 
@@ -167,19 +144,26 @@ def admin_dashboard(request):
         messages.error(request, "Access Denied. You do not have permission to access the Admin dashboard.")
         return redirect('driver_dashboard')
     
-    # Get parking statistics
-    from parking.models import ParkingSlot
-    all_slots = ParkingSlot.objects.all()
-    total_slots = all_slots.count()
-    occupied_count = all_slots.filter(is_occupied=True).count()
-    available_count = total_slots - occupied_count
-    availability_percentage = (available_count / total_slots * 100) if total_slots > 0 else 0
-    
+    # Get parking statistics from the maintained counters (one small query)
+    slot_counts = counters.summary()
+    total_slots = slot_counts.total
+
+    # Today's activity, read from the hourly booking rollups
+    today = timezone.localdate()
+    hours = reports.hourly_bookings(today, today)
+    peak = max(hours, key=lambda h: h['count'])
+    # Share of today's slot time covered by PAID bookings, including those still to come
+    day_start, day_end = reports.local_day_bounds(today, today)
+    slot_seconds = total_slots * (day_end - day_start).total_seconds()
+    occupied_seconds = sum(h['occupied_seconds'] for h in hours)
+    utilization_percentage = (occupied_seconds / slot_seconds * 100) if slot_seconds else 0
+
     context = {
-        'total_slots': total_slots,
-        'occupied_count': occupied_count,
-        'available_count': available_count,
-        'availability_percentage': availability_percentage,
+        **slot_counts.as_context(),
+        'bookings_today': sum(h['count'] for h in hours),
+        'revenue_today': sum(h['revenue'] for h in hours),
+        'utilization_percentage': utilization_percentage,
+        'peak_hour': peak['hour'] if peak['count'] else None,
     }
     
     return render(request, 'accounts/admin_dashboard.html', context)
@@ -208,6 +192,9 @@ def driver_update_profile(request):
         form = DriverUpdateForm(request.POST, instance=request.user)
         if form.is_valid():
             form.save()
+            if 'vehicle_type' in form.changed_data:
+                # Occupied slots show the occupant's vehicle type on live dashboards
+                occupancy.mark_changed()
             messages.success(request, "Your profile has been updated successfully.")
             return redirect('driver_dashboard')
         else:
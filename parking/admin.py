@@ -1,10 +1,11 @@
 from django.contrib import admin
-from .models import ParkingSlot, Booking, PricingRate
+from .models import ParkingSlot, Booking, BookingRollup, PricingRate, PaymentCallback
+from . import driverstate, occupancy, occupants, rollups
 
-# Admin action to free multiple slots at once
+# Admin action to free multiple slots at once (until their next booking starts or ends)
 @admin.action(description="Mark selected slots as free")
 def mark_as_free(modeladmin, request, queryset):
-    queryset.update(is_occupied=False)
+    occupants.release(queryset.values_list('pk', flat=True))
 
 @admin.register(ParkingSlot)
 class ParkingSlotAdmin(admin.ModelAdmin):
@@ -14,15 +15,51 @@ class ParkingSlotAdmin(admin.ModelAdmin):
     list_filter = ('pricing_category', 'is_occupied')
     actions = [mark_as_free]  # Adds bulk free action
 
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        occupancy.mark_changed()
+
 @admin.register(Booking)
 class BookingAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'slot', 'start_time', 'end_time', 'total_fee', 'payment_status')
     list_filter = ('payment_status', 'slot__pricing_category')
     search_fields = ('user__email', 'slot__slot_id', 'slot__slot_name')
 
+    def delete_queryset(self, request, queryset):
+        slot_days, drivers = set(), set()
+        for user_id, *row in queryset.values_list('user_id', 'slot_id', 'created_at', 'start_time', 'end_time'):
+            slot_days |= rollups.booking_days(*row)
+            drivers.add(user_id)
+        super().delete_queryset(request, queryset)
+        rollups.mark(slot_days)
+        occupants.refresh_slots({slot for slot, _ in slot_days})
+        driverstate.invalidate(drivers)
+
+
+@admin.register(BookingRollup)
+class BookingRollupAdmin(admin.ModelAdmin):
+    list_display = ('period', 'period_start', 'slot', 'level', 'pricing_category', 'bookings', 'paid', 'failed',
+                    'revenue', 'occupied_seconds')
+    list_filter = ('period', 'level', 'pricing_category')
+    date_hierarchy = 'period_start'
+
+    # Rows are derived from bookings; rebuild them with `manage.py backfill_rollups`
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 
 @admin.register(PricingRate)
 class PricingRateAdmin(admin.ModelAdmin):
     list_display = ('category', 'rate')
     list_editable = ('rate',)
     search_fields = ('category',)
+
+
+@admin.register(PaymentCallback)
+class PaymentCallbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'received_at', 'processed_at', 'outcome')
+    list_filter = ('outcome',)
+    readonly_fields = ('payload', 'received_at', 'processed_at', 'outcome')
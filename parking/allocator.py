@@ -0,0 +1,231 @@
+"""
+parking.allocator
+-------------------
+Free-slot allocation for auto-assigned bookings.
+
+Drivers who do not care which bay they get ask for "any free slot",
+optionally on a given level and/or in a given pricing category. Rather than
+scanning the slot table, the allocator keeps one free list per
+(level, pricing category) bucket, per process:
+
+- built from the bay layout (`parking.layout`) and the occupancy snapshot
+  (`parking.occupancy`) when either is first read or the layout changes;
+- kept current from the snapshot's change log: each read applies only the
+  slots that changed since the version it last saw;
+- handing out a slot takes it off its free list for `CLAIM_SECONDS`, so
+  drivers assigned at the same moment get different bays instead of
+  colliding on the same one;
+- slots with a live booking (PENDING within its hold, or PAID and not yet
+  ended) stay off the free lists. The occupancy snapshot does not show
+  those, so they are looked up in the booking table: all of them on a
+  build, and on claim expiry only the slots whose claims ended. A slot
+  that is still booked is claimed again and re-checked later.
+
+`release()` ends a claim early, for an attempt that did not book the slot;
+it returns to its free list unless a live booking holds it.
+
+Handing out a slot and applying an occupancy change are O(1) each; nothing
+scans the slot table after the first build. `reserve_slot()` stays
+authoritative: a candidate that another process booked meanwhile is
+rejected there, and `parking.reservations.reserve_any()` moves on to the
+next one.
+"""
+
+import threading
+import time
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .layout import get_layout
+from .occupancy import get_snapshot
+
+# How long a handed-out slot stays off the free lists before its bookings are
+# checked again
+CLAIM_SECONDS = 60
+
+
+def booked_slot_ids(slot_ids=None):
+    """slot_ids (of `slot_ids`, or all) with a PENDING booking still within its
+    hold or a PAID booking that has not ended."""
+    from .models import Booking
+    now = timezone.now()
+    bookings = (Booking.objects.live()
+                .filter(Q(end_time__gt=now) | Q(end_time__isnull=True))
+                .exclude(payment_status=Booking.STATUS_PENDING, created_at__lt=now - Booking.PENDING_HOLD))
+    if slot_ids is not None:
+        bookings = bookings.filter(slot__slot_id__in=slot_ids)
+    return set(bookings.values_list('slot__slot_id', flat=True))
+
+
+class FreeList:
+    """Set of slot ids with O(1) add, discard and pop."""
+
+    def __init__(self, slot_ids=()):
+        self._items = []
+        self._pos = {}
+        # Reversed so pop() hands out bays in layout order
+        for slot_id in reversed(slot_ids):
+            self.add(slot_id)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, slot_id):
+        return slot_id in self._pos
+
+    def add(self, slot_id):
+        if slot_id not in self._pos:
+            self._pos[slot_id] = len(self._items)
+            self._items.append(slot_id)
+
+    def discard(self, slot_id):
+        idx = self._pos.pop(slot_id, None)
+        if idx is None:
+            return
+        last = self._items.pop()
+        if idx < len(self._items):
+            self._items[idx] = last
+            self._pos[last] = idx
+
+    def pop(self):
+        slot_id = self._items.pop()
+        del self._pos[slot_id]
+        return slot_id
+
+
+class Allocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._layout_version = None
+        self._snapshot_version = None
+        self._snapshot_epoch = None
+        # {(level, pricing category): FreeList}; levels as named by the layout
+        self._free = {}
+        # {slot_id: (level, pricing category)}
+        self._bucket = {}
+        self._levels = ()
+        self._categories = ()
+        # {slot_id: monotonic time the claim ends}
+        self._claims = {}
+
+    def _sync(self):
+        layout = get_layout()
+        snap = get_snapshot()
+        if (layout.version != self._layout_version or snap.epoch != self._snapshot_epoch
+                or self._snapshot_version is None or self._snapshot_version < snap.floor):
+            self._rebuild(layout, snap)
+            return
+        now = time.monotonic()
+        expired = [slot_id for slot_id, until in self._claims.items() if until <= now]
+        changed = set()
+        if expired:
+            booked = booked_slot_ids(expired)
+            for slot_id in expired:
+                if slot_id in booked:
+                    self._claims[slot_id] = now + CLAIM_SECONDS
+                else:
+                    del self._claims[slot_id]
+                    changed.add(slot_id)
+        # An older snapshot is served while another thread rebuilds; keep ours
+        if snap.version > self._snapshot_version:
+            for version, ids, gone in snap.changes:
+                if version > self._snapshot_version:
+                    changed |= ids | gone
+            self._snapshot_version = snap.version
+        for slot_id in changed:
+            self._update(slot_id, snap.slot(slot_id))
+
+    def _rebuild(self, layout, snap):
+        from .models import ParkingSlot
+        now = time.monotonic()
+        self._claims = {slot_id: until for slot_id, until in self._claims.items() if until > now}
+        for slot_id in booked_slot_ids():
+            self._claims.setdefault(slot_id, now + CLAIM_SECONDS)
+        members = {}
+        self._bucket = {}
+        for level, bays in layout.bays_by_level:
+            for bay in bays:
+                key = (level, bay['pricing_category'])
+                self._bucket[bay['slot_id']] = key
+                state = snap.slot(bay['slot_id'])
+                if state is not None and not state['is_occupied'] and bay['slot_id'] not in self._claims:
+                    members.setdefault(key, []).append(bay['slot_id'])
+        self._levels = layout.levels
+        self._categories = tuple(category for category, _ in ParkingSlot.PRICE_CHOICES)
+        # Categories outside PRICE_CHOICES (legacy rows) still get a bucket
+        self._categories += tuple(sorted({category for _, category in self._bucket.values()} - set(self._categories)))
+        self._free = {(level, category): FreeList(members.get((level, category), ()))
+                      for level in self._levels for category in self._categories}
+        self._layout_version = layout.version
+        self._snapshot_version = snap.version
+        self._snapshot_epoch = snap.epoch
+
+    def _update(self, slot_id, state):
+        key = self._bucket.get(slot_id)
+        if key is None or key not in self._free:
+            return
+        if state is not None and not state['is_occupied'] and slot_id not in self._claims:
+            self._free[key].add(slot_id)
+        else:
+            self._free[key].discard(slot_id)
+
+    def _buckets(self, level=None, pricing_category=None):
+        levels = self._levels if level is None else (level,)
+        categories = self._categories if pricing_category is None else (pricing_category,)
+        for lvl in levels:
+            for category in categories:
+                free = self._free.get((lvl, category))
+                if free is not None:
+                    yield free
+
+    def take(self, level=None, pricing_category=None):
+        """Claim a free slot matching the preferences; returns its slot_id or None.
+
+        Levels are tried in layout order and categories in `PRICE_CHOICES`
+        order, so unconstrained requests fill the cheapest bays first.
+        """
+        with self._lock:
+            self._sync()
+            for free in self._buckets(level, pricing_category):
+                if free:
+                    slot_id = free.pop()
+                    self._claims[slot_id] = time.monotonic() + CLAIM_SECONDS
+                    return slot_id
+        return None
+
+    def release(self, slot_id):
+        """End the claim on `slot_id`; the next read re-checks its bookings."""
+        with self._lock:
+            if slot_id in self._claims:
+                self._claims[slot_id] = 0
+
+    def free_count(self, level=None, pricing_category=None):
+        with self._lock:
+            self._sync()
+            return sum(len(free) for free in self._buckets(level, pricing_category))
+
+    def reset(self):
+        with self._lock:
+            self._layout_version = self._snapshot_version = self._snapshot_epoch = None
+            self._free, self._bucket, self._claims = {}, {}, {}
+
+
+allocator = Allocator()
+
+
+def take(level=None, pricing_category=None):
+    return allocator.take(level, pricing_category)
+
+
+def release(slot_id):
+    allocator.release(slot_id)
+
+
+def free_count(level=None, pricing_category=None):
+    return allocator.free_count(level, pricing_category)
+
+
+def reset():
+    """Drop the free lists and claims (tests)."""
+    allocator.reset()
@@ -0,0 +1,155 @@
+"""
+parking.counters
+------------------
+Slot totals and occupied counts per level and per pricing category.
+
+`SlotCounter` holds one row per level and one per pricing category. Stats
+tiles read them all in one small query (`summary()`) instead of counting the
+slot table on every page load.
+
+The rows are kept exact by the slot write paths in parking.models:
+- `ParkingSlot.save()`/`delete()`;
+- `ParkingSlotQuerySet.update()`, `delete()` and `bulk_create()`.
+
+Occupancy refreshes, admin overrides and bulk_update all go through these.
+Each one locks the slots it touches, and applies the change in
+(level, category, occupied) inside the same transaction as the write.
+Raw SQL does not go through them. `reconcile()` (`manage.py
+reconcile_counters`) recounts from the slot table and repairs any drift.
+"""
+
+from dataclasses import dataclass, field
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+
+LEVEL = 'level'
+CATEGORY = 'pricing_category'
+DIMENSIONS = (LEVEL, CATEGORY)
+# Slot fields whose changes move counters, in the order `deltas()` expects them
+TRACKED_FIELDS = ('level', 'pricing_category', 'is_occupied')
+
+
+@dataclass
+class Summary:
+    total: int = 0
+    occupied: int = 0
+    # {level: (total, occupied)} and {pricing category: (total, occupied)}
+    by_level: dict = field(default_factory=dict)
+    by_category: dict = field(default_factory=dict)
+
+    @property
+    def available(self):
+        return self.total - self.occupied
+
+    @property
+    def availability_percentage(self):
+        return (self.available / self.total * 100) if self.total > 0 else 0
+
+    def as_context(self):
+        """The stats-tile context shared by the home and dashboard pages."""
+        return {
+            'total_slots': self.total,
+            'occupied_count': self.occupied,
+            'available_count': self.available,
+            'availability_percentage': self.availability_percentage,
+        }
+
+
+def deltas(before=(), after=()):
+    """Counter changes for slots going from the `before` states to the `after`
+    states, each a (level, pricing_category, is_occupied) tuple.
+
+    Returns {(dimension, value): (total delta, occupied delta)}, without zeros.
+    """
+    changes = {}
+    for sign, states in ((-1, before), (1, after)):
+        for level, category, occupied in states:
+            for key in ((LEVEL, level), (CATEGORY, category)):
+                total, busy = changes.get(key, (0, 0))
+                changes[key] = (total + sign, busy + (sign if occupied else 0))
+    return {key: change for key, change in changes.items() if change != (0, 0)}
+
+
+def apply(changes):
+    """Add the output of `deltas()` to the stored counters.
+
+    A constant number of queries however many counters change: a locked read,
+    one INSERT for new levels or categories, and one UPDATE.
+    """
+    from .models import SlotCounter
+    if not changes:
+        return
+    keys = Q()
+    for dimension, value in changes:
+        keys |= Q(dimension=dimension, value=value)
+    with transaction.atomic():
+        while True:
+            existing = {(dimension, value): pk for pk, dimension, value in
+                        SlotCounter.objects.select_for_update().filter(keys).values_list('pk', 'dimension', 'value')}
+            missing = [SlotCounter(dimension=dimension, value=value, total=total, occupied=occupied)
+                       for (dimension, value), (total, occupied) in changes.items()
+                       if (dimension, value) not in existing]
+            try:
+                with transaction.atomic():
+                    SlotCounter.objects.bulk_create(missing)
+                break
+            except IntegrityError:
+                # Another writer created one of them since the read; read again
+                continue
+        if existing:
+            SlotCounter.objects.filter(pk__in=existing.values()).update(
+                total=F('total') + Case(*[When(pk=pk, then=Value(changes[key][0])) for key, pk in existing.items()],
+                                        default=Value(0)),
+                occupied=F('occupied') + Case(*[When(pk=pk, then=Value(changes[key][1]))
+                                                for key, pk in existing.items()], default=Value(0)),
+            )
+
+
+def summary():
+    """All counters in one query."""
+    from .models import SlotCounter
+    result = Summary()
+    for dimension, value, total, occupied in (SlotCounter.objects.filter(total__gt=0)
+                                              .values_list('dimension', 'value', 'total', 'occupied')):
+        if dimension == LEVEL:
+            result.by_level[value] = (total, occupied)
+            result.total += total
+            result.occupied += occupied
+        else:
+            result.by_category[value] = (total, occupied)
+    return result
+
+
+def actual_counts():
+    """{(dimension, value): (total, occupied)} counted from the slot table."""
+    from .models import ParkingSlot
+    counts = {}
+    for dimension in DIMENSIONS:
+        for row in (ParkingSlot.objects.order_by().values(dimension)
+                    .annotate(total=Count('pk'), occupied=Count('pk', filter=Q(is_occupied=True)))):
+            counts[dimension, row[dimension]] = (row['total'], row['occupied'])
+    return counts
+
+
+def reconcile(dry_run=False):
+    """Recount from the slot table and fix counters that drifted.
+
+    Returns {(dimension, value): (stored, actual)} for every counter that was
+    wrong, as (total, occupied) pairs.
+    """
+    from .models import SlotCounter
+    with transaction.atomic():
+        # Lock the counters first: writers that already changed slots finish
+        # (and apply their deltas) before the recount reads the slot table.
+        stored = {(dimension, value): (total, occupied) for dimension, value, total, occupied in
+                  SlotCounter.objects.select_for_update().values_list('dimension', 'value', 'total', 'occupied')}
+        actual = actual_counts()
+        drift = {key: (stored.get(key, (0, 0)), actual.get(key, (0, 0)))
+                 for key in stored.keys() | actual.keys()
+                 if stored.get(key, (0, 0)) != actual.get(key, (0, 0))}
+        if drift and not dry_run:
+            for (dimension, value), (_, (total, occupied)) in drift.items():
+                SlotCounter.objects.update_or_create(dimension=dimension, value=value,
+                                                     defaults={'total': total, 'occupied': occupied})
+    return drift
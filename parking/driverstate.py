@@ -0,0 +1,117 @@
+"""
+parking.driverstate
+---------------------
+What the dashboard and booking entry points need to know about one driver:
+- the pending booking (a PENDING booking younger than `Booking.PENDING_HOLD`);
+- the active booking (a PAID booking in effect whose slot is occupied);
+- the resulting occupancy status;
+- the five most recent bookings.
+
+`get(user)` loads this in two queries and caches the rows in Django's cache,
+per user, under a per-user `VersionStamp`. Everything that changes a
+driver's bookings calls `invalidate()`: `Booking.save()`/`delete()`, payment
+callbacks and the pending-expiry sweep. So a cached state is never served
+after the driver's bookings changed.
+
+What depends on the clock or on slot occupancy is derived on every read, from
+the cached rows, the current time and the occupancy snapshot
+(`parking.occupancy`). Pending holds lapse and paid bookings start and end
+without needing an invalidation.
+
+The cached state is for display and fast rejection only.
+`parking.reservations.reserve_slot()` still checks inside its transaction
+before creating a booking.
+"""
+
+from dataclasses import dataclass
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .occupancy import get_snapshot
+from .versioning import VersionStamp
+
+RECENT_BOOKINGS = 5
+# Safety net for writes that bypass invalidate() (raw SQL)
+CACHE_TIMEOUT = 300
+
+STATUS_FREE = 'FREE'
+STATUS_PENDING = 'PENDING'
+STATUS_OCCUPIED = 'OCCUPIED'
+
+
+@dataclass(frozen=True)
+class DriverState:
+    pending_booking: object = None
+    active_booking: object = None
+    recent_bookings: tuple = ()
+
+    @property
+    def occupancy_status(self):
+        if self.pending_booking is not None:
+            return STATUS_PENDING
+        if self.active_booking is not None:
+            return STATUS_OCCUPIED
+        return STATUS_FREE
+
+    @property
+    def blocks_booking(self):
+        """Same rule as reservations.user_has_blocking_booking()."""
+        return self.occupancy_status != STATUS_FREE
+
+
+def _stamp(user_id):
+    return VersionStamp(f'parking:driver-state:{user_id}:version')
+
+
+def _key(user_id):
+    return f'parking:driver-state:{user_id}'
+
+
+def _load(user_id, now):
+    """(recent bookings, live bookings) for a driver, two queries."""
+    from .models import Booking
+    bookings = Booking.objects.filter(user_id=user_id).select_related('slot')
+    recent = tuple(bookings.order_by('-start_time')[:RECENT_BOOKINGS])
+    # Everything that can still be pending or active; read() narrows by time.
+    # Bookings only leave this set as time passes, so it stays valid until
+    # the driver's bookings change.
+    live = tuple(bookings.filter(
+        Q(payment_status=Booking.STATUS_PENDING, created_at__gte=now - Booking.PENDING_HOLD)
+        | Q(payment_status=Booking.STATUS_PAID, end_time__gt=now)
+    ).order_by('-created_at', '-pk'))
+    return recent, live
+
+
+def get(user, now=None) -> DriverState:
+    """The driver state of `user` at `now` (default: now)."""
+    from .models import Booking
+    now = now or timezone.now()
+    version = _stamp(user.pk).current()
+    cached = cache.get(_key(user.pk))
+    if cached is None or cached[0] != version:
+        # Tagged with the version read before loading: an invalidation that
+        # lands meanwhile makes this entry unusable rather than stale
+        cached = (version, *_load(user.pk, now))
+        cache.set(_key(user.pk), cached, CACHE_TIMEOUT)
+    _, recent, live = cached
+
+    pending = next((b for b in live if b.payment_status == Booking.STATUS_PENDING
+                    and b.created_at >= now - Booking.PENDING_HOLD), None)
+    active = None
+    for booking in live:
+        if booking.payment_status == Booking.STATUS_PAID and booking.start_time <= now < booking.end_time:
+            # Only drivers with a booking in effect need the occupancy snapshot
+            slot = get_snapshot().slot(booking.slot.slot_id)
+            if slot and slot['is_occupied']:
+                active = booking
+                break
+    return DriverState(pending_booking=pending, active_booking=active, recent_bookings=recent)
+
+
+def invalidate(user_ids):
+    """Drop the cached state of these drivers, now and when the transaction commits."""
+    for user_id in set(user_ids):
+        if user_id is not None:
+            _stamp(user_id).changed()
@@ -93,6 +93,19 @@ class BookingForm(forms.ModelForm):
         return cleaned_data
 
 
+class AutoBookingForm(BookingForm):
+    """
+    Booking form for "any free slot" mode: the driver gives preferences instead
+    of a slot, and parking.allocator assigns one. Blank means no preference.
+    """
+    level = forms.CharField(max_length=20, required=False, label='Level')
+    pricing_category = forms.ChoiceField(
+        choices=(('', 'Any'),) + ParkingSlot.PRICE_CHOICES,
+        required=False,
+        label='Pricing Rate'
+    )
+
+
 # --- 3. Pricing Form (Admin) ---
 class PricingForm(forms.Form):
     regular_rate = forms.DecimalField(max_digits=8, decimal_places=2, label='Regular (KES)', min_value=0)
@@ -0,0 +1,169 @@
+"""
+parking.layout
+----------------
+Cached bay layout for the driver dashboard.
+
+The dashboard shows slots grouped by level, with levels in natural order
+(B2 before B10), and with SVG coordinates for every bay. That layout only
+changes when an admin adds, edits or deletes a slot. So it is computed once
+per inventory version and kept per process. The version is a
+`VersionStamp`, bumped by the ParkingSlot write paths in parking.models.
+Occupancy-only writes do not bump it.
+
+Occupancy is overlaid one level at a time, from the occupancy snapshot
+(`parking.occupancy`). The dashboard's first paint only lists the levels;
+each level's bays are fetched when the driver opens it. So page size and
+render time follow the size of one level, not of the whole garage. Each
+level's overlay is cached until the layout or the snapshot changes.
+"""
+
+import re
+import threading
+from dataclasses import dataclass
+
+from .occupancy import get_snapshot
+from .versioning import VersionStamp
+
+_stamp = VersionStamp('parking:inventory:version')
+
+# Fields that affect the layout; writes touching only others (occupancy) keep it
+LAYOUT_FIELDS = frozenset({'slot_id', 'slot_name', 'level', 'pricing_category'})
+
+# SVG geometry: one row of bays per level
+SLOT_W = 110
+SLOT_H = 58
+GAP = 18
+LEFT_MARGIN = 260
+TOP_MARGIN = 48
+LEVEL_GAP = SLOT_H + 48
+
+
+def level_sort_key(level):
+    """Natural sort key for level names: split an alphabetic prefix and a
+    numeric suffix (e.g. B1 -> ('B', 1), so B2 sorts before B10)."""
+    if not level:
+        return ('', 0)
+    m = re.match(r"^([A-Za-z]+)\s*([0-9]+)$", level.strip())
+    if m:
+        return (m.group(1).upper(), int(m.group(2)))
+    # fallback: find first number anywhere
+    m2 = re.search(r"([0-9]+)", level)
+    if m2:
+        prefix = re.sub(r"[0-9]", '', level).strip().upper()
+        return (prefix, int(m2.group(1)))
+    return (level.strip().upper(), 0)
+
+
+@dataclass(frozen=True)
+class Layout:
+    version: int
+    # Level names in display order
+    levels: tuple
+    # ((level, (bay, ...)), ...) with each bay a dict of slot metadata and geometry
+    bays_by_level: tuple
+    # {level: frozenset of slot ids}, to restrict occupancy payloads to a level
+    slot_ids_by_level: dict
+
+
+@dataclass(frozen=True)
+class Overlay:
+    """One level of the layout with occupancy applied, as rendered by the dashboard."""
+    level: str
+    layout_version: int
+    snapshot_version: int
+    snapshot_epoch: str
+    # [slot dict, ...] in bay order
+    slots: list
+    slot_vehicle_types: dict
+
+
+def inventory_changed():
+    """Signal that slots were added, removed or re-labelled."""
+    _stamp.changed()
+
+
+_lock = threading.Lock()
+_layout = None
+# {level: Overlay}
+_overlays = {}
+
+
+def get_layout():
+    """The current layout, rebuilt (one query) only after the inventory changed."""
+    global _layout
+    version = _stamp.current()
+    current = _layout
+    if current is not None and current.version == version:
+        return current
+    with _lock:
+        if _layout is None or _layout.version != version:
+            _layout = _build(version)
+        return _layout
+
+
+def _build(version):
+    from .models import ParkingSlot
+    categories = dict(ParkingSlot.PRICE_CHOICES)
+    groups = {}
+    for slot_id, level, category in (ParkingSlot.objects.order_by('level', 'slot_id')
+                                     .values_list('slot_id', 'level', 'pricing_category')):
+        groups.setdefault(level or 'Level', []).append((slot_id, level, category))
+
+    levels = tuple(sorted(groups, key=level_sort_key))
+    bays_by_level = []
+    for row, level in enumerate(levels):
+        y = TOP_MARGIN + row * LEVEL_GAP
+        bays = []
+        for idx, (slot_id, slot_level, category) in enumerate(groups[level]):
+            x = LEFT_MARGIN + idx * (SLOT_W + GAP)
+            bays.append({
+                'slot_id': slot_id,
+                'level': slot_level,
+                'pricing_category': category,
+                'pricing_category_display': categories.get(category, category),
+                'x': x,
+                'y': y,
+                'w': SLOT_W,
+                'h': SLOT_H,
+                'cx': x + SLOT_W / 2,
+                'cy': y + SLOT_H / 2,
+            })
+        bays_by_level.append((level, tuple(bays)))
+    return Layout(version=version, levels=levels, bays_by_level=tuple(bays_by_level),
+                  slot_ids_by_level={level: frozenset(slot_id for slot_id, _, _ in groups[level])
+                                     for level in levels})
+
+
+def get_overlay(level):
+    """`level` with current occupancy applied, or None for an unknown level;
+    shared by requests until either the layout or the occupancy snapshot changes."""
+    global _overlays
+    layout = get_layout()
+    if level not in layout.slot_ids_by_level:
+        return None
+    snap = get_snapshot()
+    current = _overlays.get(level)
+    if (current is not None and current.layout_version == layout.version
+            and current.snapshot_version == snap.version and current.snapshot_epoch == snap.epoch):
+        return current
+    slots, vehicle_types = [], {}
+    for bay in dict(layout.bays_by_level)[level]:
+        state = snap.slot(bay['slot_id']) or {}
+        slot = dict(bay, is_occupied=state.get('is_occupied', False), vehicle_type=state.get('vehicle_type'))
+        slots.append(slot)
+        if slot['is_occupied'] and slot['vehicle_type']:
+            vehicle_types[slot['slot_id']] = slot['vehicle_type']
+    current = Overlay(level=level, layout_version=layout.version, snapshot_version=snap.version,
+                      snapshot_epoch=snap.epoch, slots=slots, slot_vehicle_types=vehicle_types)
+    # Drop levels of an older layout so renamed levels do not pile up
+    overlays = {key: value for key, value in _overlays.items() if value.layout_version == layout.version}
+    overlays[level] = current
+    _overlays = overlays
+    return current
+
+
+def reset():
+    """Drop the cached layout and overlays (tests)."""
+    global _layout, _overlays
+    _layout = None
+    _overlays = {}
@@ -0,0 +1,176 @@
+"""
+parking.live
+--------------
+In-process broker that pushes occupancy changes to connected dashboards.
+
+`occupancy.mark_changed()` calls `broker.publish()` from whatever thread changed
+a slot (a view, a payment callback, the simulated M-Pesa timer). The broker keeps
+one watcher task per event loop; a publish wakes that task, which fetches the
+occupancy snapshot once and hands it to every subscriber on the loop. Idle
+subscribers are just an `asyncio.Event` each, so one ASGI worker can hold
+thousands of open streams.
+
+The watcher also re-checks the snapshot every `poll_interval` seconds, which
+picks up changes made by other worker processes (see `parking.versioning`).
+Tests can drive the broker directly: `subscribe()` inside a running loop,
+`publish()` (optionally with a prepared snapshot), then await `next()`.
+"""
+
+import asyncio
+import threading
+
+from asgiref.sync import sync_to_async
+
+
+class Subscriber:
+    def __init__(self, loop):
+        self.loop = loop
+        self.snapshot = None
+        self._event = asyncio.Event()
+
+    def offer(self, snapshot):
+        self.snapshot = snapshot
+        self._event.set()
+
+    async def next(self, timeout=None):
+        """Wait for a newer snapshot; returns None if `timeout` passes first."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._event.clear()
+        return self.snapshot
+
+
+class _LoopState:
+    def __init__(self):
+        self.subscribers = set()
+        self.wake = asyncio.Event()
+        self.pending = None
+        self.version = None
+        self.task = None
+
+
+class OccupancyBroker:
+    def __init__(self, poll_interval=15.0):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._loops = {}
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(state.subscribers) for state in self._loops.values())
+
+    def subscribe(self) -> Subscriber:
+        loop = asyncio.get_running_loop()
+        sub = Subscriber(loop)
+        with self._lock:
+            state = self._loops.get(loop)
+            if state is None:
+                state = self._loops[loop] = _LoopState()
+                state.task = loop.create_task(self._watch(loop, state))
+            state.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            state = self._loops.get(sub.loop)
+            if state is None:
+                return
+            state.subscribers.discard(sub)
+            if not state.subscribers:
+                del self._loops[sub.loop]
+                state.task.cancel()
+
+    def publish(self, snapshot=None):
+        """Wake subscribers. Safe to call from any thread, with or without a loop."""
+        with self._lock:
+            states = list(self._loops.items())
+        for loop, state in states:
+            try:
+                loop.call_soon_threadsafe(self._wake, state, snapshot)
+            except RuntimeError:
+                # Loop already closed; its subscribers are gone.
+                pass
+
+    @staticmethod
+    def _wake(state, snapshot):
+        if snapshot is not None:
+            state.pending = snapshot
+        state.wake.set()
+
+    async def _watch(self, loop, state):
+        from .occupancy import get_snapshot
+
+        fetch = sync_to_async(get_snapshot)
+        while True:
+            try:
+                await asyncio.wait_for(state.wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            state.wake.clear()
+            snapshot, state.pending = state.pending, None
+            if snapshot is None:
+                try:
+                    snapshot = await fetch()
+                except Exception:
+                    continue
+            if snapshot.version == state.version:
+                continue
+            state.version = snapshot.version
+            for sub in list(state.subscribers):
+                sub.offer(snapshot)
+
+
+broker = OccupancyBroker()
+
+
+def _sse(snapshot, payload):
+    return (
+        f"event: occupancy\nid: {snapshot.epoch}-{snapshot.version}\ndata: ".encode('utf-8')
+        + payload + b"\n\n"
+    )
+
+
+def _untouched(snapshot, since, slot_ids):
+    """True when `snapshot` is known to change none of `slot_ids` after `since`."""
+    if slot_ids is None or not snapshot.floor <= since <= snapshot.version:
+        return False
+    return not any((ids | gone) & slot_ids for version, ids, gone in snapshot.changes if version > since)
+
+
+async def event_stream(since=None, epoch=None, heartbeat=20.0, slot_ids=None):
+    """Server-sent events for the occupancy stream.
+
+    The first event is the full snapshot (or the delta since `since` when the
+    client reconnects to the same process); afterwards one event is sent per
+    change, carrying only the slots that changed. With `slot_ids` (a frozenset,
+    e.g. one level of the bay layout) events only carry those slots, and
+    changes elsewhere send nothing. Comment lines are sent every `heartbeat`
+    seconds so proxies keep idle connections open.
+    """
+    from .occupancy import get_snapshot
+
+    sub = broker.subscribe()
+    try:
+        snapshot = await sync_to_async(get_snapshot)()
+        payload = None
+        if since is not None and epoch == snapshot.epoch:
+            payload = snapshot.delta_since(since, slot_ids)
+        yield _sse(snapshot, payload or snapshot.payload_for(slot_ids))
+        last = snapshot.version
+
+        while True:
+            snapshot = await sub.next(timeout=heartbeat)
+            if snapshot is None:
+                yield b": keepalive\n\n"
+                continue
+            if snapshot.version == last:
+                continue
+            if not _untouched(snapshot, last, slot_ids):
+                payload = snapshot.delta_since(last, slot_ids)
+                yield _sse(snapshot, payload or snapshot.payload_for(slot_ids))
+            last = snapshot.version
+    finally:
+        broker.unsubscribe(sub)
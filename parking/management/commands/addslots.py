@@ -1,11 +1,19 @@
-from django.core.management.base import BaseCommand
+import csv
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
+from parking import occupancy
 from parking.models import ParkingSlot
 
 
 class Command(BaseCommand):
-    help = 'Create parking slots. Usage: manage.py addslots --num 20 --prefix S --start 1 --level L1'
+    help = ('Create parking slots. Usage: manage.py addslots --num 20 --prefix S --start 1 --level L1. '
+            'Use --bulk (or --layout slots.csv|slots.json) to provision large structures with '
+            'bulk inserts/updates in batches of --batch-size.')
 
     def add_arguments(self, parser):
         parser.add_argument('--num', type=int, default=20, help='Number of slots to create')
@@ -13,28 +21,49 @@ class Command(BaseCommand):
         parser.add_argument('--start', type=int, default=1, help='Start index for numbering')
         parser.add_argument('--level', type=str, default='L1', help='Level (value for level field)')
         parser.add_argument('--force', action='store_true', help='Update existing slots with provided defaults')
+        parser.add_argument('--bulk', action='store_true', help='Use bulk_create/bulk_update instead of one query per slot')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per bulk INSERT/UPDATE (bulk mode)')
+        parser.add_argument('--layout', type=str,
+                            help='CSV or JSON file with slot_id, level and optional slot_name/pricing_category '
+                                 'per slot (implies --bulk)')
 
     def handle(self, *args, **options):
-        num = options['num']
-        prefix = options['prefix']
-        start = options['start']
+        started = time.perf_counter()
+        if options['bulk'] or options['layout']:
+            processed = self._handle_bulk(options)
+        else:
+            processed = self._handle_each(options)
+        elapsed = time.perf_counter() - started
+
+        total = ParkingSlot.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Total parking slots in DB: {total}"))
+        rate = processed / elapsed if elapsed else processed
+        self.stdout.write(f"Processed {processed} slots in {elapsed:.2f}s ({rate:.0f} slots/sec)")
+
+    def _default_rows(self, options):
         level = options['level']
+        rows = []
+        for i in range(options['start'], options['start'] + options['num']):
+            rows.append({
+                'slot_id': f"{options['prefix']}-{i:03d}",
+                'slot_name': f"Level {level} Spot {i:03d}" if level else f"Spot {i:03d}",
+                'pricing_category': 'Regular',
+                'level': level,
+            })
+        return rows
+
+    def _handle_each(self, options):
         force = options['force']
 
         created = []
         updated = []
         skipped = []
 
+        rows = self._default_rows(options)
         with transaction.atomic():
-            for i in range(start, start + num):
-                slot_id = f"{prefix}-{i:03d}"
-                slot_name = f"Level {level} Spot {i:03d}" if level else f"Spot {i:03d}"
-                defaults = {
-                    'slot_name': slot_name,
-                    'pricing_category': 'Regular',
-                    'is_occupied': False,
-                    'level': level,
-                }
+            for row in rows:
+                slot_id = row.pop('slot_id')
+                defaults = dict(row, is_occupied=False)
 
                 if force:
                     slot, created_flag = ParkingSlot.objects.update_or_create(
@@ -62,6 +91,74 @@ class Command(BaseCommand):
             self.stdout.write(self.style.SUCCESS(f"Updated {len(updated)} slots: {updated}"))
         if skipped:
             self.stdout.write(self.style.WARNING(f"Skipped (already existed) {len(skipped)} slots: {skipped}"))
+        return len(rows)
 
-        total = ParkingSlot.objects.count()
-        self.stdout.write(self.style.SUCCESS(f"Total parking slots in DB: {total}"))
+    def _handle_bulk(self, options):
+        rows = self._read_layout(options['layout']) if options['layout'] else self._default_rows(options)
+        batch_size = options['batch_size']
+        fields = ['slot_name', 'level', 'pricing_category', 'is_occupied']
+
+        with transaction.atomic():
+            # One read of the existing inventory instead of a lookup per slot
+            existing = dict(ParkingSlot.objects.values_list('slot_id', 'pk'))
+            to_create = []
+            to_update = []
+            for row in rows:
+                slot = ParkingSlot(is_occupied=False, **row)
+                if row['slot_id'] not in existing:
+                    to_create.append(slot)
+                elif options['force']:
+                    slot.pk = existing[row['slot_id']]
+                    to_update.append(slot)
+
+            ParkingSlot.objects.bulk_create(to_create, batch_size=batch_size)
+            if to_update:
+                ParkingSlot.objects.bulk_update(to_update, fields, batch_size=batch_size)
+            # Bulk operations bypass ParkingSlot.save(); refresh the live snapshot explicitly
+            occupancy.mark_changed()
+
+        skipped = len(rows) - len(to_create) - len(to_update)
+        self.stdout.write(self.style.SUCCESS(f"Created {len(to_create)} slots"))
+        if to_update:
+            self.stdout.write(self.style.SUCCESS(f"Updated {len(to_update)} slots"))
+        if skipped:
+            self.stdout.write(self.style.WARNING(f"Skipped (already existed) {skipped} slots"))
+        return len(rows)
+
+    def _read_layout(self, path):
+        path = Path(path)
+        if not path.exists():
+            raise CommandError(f"Layout file not found: {path}")
+        if path.suffix.lower() == '.json':
+            data = json.loads(path.read_text(encoding='utf-8'))
+            records = data.get('slots', []) if isinstance(data, dict) else data
+        elif path.suffix.lower() == '.csv':
+            with path.open(newline='', encoding='utf-8') as fh:
+                records = list(csv.DictReader(fh))
+        else:
+            raise CommandError("Layout file must be .csv or .json")
+
+        categories = {value for value, _ in ParkingSlot.PRICE_CHOICES}
+        max_id_length = ParkingSlot._meta.get_field('slot_id').max_length
+        rows = []
+        seen = set()
+        for line, record in enumerate(records, start=1):
+            slot_id = (record.get('slot_id') or '').strip()
+            level = (record.get('level') or '').strip()
+            category = (record.get('pricing_category') or 'Regular').strip()
+            if not slot_id or not level:
+                raise CommandError(f"Layout row {line}: slot_id and level are required")
+            if len(slot_id) > max_id_length:
+                raise CommandError(f"Layout row {line}: slot_id '{slot_id}' is longer than {max_id_length} characters")
+            if category not in categories:
+                raise CommandError(f"Layout row {line}: unknown pricing_category '{category}'")
+            if slot_id in seen:
+                raise CommandError(f"Layout row {line}: duplicate slot_id '{slot_id}'")
+            seen.add(slot_id)
+            rows.append({
+                'slot_id': slot_id,
+                'slot_name': (record.get('slot_name') or '').strip() or f"Level {level} Spot {slot_id}",
+                'level': level,
+                'pricing_category': category,
+            })
+        return rows
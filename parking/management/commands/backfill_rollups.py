@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from parking import rollups
+from parking.models import Booking
+
+
+class Command(BaseCommand):
+    help = ('Recompute the hourly and daily booking rollups from bookings. Safe to re-run; existing rows '
+            'for the range are replaced. Usage: manage.py backfill_rollups [--from 2026-01-01] [--to 2026-01-31] '
+            '[--days-per-batch 7].')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='first', help="First local date (default: the oldest booking's creation or start)")
+        parser.add_argument('--to', dest='last', help='Last local date (default: today)')
+        parser.add_argument('--days-per-batch', type=int, default=7, help='Days recomputed per transaction')
+
+    def handle(self, *args, **options):
+        first, last = self._date(options['first']), self._date(options['last']) or timezone.localdate()
+        if first is None:
+            oldest = [value for value in Booking.objects.aggregate(Min('created_at'), Min('start_time')).values() if value]
+            if not oldest:
+                self.stdout.write('No bookings to roll up')
+                return
+            first = timezone.localdate(min(oldest))
+        if first > last:
+            raise CommandError(f'--from {first} is after --to {last}')
+
+        started = time.perf_counter()
+        written = rollups.rebuild(first, last, days_per_batch=max(options['days_per_batch'], 1))
+        elapsed = time.perf_counter() - started
+        days = (last - first).days + 1
+        self.stdout.write(f'Wrote {written} rollup rows for {days} days ({first} to {last}) in {elapsed:.2f}s')
+
+    def _date(self, value):
+        if not value:
+            return None
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f'Invalid date: {value!r}')
+        return day
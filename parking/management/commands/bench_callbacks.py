@@ -0,0 +1,166 @@
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from parking.models import ParkingSlot, Booking
+from parkingpayments.callbacks import parse_callback, apply_callback, NOT_FOUND
+from parkingpayments.inbox import BATCH_SIZE, drain, enqueue
+
+
+class Command(BaseCommand):
+    help = ('Replay M-Pesa STK callbacks through parkingpayments.callbacks and report throughput. '
+            'Usage: manage.py bench_callbacks --callbacks 100000 --duplicates 0.1 [--payloads recorded.jsonl] '
+            '[--mode inbox|direct]. Inbox mode times the webhook append and the batched drain separately; '
+            'direct mode applies each callback on its own. '
+            'Without --payloads, Daraja-style payloads are generated for freshly created bookings. '
+            'All rows are created inside a transaction that is rolled back at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callbacks', type=int, default=100_000, help='Callbacks to replay')
+        parser.add_argument('--duplicates', type=float, default=0.1,
+                            help='Share of callbacks that are redelivered (Safaricom retries)')
+        parser.add_argument('--failures', type=float, default=0.05, help='Share of generated callbacks that report a failed payment')
+        parser.add_argument('--payloads', type=str,
+                            help='JSONL file of recorded callback bodies; bookings are created for their CheckoutRequestIDs')
+        parser.add_argument('--slots', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=5000, help='bulk_create batch size')
+        parser.add_argument('--mode', choices=['inbox', 'direct'], default='inbox')
+        parser.add_argument('--drain-batch', type=int, default=BATCH_SIZE, help='Callbacks per drain batch (inbox mode)')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            if options['payloads']:
+                bodies = self._load(options['payloads'])
+            else:
+                bodies = self._generate(options['callbacks'], options['failures'], rng)
+            refs = list(dict.fromkeys(parse_callback(json.loads(b)).reference for b in bodies))
+            self._populate(refs, options['slots'], options['batch_size'])
+
+            # Redeliveries are replayed after a random delay, as Safaricom retries would be
+            duplicates = [rng.choice(bodies) for _ in range(int(len(bodies) * options['duplicates']))]
+            replay = bodies + duplicates
+            rng.shuffle(replay)
+
+            if options['mode'] == 'inbox':
+                self._inbox(replay, options['drain_batch'])
+            else:
+                self._direct(replay)
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished; all benchmark rows rolled back.'))
+
+    def _inbox(self, replay, batch_size):
+        with override_settings(MPESA_CALLBACK_AUTODRAIN=False):
+            timings = []
+            started = time.perf_counter()
+            for body in replay:
+                t0 = time.perf_counter()
+                # What the webhook does per delivery: validate, parse, append
+                parse_callback(json.loads(body))
+                enqueue(body)
+                timings.append((time.perf_counter() - t0) * 1000)
+            elapsed = time.perf_counter() - started
+        self._report('Queued', timings, elapsed)
+
+        started = time.perf_counter()
+        outcomes = drain(batch_size)
+        elapsed = time.perf_counter() - started
+        total = sum(outcomes.values())
+        self.stdout.write(f'Drained {total} callbacks in batches of {batch_size} in {elapsed:.2f}s '
+                          f'({total / elapsed:.0f} callbacks/sec)')
+        self._outcomes(outcomes)
+
+    def _direct(self, replay):
+        outcomes = {}
+        timings = []
+        sample = min(len(replay), 1000)
+        with CaptureQueriesContext(connection) as ctx:
+            for body in replay[:sample]:
+                apply_callback(parse_callback(json.loads(body)))
+        queries_per_callback = len([q for q in ctx.captured_queries
+                                    if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]) / sample
+
+        started = time.perf_counter()
+        for body in replay[sample:]:
+            t0 = time.perf_counter()
+            outcome, _ = apply_callback(parse_callback(json.loads(body)))
+            timings.append((time.perf_counter() - t0) * 1000)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        elapsed = time.perf_counter() - started
+
+        if not timings:
+            raise CommandError('Not enough callbacks to measure; increase --callbacks')
+        self._report('Replayed', timings, elapsed)
+        self.stdout.write(f'Queries per callback (first {sample}, excluding savepoints): {queries_per_callback:.2f}')
+        self._outcomes(outcomes)
+
+    def _report(self, label, timings, elapsed):
+        timings.sort()
+        self.stdout.write(f'{label} {len(timings)} callbacks in {elapsed:.2f}s ({len(timings) / elapsed:.0f} callbacks/sec)')
+        self.stdout.write(f'Latency avg {statistics.mean(timings):.3f}ms, '
+                          f'p95 {timings[int(len(timings) * 0.95) - 1]:.3f}ms, max {timings[-1]:.3f}ms')
+
+    def _outcomes(self, outcomes):
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome}: {count}')
+        if outcomes.get(NOT_FOUND):
+            self.stdout.write(self.style.WARNING('Some callbacks did not match a booking.'))
+
+    def _load(self, path):
+        try:
+            with open(path, encoding='utf-8') as fh:
+                return [line.strip() for line in fh if line.strip()]
+        except OSError as exc:
+            raise CommandError(f'Cannot read payloads: {exc}')
+
+    def _generate(self, count, failures, rng):
+        bodies = []
+        for i in range(count):
+            checkout_id = f'ws_CO_BENCH{i:010d}'
+            if rng.random() < failures:
+                stk = {'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user'}
+            else:
+                stk = {
+                    'ResultCode': 0,
+                    'ResultDesc': 'The service request is processed successfully.',
+                    'CallbackMetadata': {'Item': [
+                        {'Name': 'Amount', 'Value': 100},
+                        {'Name': 'MpesaReceiptNumber', 'Value': f'BNC{i:07d}'},
+                        {'Name': 'PhoneNumber', 'Value': 254712345678},
+                    ]},
+                }
+            stk.update({'MerchantRequestID': f'bench-{i}', 'CheckoutRequestID': checkout_id})
+            bodies.append(json.dumps({'Body': {'stkCallback': stk}}))
+        return bodies
+
+    def _populate(self, refs, slot_count, batch_size):
+        user = get_user_model().objects.create_user(
+            email='bench-callbacks@example.invalid',
+            username='bench-callbacks',
+            phone_number='254799999998',
+            vehicle_plate='BENCH-CB',
+            password=None,
+        )
+        slots = ParkingSlot.objects.bulk_create([
+            ParkingSlot(slot_id=f'BC-{i:05d}', slot_name=f'Bench {i}', level='BENCH')
+            for i in range(slot_count)
+        ])
+        start = timezone.now()
+        Booking.objects.bulk_create([
+            Booking(user=user, slot=slots[i % slot_count], start_time=start,
+                    end_time=start + timedelta(hours=1), checkout_request_id=ref)
+            for i, ref in enumerate(refs) if ref and not ref.isdigit()
+        ], batch_size=batch_size)
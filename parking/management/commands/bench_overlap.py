@@ -0,0 +1,117 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from parking.models import ParkingSlot, Booking
+
+
+class Command(BaseCommand):
+    help = ('Benchmark booking overlap checks against growing booking history. '
+            'Usage: manage.py bench_overlap --sizes 10000 100000 1000000 --slots 200 --queries 500. '
+            'All rows are created inside a transaction that is rolled back at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help='Historical booking counts to measure at (ascending)')
+        parser.add_argument('--slots', type=int, default=200, help='Number of slots to spread bookings over')
+        parser.add_argument('--queries', type=int, default=500, help='Overlap checks per size')
+        parser.add_argument('--batch-size', type=int, default=5000, help='bulk_create batch size')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        sizes = sorted(options['sizes'])
+
+        with transaction.atomic():
+            user = get_user_model().objects.create_user(
+                email='bench-overlap@example.invalid',
+                username='bench-overlap',
+                phone_number='254799999999',
+                vehicle_plate='BENCH-OVL',
+                password=None,
+            )
+            slots = ParkingSlot.objects.bulk_create([
+                ParkingSlot(slot_id=f'BO-{i:05d}', slot_name=f'Bench {i}', level='BENCH')
+                for i in range(options['slots'])
+            ])
+
+            self.stdout.write(f"{'bookings':>10} {'helper avg':>11} {'helper p95':>11} {'legacy avg':>11} {'legacy p95':>11}")
+            inserted = 0
+            for size in sizes:
+                self._populate(user, slots, size - inserted, options['batch_size'], rng)
+                inserted = size
+                helper = self._measure(slots, options['queries'], rng, self._helper_query)
+                legacy = self._measure(slots, options['queries'], rng, self._legacy_query)
+                self.stdout.write(
+                    f"{size:>10} {helper[0]:>9.3f}ms {helper[1]:>9.3f}ms {legacy[0]:>9.3f}ms {legacy[1]:>9.3f}ms"
+                )
+
+            now = timezone.now()
+            plan_sql, params = self._helper_query(slots[0], now, now + timedelta(hours=2)).query.sql_with_params()
+            if connection.vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.execute(f'EXPLAIN QUERY PLAN {plan_sql}', params)
+                    self.stdout.write('Query plan (helper):')
+                    for row in cursor.fetchall():
+                        self.stdout.write(f'  {row[-1]}')
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished; all benchmark rows rolled back.'))
+
+    def _populate(self, user, slots, count, batch_size, rng):
+        now = timezone.now()
+        statuses = [Booking.STATUS_PAID] * 14 + [Booking.STATUS_FAILED] * 5 + [Booking.STATUS_PENDING]
+        batch = []
+        for _ in range(count):
+            start = now - timedelta(minutes=rng.randint(60, 2 * 365 * 24 * 60))
+            batch.append(Booking(
+                user=user,
+                slot=rng.choice(slots),
+                start_time=start,
+                end_time=start + timedelta(hours=rng.randint(1, 24)),
+                payment_status=rng.choice(statuses),
+            ))
+            if len(batch) >= batch_size:
+                Booking.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Booking.objects.bulk_create(batch)
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+    def _measure(self, slots, queries, rng, build):
+        timings = []
+        now = timezone.now()
+        for _ in range(queries):
+            start = now + timedelta(minutes=rng.randint(0, 7 * 24 * 60))
+            end = start + timedelta(hours=rng.randint(1, 24))
+            qs = build(rng.choice(slots), start, end)
+            t0 = time.perf_counter()
+            qs.exists()
+            timings.append((time.perf_counter() - t0) * 1000)
+        timings.sort()
+        return statistics.mean(timings), timings[int(len(timings) * 0.95) - 1]
+
+    @staticmethod
+    def _helper_query(slot, start, end):
+        return Booking.objects.overlapping(slot, start, end)
+
+    @staticmethod
+    def _legacy_query(slot, start, end):
+        # The overlap filter initiate_booking_view used before BookingQuerySet.overlapping
+        return Booking.objects.filter(
+            Q(payment_status__in=[Booking.STATUS_PENDING, Booking.STATUS_PAID]) & Q(slot=slot) & (
+                Q(start_time__lt=end, end_time__gt=start) |
+                Q(start_time__lt=end, end_time__isnull=True) |
+                Q(start_time__isnull=True, end_time__gt=start)
+            )
+        )
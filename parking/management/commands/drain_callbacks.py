@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from parkingpayments.inbox import BATCH_SIZE, drain
+
+
+class Command(BaseCommand):
+    help = ('Apply queued M-Pesa callbacks (PaymentCallback rows) to bookings in batches. '
+            'Usage: manage.py drain_callbacks [--batch-size 500] [--loop --interval 1.0].')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Callbacks applied per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep draining until interrupted')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the inbox is empty (--loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            counts = drain(options['batch_size'])
+            elapsed = time.perf_counter() - started
+            total = sum(counts.values())
+            if total or not options['loop']:
+                rate = total / elapsed if elapsed else total
+                summary = ', '.join(f'{outcome}: {count}' for outcome, count in sorted(counts.items())) or 'inbox empty'
+                self.stdout.write(f'Drained {total} callbacks in {elapsed:.2f}s ({rate:.0f}/sec) - {summary}')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from parking.models import Booking
+from parking.reservations import expire_pending_bookings
+
+
+class Command(BaseCommand):
+    help = ('Mark PENDING bookings older than Booking.PENDING_HOLD as FAILED. '
+            'Usage: manage.py expire_pending [--batch-size 1000] [--loop --interval 60] [--dry-run].')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Bookings expired per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep sweeping until interrupted')
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between sweeps (--loop)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count stale pending bookings')
+
+    def handle(self, *args, **options):
+        while True:
+            if options['dry_run']:
+                self.stdout.write(f'{Booking.objects.stale_pending().count()} stale pending bookings')
+                return
+
+            started = time.perf_counter()
+            expired = expire_pending_bookings(options['batch_size'])
+            elapsed = time.perf_counter() - started
+            if expired or not options['loop']:
+                rate = expired / elapsed if elapsed else expired
+                self.stdout.write(f'Expired {expired} pending bookings in {elapsed:.2f}s ({rate:.0f} rows/sec)')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
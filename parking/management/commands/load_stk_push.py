@@ -0,0 +1,143 @@
+import statistics
+import threading
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from parking.models import ParkingSlot, Booking
+from parking.scheduler import scheduler
+from parkingpayments.dispatch import get_dispatcher
+from parkingpayments.stub_daraja import StubDaraja
+
+
+class Command(BaseCommand):
+    help = ('Load-test the booking view against a slow local stub of the Daraja gateway and '
+            'compare request latency with inline and background STK pushes. '
+            'Usage: manage.py load_stk_push --bookings 20 --gateway-delay 1.0 --mode both. '
+            'With --mode simulate the bookings are paid by simulated callbacks instead '
+            '(--pay-delay, --pay-jitter, --failure-rate) and the full booking -> payment -> occupancy '
+            'flow is timed. '
+            'Creates LOAD-* slots and load users, and deletes them afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=20, help='Bookings per mode')
+        parser.add_argument('--gateway-delay', type=float, default=1.0, help='Seconds the stub takes per STK push')
+        parser.add_argument('--mode', choices=['async', 'sync', 'both', 'simulate'], default='both')
+        parser.add_argument('--pay-delay', type=float, default=1.0, help='MPESA_SIMULATE_DELAY for --mode simulate')
+        parser.add_argument('--pay-jitter', type=float, default=0.5, help='MPESA_SIMULATE_DELAY_JITTER for --mode simulate')
+        parser.add_argument('--failure-rate', type=float, default=0.1, help='MPESA_SIMULATE_FAILURE_RATE for --mode simulate')
+        parser.add_argument('--workers', type=int, default=4, help='MPESA_PUSH_WORKERS for async mode')
+
+    def handle(self, *args, **options):
+        if options['mode'] == 'simulate':
+            with override_settings(
+                MPESA_SIMULATE=True,
+                MPESA_SIMULATE_DELAY=options['pay_delay'],
+                MPESA_SIMULATE_DELAY_JITTER=options['pay_jitter'],
+                MPESA_SIMULATE_FAILURE_RATE=options['failure_rate'],
+                MPESA_CALLBACK_AUTODRAIN=True,
+                MPESA_PUSH_WORKERS=options['workers'],
+                ALLOWED_HOSTS=['testserver'],
+            ):
+                self.stdout.write(f"{'mode':>8} {'bookings':>9} {'avg':>9} {'p95':>9} {'max':>9} {'pushes done':>12}")
+                self._run('simulate', options['bookings'])
+            return
+
+        modes = ['sync', 'async'] if options['mode'] == 'both' else [options['mode']]
+        with StubDaraja(delay=options['gateway_delay']) as stub:
+            self.stdout.write(f"Stub gateway at {stub.url}, {options['gateway_delay']:.2f}s per STK push")
+            self.stdout.write(f"{'mode':>8} {'bookings':>9} {'avg':>9} {'p95':>9} {'max':>9} {'pushes done':>12}")
+            for mode in modes:
+                with override_settings(
+                    MPESA_SIMULATE=False,
+                    MPESA_API_BASE=stub.url,
+                    MPESA_CONSUMER_KEY='load',
+                    MPESA_CONSUMER_SECRET='load',
+                    MPESA_SHORTCODE='174379',
+                    MPESA_PASSKEY='load',
+                    MPESA_PUSH_ASYNC=(mode == 'async'),
+                    MPESA_PUSH_WORKERS=options['workers'],
+                    MPESA_PUSH_RETRIES=0,
+                    ALLOWED_HOSTS=['testserver'],
+                ):
+                    self._run(mode, options['bookings'])
+
+    def _run(self, mode, count):
+        User = get_user_model()
+        users = User.objects.bulk_create([
+            User(email=f'load-{mode}-{i}@example.invalid', username=f'load-{mode}-{i}',
+                 phone_number=f'07{i:08d}', vehicle_plate=f'LOAD-{i}')
+            for i in range(count)
+        ])
+        slots = ParkingSlot.objects.bulk_create([
+            ParkingSlot(slot_id=f'LOAD-{i:04d}', slot_name=f'Load {i}', level='LOAD')
+            for i in range(count)
+        ])
+        # Simulated bookings start now, so a paid booking occupies its slot straight away
+        offset = timedelta(0) if mode == 'simulate' else timedelta(hours=1)
+        start = timezone.localtime(timezone.now() + offset).strftime('%Y-%m-%dT%H:%M')
+        try:
+            timings = []
+            started = time.perf_counter()
+            for user, slot in zip(users, slots):
+                client = Client()
+                client.force_login(user)
+                url = reverse('parking:initiate_booking', args=[slot.slot_id])
+                t0 = time.perf_counter()
+                response = client.post(url, {'start_time': start, 'duration_hours': 1})
+                timings.append((time.perf_counter() - t0) * 1000)
+                if response.status_code != 302:
+                    raise CommandError(f'Booking request failed with status {response.status_code}')
+
+            request_done = time.perf_counter()
+            get_dispatcher().drain(timeout=600)
+            drained = time.perf_counter() - request_done
+
+            bookings = Booking.objects.filter(slot__in=slots)
+            if mode == 'simulate':
+                pushed = bookings.exclude(checkout_request_id=None).count()
+            else:
+                pushed = bookings.filter(checkout_request_id__startswith='ws_CO_').count()
+            if bookings.count() != count:
+                raise CommandError(f'Expected {count} bookings, found {bookings.count()}')
+
+            timings.sort()
+            p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+            self.stdout.write(
+                f"{mode:>8} {count:>9} {statistics.mean(timings):>7.1f}ms {p95:>7.1f}ms {timings[-1]:>7.1f}ms "
+                f"{pushed:>5}/{count:<6}"
+            )
+            if mode == 'async':
+                self.stdout.write(f'        background pushes finished {drained:.2f}s after the last request')
+            if mode == 'simulate':
+                self._await_payments(bookings, slots, started, request_done)
+        finally:
+            scheduler.wait_idle(timeout=60)
+            Booking.objects.filter(slot__in=slots).delete()
+            ParkingSlot.objects.filter(pk__in=[s.pk for s in slots]).delete()
+            User.objects.filter(pk__in=[u.pk for u in users]).delete()
+
+    def _await_payments(self, bookings, slots, started, request_done, timeout=600):
+        peak_threads = threading.active_count()
+        deadline = time.perf_counter() + timeout
+        while bookings.filter(payment_status=Booking.STATUS_PENDING).exists():
+            if time.perf_counter() > deadline:
+                raise CommandError('Timed out waiting for simulated payments')
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(0.05)
+        finished = time.perf_counter()
+
+        paid = bookings.filter(payment_status=Booking.STATUS_PAID).count()
+        failed = bookings.filter(payment_status=Booking.STATUS_FAILED).count()
+        occupied = ParkingSlot.objects.filter(pk__in=[s.pk for s in slots], is_occupied=True).count()
+        total = paid + failed
+        self.stdout.write(f'        payments settled {finished - request_done:.2f}s after the last request; '
+                          f'{total / (finished - started):.1f} bookings/sec end to end')
+        self.stdout.write(f'        paid {paid}, failed {failed}, slots occupied {occupied}, peak threads {peak_threads}')
+        if occupied != paid:
+            raise CommandError(f'{paid} bookings paid but {occupied} slots occupied')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from parking import counters
+
+
+class Command(BaseCommand):
+    help = ('Recount slots per level and pricing category and repair SlotCounter rows that drifted. '
+            'Usage: manage.py reconcile_counters [--dry-run].')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted counters')
+
+    def handle(self, *args, **options):
+        drift = counters.reconcile(dry_run=options['dry_run'])
+        if not drift:
+            self.stdout.write('Counters match the slot table')
+            return
+        verb = 'Would fix' if options['dry_run'] else 'Fixed'
+        self.stdout.write(f'{verb} {len(drift)} counters:')
+        for (dimension, value), ((total, occupied), (actual_total, actual_occupied)) in sorted(drift.items()):
+            self.stdout.write(f'- {dimension}={value}: {occupied}/{total} occupied -> {actual_occupied}/{actual_total}')
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from parking import occupants
+from parking.models import ParkingSlot
+
+
+class Command(BaseCommand):
+    help = ('Re-derive slot occupancy from PAID booking intervals and update the slots whose occupant '
+            'changed. With --loop the refresh also runs at every booking start/end in between. '
+            'Usage: manage.py refresh_occupancy [--loop --interval 60] [--at 2026-01-31T18:00].')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing until interrupted')
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between full refreshes (--loop)')
+        parser.add_argument('--at', help='Only report which slots will be occupied at this moment (ISO format)')
+
+    def handle(self, *args, **options):
+        if options['at']:
+            self._preview(options['at'])
+            return
+
+        while True:
+            started = time.perf_counter()
+            changed = occupants.refresh()
+            elapsed = time.perf_counter() - started
+            if changed or not options['loop']:
+                occupied = sum(1 for booking_id in changed.values() if booking_id is not None)
+                self.stdout.write(f'{len(changed)} slots changed ({occupied} now occupied, '
+                                  f'{len(changed) - occupied} freed) in {elapsed * 1000:.1f}ms')
+            if not options['loop']:
+                return
+            # Boundaries in between are handled by the refresh scheduled on parking.scheduler
+            time.sleep(options['interval'])
+
+    def _preview(self, value):
+        moment = parse_datetime(value)
+        if moment is None:
+            raise CommandError(f'Invalid --at value: {value!r}')
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        derived = occupants.occupants_at(moment)
+        slots = ParkingSlot.objects.filter(pk__in=derived).values_list('pk', 'slot_id')
+        self.stdout.write(f'{len(derived)} slots occupied at {moment.isoformat()}')
+        for pk, slot_id in slots:
+            self.stdout.write(f'- {slot_id} (booking #{derived[pk]})')
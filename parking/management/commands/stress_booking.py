@@ -0,0 +1,101 @@
+import random
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+from parking.models import ParkingSlot, Booking
+from parking.reservations import reserve_slot
+
+
+class Command(BaseCommand):
+    help = ('Race N threads for M slots through parking.reservations.reserve_slot and verify '
+            'that no slot/time window is booked twice. '
+            'Usage: manage.py stress_booking --threads 16 --slots 8 --windows 24 --attempts 50. '
+            'Creates STRESS-* slots and stress users, and deletes them afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent booking threads')
+        parser.add_argument('--slots', type=int, default=8, help='Slots to race for')
+        parser.add_argument('--windows', type=int, default=24, help='Distinct one-hour windows per slot')
+        parser.add_argument('--attempts', type=int, default=50, help='Booking attempts per thread')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        n_threads = options['threads']
+        attempts = options['attempts']
+        User = get_user_model()
+
+        # Each attempt uses a fresh driver so the one-booking-per-driver rule
+        # does not end a thread's run after its first success.
+        users = User.objects.bulk_create([
+            User(email=f'stress-{i}@example.invalid', username=f'stress-{i}',
+                 phone_number=f'2547{i:08d}', vehicle_plate=f'STRESS-{i}')
+            for i in range(n_threads * attempts)
+        ])
+        slots = ParkingSlot.objects.bulk_create([
+            ParkingSlot(slot_id=f'STRESS-{i:03d}', slot_name=f'Stress {i}', level='STRESS')
+            for i in range(options['slots'])
+        ])
+        base = (timezone.now() + timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+        windows = [base + timedelta(hours=2 * w) for w in range(options['windows'])]
+
+        outcomes = Counter()
+        attempted = set()
+        lock = threading.Lock()
+        barrier = threading.Barrier(n_threads)
+
+        def worker(index):
+            rng = random.Random(options['seed'] + index)
+            local = Counter()
+            tried = set()
+            try:
+                barrier.wait()
+                for user in users[index * attempts:(index + 1) * attempts]:
+                    slot = rng.choice(slots)
+                    start = rng.choice(windows)
+                    tried.add((slot.pk, start))
+                    result = reserve_slot(user, slot.slot_id, start, start + timedelta(hours=1))
+                    local['booked' if result.ok else result.conflict] += 1
+            except Exception as exc:
+                local[f'error: {exc.__class__.__name__}'] += 1
+            finally:
+                connection.close()
+                with lock:
+                    outcomes.update(local)
+                    attempted.update(tried)
+
+        try:
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+
+            doubles = (Booking.objects.filter(slot__in=slots).live()
+                       .values('slot', 'start_time').annotate(n=Count('id')).filter(n__gt=1))
+            doubles = list(doubles)
+            total = sum(outcomes.values())
+            self.stdout.write(f'Attempts: {total} in {elapsed:.2f}s ({total / elapsed:.1f} attempts/sec)')
+            self.stdout.write(f"Bookings: {outcomes['booked']} ({outcomes['booked'] / elapsed:.1f} bookings/sec), "
+                              f'{len(attempted)} distinct slot windows attempted')
+            for outcome, count in sorted(outcomes.items()):
+                self.stdout.write(f'  {outcome}: {count}')
+        finally:
+            Booking.objects.filter(slot__in=slots).delete()
+            ParkingSlot.objects.filter(pk__in=[s.pk for s in slots]).delete()
+            User.objects.filter(pk__in=[u.pk for u in users]).delete()
+
+        if doubles:
+            raise CommandError(f'Double bookings detected: {doubles}')
+        if outcomes['booked'] != len(attempted):
+            raise CommandError(f"Expected {len(attempted)} bookings (one per attempted window), got {outcomes['booked']}")
+        self.stdout.write(self.style.SUCCESS('No double bookings.'))
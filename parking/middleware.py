@@ -0,0 +1,56 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+from . import occupants, querystats
+
+
+@sync_and_async_middleware
+def occupancy_middleware(get_response):
+    """Refresh materialized slot occupants when an interval boundary has passed.
+
+    The check is a clock comparison; the refresh itself only runs when due,
+    in one request at a time (see `occupants.ensure_current`).
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if occupants.refresh_due():
+                await sync_to_async(occupants.ensure_current)()
+            return await get_response(request)
+    else:
+        def middleware(request):
+            occupants.ensure_current()
+            return get_response(request)
+    return middleware
+
+
+@sync_and_async_middleware
+def query_stats_middleware(get_response):
+    """Record queries, DB time, template time and response size per view
+    (see `parking.querystats`). Enabled with QUERY_STATS=True.
+    """
+    if not getattr(settings, 'QUERY_STATS', False):
+        raise MiddlewareNotUsed
+    querystats.install()
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with querystats.RequestStats() as measured:
+                response = await get_response(request)
+            _record(request, response, measured)
+            return response
+    else:
+        def middleware(request):
+            with querystats.RequestStats() as measured:
+                response = get_response(request)
+            _record(request, response, measured)
+            return response
+    return middleware
+
+
+def _record(request, response, measured):
+    match = request.resolver_match
+    if match is not None and match.view_name:
+        size = 0 if response.streaming else len(response.content)
+        querystats.stats.record(match.view_name, measured, size)
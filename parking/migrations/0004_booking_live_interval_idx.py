@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0003_pricingrate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(condition=models.Q(('payment_status__in', ['PENDING', 'PAID'])), fields=['slot', 'start_time', 'end_time'], name='booking_live_interval_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:24
+
+from django.db import migrations, models
+
+
+def clear_duplicate_checkout_ids(apps, schema_editor):
+    """Blank ids become NULL and only the newest booking keeps a repeated id,
+    so the unique index can be built on existing data."""
+    Booking = apps.get_model('parking', 'Booking')
+    Booking.objects.filter(checkout_request_id='').update(checkout_request_id=None)
+    seen = set()
+    stale = []
+    for pk, checkout_id in (Booking.objects.exclude(checkout_request_id=None)
+                            .order_by('-pk').values_list('pk', 'checkout_request_id').iterator()):
+        if checkout_id in seen:
+            stale.append(pk)
+        seen.add(checkout_id)
+    Booking.objects.filter(pk__in=stale).update(checkout_request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0004_booking_live_interval_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_checkout_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='booking',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+    ]
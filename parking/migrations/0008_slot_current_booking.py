@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+from django.utils import timezone
+
+
+def derive_current_bookings(apps, schema_editor):
+    """Materialize the PAID booking covering now on each slot. Slots still
+    flagged occupied by a PAID booking that has since ended are freed; slots
+    without any PAID booking keep their (manual) flag."""
+    Booking = apps.get_model('parking', 'Booking')
+    ParkingSlot = apps.get_model('parking', 'ParkingSlot')
+    now = timezone.now()
+    covering = (Booking.objects.filter(payment_status='PAID', start_time__lte=now)
+                .filter(Q(end_time__gt=now) | Q(end_time__isnull=True))
+                .order_by('start_time', 'pk').values_list('slot_id', 'pk'))
+    for slot_id, booking_id in dict(covering).items():
+        ParkingSlot.objects.filter(pk=slot_id).update(current_booking_id=booking_id, is_occupied=True)
+    ended = Booking.objects.filter(payment_status='PAID', end_time__lte=now).values('slot_id')
+    ParkingSlot.objects.filter(is_occupied=True, current_booking__isnull=True, pk__in=ended).update(is_occupied=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0007_booking_status_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parkingslot',
+            name='current_booking',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='parking.booking'),
+        ),
+        migrations.RunPython(derive_current_bookings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['payment_status', 'start_time'], name='booking_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['payment_status', 'end_time'], name='booking_status_end_idx'),
+        ),
+    ]
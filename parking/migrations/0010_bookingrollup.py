@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0009_booking_ledger_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('level', models.CharField(max_length=20)),
+                ('pricing_category', models.CharField(max_length=20)),
+                ('bookings', models.PositiveIntegerField(default=0)),
+                ('paid', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('occupied_seconds', models.PositiveIntegerField(default=0)),
+                ('slot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='parking.parkingslot')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'period_start'], name='bookingrollup_period_idx')],
+                'constraints': [models.UniqueConstraint(fields=('slot', 'period', 'period_start'), name='bookingrollup_slot_period_uniq')],
+            },
+        ),
+    ]
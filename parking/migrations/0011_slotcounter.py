@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:04
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_slots(apps, schema_editor):
+    ParkingSlot = apps.get_model('parking', 'ParkingSlot')
+    SlotCounter = apps.get_model('parking', 'SlotCounter')
+    for dimension in ('level', 'pricing_category'):
+        rows = (ParkingSlot.objects.order_by().values(dimension)
+                .annotate(total=Count('pk'), occupied=Count('pk', filter=Q(is_occupied=True))))
+        SlotCounter.objects.bulk_create([
+            SlotCounter(dimension=dimension, value=row[dimension], total=row['total'], occupied=row['occupied'])
+            for row in rows
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0010_bookingrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('level', 'Level'), ('pricing_category', 'Pricing category')], max_length=20)),
+                ('value', models.CharField(max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('occupied', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['dimension', 'value'],
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'value'), name='slotcounter_dimension_value_uniq')],
+            },
+        ),
+        migrations.RunPython(count_slots, migrations.RunPython.noop),
+    ]
@@ -4,16 +4,179 @@ parking.models
 Core data models for the CarParking application:
 - ParkingSlot: represents an individual parking space
 - Booking: records user reservations and payment state
+- SlotCounter: slot totals per level and pricing category (parking.counters)
 
 This module contains lightweight domain logic (fee calculation and slot occupation
-updates) so that views and payment callbacks can rely on model behaviour.
+updates) so that views and payment callbacks can rely on model behaviour. Slot
+occupancy itself is derived from PAID booking intervals in parking.occupants.
 """
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.utils import timezone
+from datetime import timedelta
 from decimal import Decimal
 
+from . import counters, driverstate, layout, occupancy, occupants, rollups
+from .versioning import VersionStamp
+
+
+def _slot_states(slots):
+    """{pk: (level, pricing_category, is_occupied)} for a slot queryset."""
+    return {pk: tuple(state) for pk, *state in slots.order_by().values_list('pk', *counters.TRACKED_FIELDS)}
+
+
+def _relabel_rollups(before, after):
+    """Copy new levels and pricing categories onto the slots' rollup rows.
+
+    `before`/`after` are `_slot_states()` of the written slots; only slots
+    whose level or category changed are touched (rollups refer to slots by
+    pk, so a new slot_id needs nothing).
+    """
+    moved = {}
+    for pk, (level, category, _) in after.items():
+        if pk in before and before[pk][:2] != (level, category):
+            moved.setdefault((level, category), []).append(pk)
+    for (level, category), pks in moved.items():
+        BookingRollup.objects.filter(slot_id__in=pks).update(level=level, pricing_category=category)
+
+
+class ParkingSlotQuerySet(models.QuerySet):
+    # update(), delete() and bulk_create() keep parking.counters exact: the
+    # touched slots are locked and their counter deltas applied in the same
+    # transaction as the write. They also invalidate the cached bay layout
+    # (parking.layout) when the inventory changes.
+
+    def update(self, **kwargs):
+        relabel = bool(layout.LAYOUT_FIELDS & kwargs.keys())
+        tracked = bool(set(counters.TRACKED_FIELDS) & kwargs.keys())
+        if not relabel and not tracked:
+            return super().update(**kwargs)
+        with transaction.atomic():
+            before = _slot_states(self.select_for_update(of=('self',))) if tracked else {}
+            rows = super().update(**kwargs)
+            if before:
+                after = _slot_states(ParkingSlot.objects.filter(pk__in=list(before)))
+                counters.apply(counters.deltas(before.values(), after.values()))
+                # bulk_update() ends up here too
+                _relabel_rollups(before, after)
+            if relabel:
+                # After the write and inside the transaction, so the layout
+                # version moves on commit (see VersionStamp.changed)
+                layout.inventory_changed()
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic():
+            before = _slot_states(self.select_for_update(of=('self',)))
+            result = super().delete()
+            counters.apply(counters.deltas(before.values()))
+        layout.inventory_changed()
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+            # Which rows were inserted is unknown; recount instead
+            objs = super().bulk_create(objs, *args, **kwargs)
+            counters.reconcile()
+        else:
+            with transaction.atomic():
+                objs = super().bulk_create(objs, *args, **kwargs)
+                counters.apply(counters.deltas(after=[(s.level, s.pricing_category, s.is_occupied) for s in objs]))
+        layout.inventory_changed()
+        return objs
+
+    def with_vehicle_types(self):
+        """Annotate each slot with `occupant_vehicle_type`: the vehicle type of the
+        user on the booking currently occupying it, for occupied slots (None
+        otherwise).
+
+        Slots marked occupied by hand have no current booking; for those the
+        latest PAID booking is used. Either way this stays a single query.
+        """
+        latest_paid = Booking.objects.filter(
+            slot=models.OuterRef('pk'),
+            payment_status=Booking.STATUS_PAID,
+        ).order_by('-created_at').values('user__vehicle_type')[:1]
+        return self.annotate(occupant_vehicle_type=models.Case(
+            models.When(is_occupied=True, current_booking__isnull=False,
+                        then=models.F('current_booking__user__vehicle_type')),
+            models.When(is_occupied=True, then=models.Subquery(latest_paid)),
+            default=models.Value(None),
+            output_field=models.CharField(),
+        ))
+
+
+class _LiteralIn(models.Expression):
+    """`<expression> IN ('a', 'b')` with the values inlined as SQL literals.
+
+    The column comes from the compiler, so the condition follows whatever
+    alias the table gets (e.g. `U0` inside a subquery).
+    """
+    conditional = True
+    output_field = models.BooleanField()
+
+    def __init__(self, expression, values):
+        super().__init__()
+        self.expression = expression
+        self.values = tuple(values)
+
+    def get_source_expressions(self):
+        return [self.expression]
+
+    def set_source_expressions(self, exprs):
+        (self.expression,) = exprs
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.expression)
+        literals = ', '.join("'%s'" % value.replace("'", "''") for value in self.values)
+        return f'{sql} IN ({literals})', params
+
+
+class BookingQuerySet(models.QuerySet):
+    def live(self):
+        """Bookings that still hold their slot (PENDING or PAID).
+
+        The statuses are inlined as literals rather than bound parameters:
+        SQLite only uses a partial index when the query repeats the index
+        condition verbatim, which a `?` placeholder never does.
+        """
+        return self.filter(_LiteralIn(models.F('payment_status'), Booking.LIVE_STATUSES))
+
+    def overlapping(self, slot, start_time, end_time):
+        """Live bookings on `slot` whose interval overlaps [start_time, end_time).
+
+        Bookings last at most `Booking.MAX_DURATION`, so anything overlapping
+        must also start after `start_time - MAX_DURATION`. That lower bound turns
+        the check into a short range scan on the partial
+        `booking_live_interval_idx` index instead of a walk over the slot's whole
+        booking history. Open-ended bookings (no end_time) are matched separately.
+        """
+        # `slot` is repeated inside each branch so the planner can run each
+        # branch as its own index range scan.
+        return self.live().filter(
+            models.Q(slot=slot, start_time__gt=start_time - Booking.MAX_DURATION,
+                     start_time__lt=end_time, end_time__gt=start_time)
+            | models.Q(slot=slot, start_time__lt=end_time, end_time__isnull=True)
+        )
+
+    def stale_pending(self, now=None):
+        """PENDING bookings older than `Booking.PENDING_HOLD` (abandoned payments).
+
+        Runs as a range scan on `booking_status_created_idx`.
+        """
+        now = now or timezone.now()
+        return self.filter(payment_status=Booking.STATUS_PENDING, created_at__lt=now - Booking.PENDING_HOLD)
+
+
 class ParkingSlot(models.Model):
     PRICE_CHOICES = (
         ("Regular", "Regular"),
@@ -26,10 +189,46 @@ class ParkingSlot(models.Model):
     level = models.CharField(max_length=20)
     pricing_category = models.CharField(max_length=20, choices=PRICE_CHOICES, default="Regular")
     is_occupied = models.BooleanField(default=False)
+    # PAID booking covering the current moment, maintained by parking.occupants
+    current_booking = models.ForeignKey('Booking', on_delete=models.SET_NULL, null=True, blank=True,
+                                        related_name='+', editable=False)
+
+    objects = ParkingSlotQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.slot_name} ({self.slot_id})"
 
+    def save(self, *args, **kwargs):
+        # current_booking belongs to parking.occupants; never write back a value
+        # that may have gone stale since this instance was loaded.
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != 'current_booking']
+        adding = self._state.adding
+        with transaction.atomic():
+            if adding:
+                before = {}
+                super().save(*args, **kwargs)
+                after = {self.pk: (self.level, self.pricing_category, self.is_occupied)}
+            else:
+                before = _slot_states(ParkingSlot.objects.filter(pk=self.pk).select_for_update())
+                super().save(*args, **kwargs)
+                after = _slot_states(ParkingSlot.objects.filter(pk=self.pk))
+            counters.apply(counters.deltas(before.values(), after.values()))
+            # Rollups are grouped by the slot's current level and category
+            _relabel_rollups(before, after)
+        occupancy.mark_changed()
+        layout.inventory_changed()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            before = _slot_states(ParkingSlot.objects.filter(pk=self.pk).select_for_update())
+            result = super().delete(*args, **kwargs)
+            counters.apply(counters.deltas(before.values()))
+        occupancy.mark_changed()
+        layout.inventory_changed()
+        return result
+
     class Meta:
         ordering = ["slot_id"]
 
@@ -44,6 +243,12 @@ class Booking(models.Model):
         (STATUS_PAID, "Paid"),
         (STATUS_FAILED, "Failed"),
     ]
+    # Statuses that hold a slot for their time range (used for overlap checks)
+    LIVE_STATUSES = (STATUS_PENDING, STATUS_PAID)
+    # Longest reservation drivers can make (matches BookingForm.duration_hours)
+    MAX_DURATION = timedelta(hours=24)
+    # How long an unpaid PENDING booking blocks its driver from booking again
+    PENDING_HOLD = timedelta(minutes=15)
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     slot = models.ForeignKey(ParkingSlot, on_delete=models.CASCADE)
@@ -52,12 +257,50 @@ class Booking(models.Model):
     total_fee = models.DecimalField(max_digits=8, decimal_places=2, default=0)
     payment_status = models.CharField(max_length=20, choices=PAYMENT_STATUS_CHOICES, default=STATUS_PENDING)
     mpesa_receipt_no = models.CharField(max_length=50, blank=True, null=True)
-    checkout_request_id = models.CharField(max_length=50, blank=True, null=True)
+    # Daraja CheckoutRequestID; callbacks are matched to bookings through this index
+    checkout_request_id = models.CharField(max_length=50, blank=True, null=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = BookingQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Interval index for overlap checks; only bookings that can still
+            # block a slot are indexed (see BookingQuerySet.overlapping).
+            models.Index(
+                fields=['slot', 'start_time', 'end_time'],
+                name='booking_live_interval_idx',
+                condition=models.Q(payment_status__in=['PENDING', 'PAID']),
+            ),
+            # Pending-hold checks and the expiry sweep (BookingQuerySet.stale_pending)
+            models.Index(fields=['payment_status', 'created_at'], name='booking_status_created_idx'),
+            # Occupancy derivation: PAID bookings covering a moment, and the
+            # next start/end boundary (parking.occupants)
+            models.Index(fields=['payment_status', 'start_time'], name='booking_status_start_idx'),
+            models.Index(fields=['payment_status', 'end_time'], name='booking_status_end_idx'),
+            # Admin ledger pages, newest first, optionally per slot (parking.ledger);
+            # the status filter uses booking_status_created_idx
+            models.Index(fields=['created_at', 'id'], name='booking_created_idx'),
+            models.Index(fields=['slot', 'created_at', 'id'], name='booking_slot_created_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember whether this booking occupied its slot when loaded, so save()
+        # can tell when a PAID booking stops being PAID, and where it counted
+        # in the rollups, so a moved booking refreshes both its old and new days
+        instance._loaded_status = instance.__dict__.get('payment_status')
+        instance._loaded_rollup_key = instance._rollup_key()
+        return instance
+
     def __str__(self):
         return f"Booking #{self.id} - {self.user.email} ({self.payment_status})"
 
+    def clean(self):
+        if self.end_time and self.start_time and self.end_time - self.start_time > self.MAX_DURATION:
+            raise ValidationError(f"Bookings cannot be longer than {self.MAX_DURATION}.")
+
     def calculate_fee(self):
         if not self.end_time:
             return 0
@@ -78,12 +321,53 @@ class Booking(models.Model):
         # Persist booking first so we have an ID for payment tracking
         super().save(*args, **kwargs)
 
-        # Post-save side-effect: when a booking is marked PAID we make the
-        # associated slot occupied. We intentionally do NOT mark the slot
-        # occupied for PENDING or FAILED payments to avoid accidental holds.
-        if self.payment_status == self.STATUS_PAID:
-            self.slot.is_occupied = True
-            self.slot.save()
+        # Post-save side-effect: re-derive the slot's occupant whenever a PAID
+        # booking changes (paid, moved, ended early or no longer paid). PENDING
+        # and FAILED bookings never occupy a slot.
+        if self.STATUS_PAID in (self.payment_status, getattr(self, '_loaded_status', None)):
+            self._refresh_slot()
+        self._loaded_status = self.payment_status
+
+        loaded_key = getattr(self, '_loaded_rollup_key', None)
+        self._loaded_rollup_key = self._rollup_key()
+        rollups.mark(rollups.booking_days(*self._loaded_rollup_key)
+                     | (rollups.booking_days(*loaded_key) if loaded_key else set()))
+        driverstate.invalidate([self.user_id])
+
+    def delete(self, *args, **kwargs):
+        slot_id = self.slot_id
+        # _free_occupied_slot() frees the slot if this booking occupies it; the
+        # refresh below picks up any other booking that covers the slot right now.
+        result = super().delete(*args, **kwargs)
+        # The slot's latest PAID booking (and so its occupant's vehicle type) may have changed
+        occupants.refresh_slots([slot_id])
+        occupancy.mark_changed()
+        rollups.mark(rollups.booking_days(*self._rollup_key()))
+        driverstate.invalidate([self.user_id])
+        return result
+
+    def _rollup_key(self):
+        fields = self.__dict__
+        return (fields.get('slot_id'), fields.get('created_at'), fields.get('start_time'), fields.get('end_time'))
+
+    def _refresh_slot(self):
+        changed = occupants.refresh_slots([self.slot_id])
+        # Keep an already loaded slot instance in step with the database
+        if self.slot_id in changed and Booking.slot.is_cached(self):
+            self.slot.current_booking_id = changed[self.slot_id]
+            self.slot.is_occupied = changed[self.slot_id] is not None
+
+
+@receiver(pre_delete, sender=Booking)
+def _free_occupied_slot(sender, instance, **kwargs):
+    """Clear `is_occupied` on the slot a deleted booking occupies.
+
+    SET_NULL clears `current_booking` on every delete path, so the flag is
+    cleared here rather than in `Booking.delete()`: queryset deletes (the
+    admin) and cascades (deleting a user) free the slot too.
+    """
+    if ParkingSlot.objects.filter(pk=instance.slot_id, current_booking=instance, is_occupied=True).update(is_occupied=False):
+        occupancy.mark_changed()
 
 
 class Subscription(models.Model):
@@ -96,6 +380,86 @@ class Subscription(models.Model):
         return f"Subscription {self.email}"
 
 
+class PaymentCallback(models.Model):
+    """Raw M-Pesa callback bodies. The webhook only appends rows here;
+    parkingpayments.inbox.drain() applies them to bookings in batches."""
+    OUTCOME_APPLIED = "applied"
+    OUTCOME_DUPLICATE = "duplicate"
+    OUTCOME_NOT_FOUND = "not_found"
+    OUTCOME_INVALID = "invalid"
+
+    payload = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    outcome = models.CharField(max_length=20, blank=True, default="")
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [
+            # The drain only ever scans callbacks that have not been applied yet
+            models.Index(fields=['id'], name='paymentcallback_pending_idx',
+                         condition=models.Q(processed_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f"Callback #{self.id} ({self.outcome or 'pending'})"
+
+
+class SlotCounter(models.Model):
+    """Number of slots, and of occupied slots, with one level or pricing
+    category. Maintained by the ParkingSlot write paths; see parking.counters."""
+    DIMENSION_CHOICES = [(counters.LEVEL, "Level"), (counters.CATEGORY, "Pricing category")]
+
+    dimension = models.CharField(max_length=20, choices=DIMENSION_CHOICES)
+    value = models.CharField(max_length=20)
+    # Plain integers, so drift shows up for reconcile() instead of failing writes
+    total = models.IntegerField(default=0)
+    occupied = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['dimension', 'value']
+        constraints = [
+            models.UniqueConstraint(fields=['dimension', 'value'], name='slotcounter_dimension_value_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.dimension}={self.value}: {self.occupied}/{self.total}"
+
+
+class BookingRollup(models.Model):
+    """Booking statistics per slot and hour or (local) day, maintained by
+    parking.rollups. Level and pricing category are copied from the slot so
+    reports can group by them without joins."""
+    PERIOD_HOUR = "hour"
+    PERIOD_DAY = "day"
+    PERIOD_CHOICES = [(PERIOD_HOUR, "Hour"), (PERIOD_DAY, "Day")]
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    period_start = models.DateTimeField()
+    slot = models.ForeignKey(ParkingSlot, on_delete=models.CASCADE, related_name='+')
+    level = models.CharField(max_length=20)
+    pricing_category = models.CharField(max_length=20)
+    # Bookings created in the period
+    bookings = models.PositiveIntegerField(default=0)
+    paid = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # Seconds of the period during which PAID bookings covered the slot
+    occupied_seconds = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['slot', 'period', 'period_start'], name='bookingrollup_slot_period_uniq'),
+        ]
+        indexes = [
+            # Reports read one period type over a date range
+            models.Index(fields=['period', 'period_start'], name='bookingrollup_period_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.slot_id} {self.period} {self.period_start:%Y-%m-%d %H:%M}"
+
+
 class PricingRate(models.Model):
     """Global pricing per category. Administrators can update these rates.
     This allows dynamic pricing without changing code.
@@ -111,11 +475,39 @@ class PricingRate(models.Model):
     def __str__(self):
         return f"{self.category} - KES {self.rate}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        _rates_version.changed()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        _rates_version.changed()
+        return result
+
+    @classmethod
+    def cached_rates(cls):
+        """Return {category: rate} from an in-process copy of the rate table.
+
+        The copy is reloaded (one query) only after a rate was saved or deleted,
+        here or in another worker, so fee calculation normally costs no queries.
+        """
+        global _rates_cache
+        version = _rates_version.current()
+        cached_version, rates = _rates_cache
+        if cached_version != version:
+            rates = {pr.category: float(pr.rate) for pr in cls.objects.all()}
+            _rates_cache = (version, rates)
+        return rates
+
     @classmethod
     def get_rate_for_category(cls, category):
         try:
-            pr = cls.objects.get(category=category)
-            return float(pr.rate)
+            return cls.cached_rates()[category]
         except Exception:
             # Fallback to legacy hardcoded mapping
             return 50.0 if category == 'Regular' else 100.0 if category == 'Premium' else 150.0
+
+
+# In-process copy of the PricingRate table: (version stamp, {category: rate})
+_rates_version = VersionStamp('parking:pricing:version')
+_rates_cache = (None, {})
@@ -0,0 +1,198 @@
+"""
+parking.occupancy
+-------------------
+Process-wide slot occupancy snapshot used by the live dashboard endpoints.
+
+Every open driver dashboard polls ``slot_statuses_api``. Rather than scanning and
+serializing the ``ParkingSlot`` table on each poll, this module keeps one
+pre-serialized snapshot per process and rebuilds it only after a slot or booking
+changed. Writers call ``mark_changed()`` (``ParkingSlot.save``/``Booking.save`` do
+so automatically); readers call ``get_snapshot()``, which costs a single cache
+lookup while nothing has changed.
+
+Each rebuild is diffed against the previous snapshot and the changed slot ids are
+kept in a short change log, so pollers that already hold version N can be sent
+just the slots that changed since then (``Snapshot.delta_since``). Versions come
+from a shared stamp, but change logs are per process: the ``epoch`` identifies
+the process a version was observed in, and a mismatched epoch always gets the
+full snapshot.
+
+Payloads and deltas can also be restricted to a set of slots (one level of the
+bay layout, see ``parking.layout``); those are memoized per snapshot too.
+"""
+
+import json
+import threading
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+
+from django.db import connection, transaction
+
+from .live import broker
+from .versioning import VersionStamp
+
+_stamp = VersionStamp('parking:occupancy:version')
+
+# Number of rebuilds remembered for delta responses; older clients get a full snapshot.
+CHANGE_LOG_SIZE = 256
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    version: int
+    epoch: str
+    slots: tuple
+    payload: bytes
+    # (version, changed slot ids, removed slot ids) for rebuilds after `floor`
+    changes: tuple = ()
+    floor: int = 0
+    _deltas: dict = field(default_factory=dict, compare=False, repr=False)
+    _by_id: dict = field(default_factory=dict, compare=False, repr=False)
+    _subsets: dict = field(default_factory=dict, compare=False, repr=False)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def slot(self, slot_id):
+        """The entry for `slot_id` ({'slot_id', 'is_occupied', 'vehicle_type'}), or None."""
+        if not self._by_id and self.slots:
+            self._by_id.update((s['slot_id'], s) for s in self.slots)
+        return self._by_id.get(slot_id)
+
+    def payload_for(self, slot_ids=None):
+        """Pre-serialized JSON like `payload`, with only the slots in `slot_ids`
+        (a frozenset; None for all of them)."""
+        if slot_ids is None:
+            return self.payload
+        cached = self._subsets.get(slot_ids)
+        if cached is None:
+            cached = json.dumps({
+                'version': self.version,
+                'epoch': self.epoch,
+                'slots': [s for s in self.slots if s['slot_id'] in slot_ids],
+            }).encode('utf-8')
+            self._subsets[slot_ids] = cached
+        return cached
+
+    def delta_since(self, since, slot_ids=None):
+        """Return pre-serialized JSON with the slots changed after `since`, or
+        None when this process cannot answer (unknown or too old a version).
+        With `slot_ids` (a frozenset), only changes to those slots are listed."""
+        if since == self.version:
+            return None
+        if since < self.floor or since > self.version:
+            return None
+        cached = self._deltas.get((since, slot_ids))
+        if cached is not None:
+            return cached
+
+        changed, removed = set(), set()
+        for version, ids, gone in self.changes:
+            if version > since:
+                changed |= ids
+                removed |= gone
+        if slot_ids is not None:
+            changed &= slot_ids
+            removed &= slot_ids
+        slots = [s for s in self.slots if s['slot_id'] in changed]
+        removed -= {s['slot_id'] for s in slots}
+        payload = json.dumps({
+            'version': self.version,
+            'epoch': self.epoch,
+            'delta': True,
+            'slots': slots,
+            'removed': sorted(removed),
+        }).encode('utf-8')
+        self._deltas[since, slot_ids] = payload
+        return payload
+
+
+class OccupancySnapshot:
+    """Lazily rebuilt, immutable view of every slot's occupancy."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+        self.epoch = uuid.uuid4().hex[:12]
+
+    def get(self) -> Snapshot:
+        version = _stamp.current()
+        current = self._current
+        if current is not None and current.version == version:
+            return current
+        # Only one thread rebuilds; others keep serving the previous snapshot
+        # (if there is one) instead of queueing up behind the query.
+        if not self._lock.acquire(blocking=current is None):
+            return current
+        try:
+            current = self._current
+            if current is None or current.version != version:
+                current = self._build(version, current)
+                self._current = current
+            return current
+        finally:
+            self._lock.release()
+
+    def _build(self, version, previous) -> Snapshot:
+        from .models import ParkingSlot
+
+        slots = tuple(
+            {
+                'slot_id': s.slot_id,
+                'is_occupied': bool(s.is_occupied),
+                'vehicle_type': s.occupant_vehicle_type,
+            }
+            for s in ParkingSlot.objects.with_vehicle_types().order_by('level', 'slot_id')
+        )
+        payload = json.dumps({
+            'version': version,
+            'epoch': self.epoch,
+            'slots': slots,
+        }).encode('utf-8')
+
+        if previous is None:
+            return Snapshot(version=version, epoch=self.epoch, slots=slots,
+                            payload=payload, floor=version)
+
+        before = {s['slot_id']: s for s in previous.slots}
+        changed = frozenset(s['slot_id'] for s in slots if before.get(s['slot_id']) != s)
+        removed = frozenset(before.keys() - {s['slot_id'] for s in slots})
+        changes = deque(previous.changes, maxlen=CHANGE_LOG_SIZE)
+        floor = previous.floor
+        if len(changes) == CHANGE_LOG_SIZE:
+            # The oldest entry is about to fall off; clients at or before it need a full snapshot.
+            floor = changes[0][0]
+        changes.append((version, changed, removed))
+        return Snapshot(version=version, epoch=self.epoch, slots=slots, payload=payload,
+                        changes=tuple(changes), floor=floor)
+
+    def clear(self):
+        self._current = None
+
+
+snapshot = OccupancySnapshot()
+
+
+def get_snapshot() -> Snapshot:
+    return snapshot.get()
+
+
+def _bump():
+    _stamp.bump()
+    broker.publish()
+
+
+def mark_changed():
+    """Signal that slot occupancy may have changed.
+
+    Inside a transaction the stamp is bumped once it commits, as with
+    `VersionStamp.changed()`, so nothing is rebuilt and served from a change
+    that may still be rolled back. The bump also wakes the live occupancy
+    stream (`parking.live`).
+    """
+    if connection.in_atomic_block:
+        transaction.on_commit(_bump)
+    else:
+        _bump()
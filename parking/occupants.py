@@ -0,0 +1,204 @@
+"""
+parking.occupants
+-------------------
+Time-based slot occupancy.
+
+A slot is occupied while a PAID booking covers the current moment
+(start_time <= now < end_time; a booking without end_time is open-ended).
+`occupants_at(moment)` derives that for any moment, past or future, from
+booking intervals alone.
+
+So that dashboards can keep reading one row per slot, the current occupant is
+materialized on `ParkingSlot.current_booking`, together with the
+`is_occupied` flag. `refresh()` re-derives the occupants and writes only the
+slots whose occupant changed. It runs:
+
+- for a single slot whenever one of its PAID bookings is saved or deleted
+  (`Booking.save`/`Booking.delete`);
+- for every slot at the next interval boundary (a PAID booking starting or
+  ending), using the shared `parking.scheduler`;
+- whenever `ensure_current()` notices that the boundary has passed or the last
+  full refresh is older than OCCUPANCY_REFRESH_INTERVAL seconds (default
+  60). This covers boundaries created by other processes.
+  `parking.middleware.occupancy_middleware` calls it on each request, and
+  `manage.py refresh_occupancy` runs a refresh on demand. Only one request
+  per process runs a due refresh; concurrent ones skip it instead of all
+  scanning the slots at once.
+
+Full refreshes are edge-triggered. `is_occupied` only changes when a slot's
+derived occupant changes, so a manual override by an administrator
+(`hold()`/`release()`, the slot admin) stays in place until that slot's next
+interval boundary or booking change. Refreshing given slots (after their
+bookings changed) also frees those flagged occupied with no occupant, since
+the flag may have belonged to a booking that no longer exists.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from . import occupancy
+from .scheduler import scheduler
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+_lock = threading.Lock()
+# Held by the request running a due refresh (see ensure_current)
+_refresh_lock = threading.Lock()
+# Next known interval boundary, the job scheduled for it, and when the last
+# full refresh ran (monotonic seconds)
+_next_boundary = None
+_next_job = None
+_last_full_refresh = None
+
+
+def covering(moment):
+    """PAID bookings in effect at `moment`.
+
+    Bookings last at most `Booking.MAX_DURATION`, so bounded bookings are found
+    with a range scan on (payment_status, start_time); open-ended bookings come
+    from (payment_status, end_time).
+    """
+    from .models import Booking
+    paid = Booking.objects.filter(payment_status=Booking.STATUS_PAID)
+    return paid.filter(
+        Q(start_time__gt=moment - Booking.MAX_DURATION, start_time__lte=moment, end_time__gt=moment)
+        | Q(end_time__isnull=True, start_time__lte=moment)
+    )
+
+
+def occupants_at(moment=None, slot_ids=None):
+    """Return {slot pk: booking pk} for slots occupied at `moment` (default now).
+
+    When bookings overlap, the one that started last wins.
+    """
+    moment = moment or timezone.now()
+    bookings = covering(moment)
+    if slot_ids is not None:
+        bookings = bookings.filter(slot_id__in=slot_ids)
+    return dict(bookings.order_by('start_time', 'pk').values_list('slot_id', 'pk'))
+
+
+def next_boundary(after):
+    """The first start or end of a PAID booking after `after`, or None."""
+    from .models import Booking
+    paid = Booking.objects.filter(payment_status=Booking.STATUS_PAID)
+    start = paid.filter(start_time__gt=after).order_by('start_time').values_list('start_time', flat=True).first()
+    end = paid.filter(end_time__gt=after).order_by('end_time').values_list('end_time', flat=True).first()
+    candidates = [t for t in (start, end) if t is not None]
+    return min(candidates) if candidates else None
+
+
+def refresh(slot_ids=None, now=None):
+    """Bring materialized occupants up to date. Returns {slot pk: booking pk or None} for changed slots."""
+    from .models import ParkingSlot
+    now = now or timezone.now()
+    derived = occupants_at(now, slot_ids)
+    slots = ParkingSlot.objects.all()
+    if slot_ids is not None:
+        slots = slots.filter(pk__in=slot_ids)
+
+    changed = []
+    for pk, current, occupied in slots.values_list('pk', 'current_booking_id', 'is_occupied'):
+        occupant = derived.get(pk)
+        # Refreshing given slots also frees ones flagged occupied with no
+        # occupant (see the module docstring)
+        if occupant != current or (slot_ids is not None and occupied and occupant is None):
+            changed.append(ParkingSlot(pk=pk, current_booking_id=occupant, is_occupied=occupant is not None))
+    if changed:
+        ParkingSlot.objects.bulk_update(changed, ['current_booking', 'is_occupied'])
+        occupancy.mark_changed()
+
+    if slot_ids is None:
+        global _last_full_refresh
+        _last_full_refresh = time.monotonic()
+        _schedule(next_boundary(now), replace=True)
+    else:
+        boundary = next_boundary(now)
+        if boundary is not None:
+            _schedule(boundary)
+    return {slot.pk: slot.current_booking_id for slot in changed}
+
+
+def refresh_slots(slot_ids):
+    return refresh(slot_ids=list(slot_ids))
+
+
+def refresh_due():
+    """True if an interval boundary has passed or the last full refresh is stale.
+
+    Only compares clocks; no queries.
+    """
+    interval = getattr(settings, 'OCCUPANCY_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL)
+    return (_last_full_refresh is None
+            or time.monotonic() - _last_full_refresh >= interval
+            or (_next_boundary is not None and timezone.now() >= _next_boundary))
+
+
+def ensure_current():
+    """Run a full refresh if one is due (see refresh_due).
+
+    The refresh is claimed without waiting: while one caller runs it, others
+    return at once and keep serving the current occupants.
+    """
+    if not refresh_due() or not _refresh_lock.acquire(blocking=False):
+        return
+    try:
+        # Another caller may have finished the refresh since the check
+        if refresh_due():
+            refresh()
+    finally:
+        _refresh_lock.release()
+
+
+def hold(slot_ids):
+    """Mark slots occupied by hand (no booking) until their next interval boundary."""
+    _set_flag(slot_ids, True)
+
+
+def release(slot_ids):
+    """Mark slots free by hand until their next interval boundary."""
+    _set_flag(slot_ids, False)
+
+
+def _set_flag(slot_ids, occupied):
+    from .models import ParkingSlot
+    if ParkingSlot.objects.filter(pk__in=list(slot_ids)).exclude(is_occupied=occupied).update(is_occupied=occupied):
+        occupancy.mark_changed()
+
+
+def _schedule(boundary, replace=False):
+    """Arrange a full refresh at `boundary` unless an earlier one is already due."""
+    global _next_boundary, _next_job
+    with _lock:
+        if not replace and _next_boundary is not None and boundary >= _next_boundary:
+            return
+        if _next_job is not None:
+            _next_job.cancel()
+            _next_job = None
+        _next_boundary = boundary
+        if boundary is None:
+            return
+        # A little slack so the boundary has certainly passed when the job runs
+        delay = (boundary - timezone.now()).total_seconds() + 0.05
+        _next_job = scheduler.schedule_background(delay, _scheduled_refresh)
+
+
+def _scheduled_refresh():
+    global _next_job
+    with _lock:
+        _next_job = None
+    refresh()
+
+
+def reset():
+    """Forget scheduling state (tests)."""
+    global _next_boundary, _next_job, _last_full_refresh
+    with _lock:
+        if _next_job is not None:
+            _next_job.cancel()
+        _next_boundary = _next_job = _last_full_refresh = None
+
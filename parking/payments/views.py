@@ -4,7 +4,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 import json
 
-from ..models import Booking, ParkingSlot
+from ..models import Booking
 
 @login_required
 def payment_pending_view(request, booking_id):
@@ -52,10 +52,8 @@ def mpesa_callback(request):
         if success:
             booking.payment_status = Booking.STATUS_PAID
             booking.mpesa_receipt_no = receipt or f"MPESA-{booking_id}"
+            # Saving a PAID booking occupies the slot for the booked interval
             booking.save()
-            slot = booking.slot
-            slot.is_occupied = True
-            slot.save()
             return JsonResponse({'ok': True})
 
         # Non-success
@@ -0,0 +1,223 @@
+"""
+parking.querystats
+--------------------
+Per-view query budgets.
+
+`parking.middleware.query_stats_middleware` (enabled with QUERY_STATS=True)
+measures every request it serves:
+- the number of SQL queries and the time spent in them;
+- the time spent rendering templates (queries run from templates count
+  towards both);
+- the response size.
+
+The measurements are aggregated per URL name in the process-wide `stats`
+collector. Staff can read them from `/parking/api/query_stats/`, and every
+QUERY_STATS_LOG_INTERVAL seconds (default 300) one summary line is logged to
+the `parking.querystats` logger.
+
+The current request's measurements live in a context variable, which
+`sync_to_async` carries into the thread running a sync view under ASGI, so
+WSGI and ASGI deployments are measured alike. Queries from other threads (the
+scheduler, background drains) are not attributed to any view. For streaming
+responses only the work done before streaming starts is measured.
+
+QUERY_BUDGETS maps view names to limits:
+
+    QUERY_BUDGETS = {
+        'parking:driver_slots': 10,                      # queries
+        'parking:admin_activities': {'queries': 12, 'db_ms': 250},
+    }
+
+Supported limits are `queries`, `db_ms`, `template_ms` and `bytes`. A request
+over budget is logged as a warning; with QUERY_BUDGET_STRICT=True it raises
+QueryBudgetExceeded instead, so a regression fails the test that caused it.
+"""
+
+import contextvars
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.base import Template
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_INTERVAL = 300
+BUDGET_LIMITS = ('queries', 'db_ms', 'template_ms', 'bytes')
+
+# Measurements for the request being served in this context, if any
+_current = contextvars.ContextVar('querystats_current', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestStats:
+    """Measurements for one request."""
+    __slots__ = ('queries', 'db_time', 'template_time', 'render_depth', '_token')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.render_depth = 0
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+
+
+class ViewStats:
+    __slots__ = ('requests', 'queries', 'max_queries', 'db_time', 'template_time', 'bytes', 'over_budget')
+
+    def __init__(self):
+        self.requests = self.queries = self.max_queries = self.bytes = self.over_budget = 0
+        self.db_time = self.template_time = 0.0
+
+    def add(self, measured, size, over_budget):
+        self.requests += 1
+        self.queries += measured.queries
+        self.max_queries = max(self.max_queries, measured.queries)
+        self.db_time += measured.db_time
+        self.template_time += measured.template_time
+        self.bytes += size
+        self.over_budget += over_budget
+
+    def as_dict(self):
+        n = self.requests or 1
+        return {
+            'requests': self.requests,
+            'avg_queries': round(self.queries / n, 2),
+            'max_queries': self.max_queries,
+            'avg_db_ms': round(self.db_time * 1000 / n, 2),
+            'avg_template_ms': round(self.template_time * 1000 / n, 2),
+            'avg_bytes': round(self.bytes / n),
+            'over_budget': self.over_budget,
+        }
+
+
+class Collector:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+            self.since = timezone.now()
+            self._last_log = time.monotonic()
+
+    def record(self, view_name, measured, size):
+        """Add one request's measurements. Raises QueryBudgetExceeded in strict mode."""
+        violations = check_budget(view_name, measured, size)
+        with self._lock:
+            self._views.setdefault(view_name, ViewStats()).add(measured, size, bool(violations))
+            interval = getattr(settings, 'QUERY_STATS_LOG_INTERVAL', DEFAULT_LOG_INTERVAL)
+            log_due = time.monotonic() - self._last_log >= interval
+            if log_due:
+                self._last_log = time.monotonic()
+        if log_due:
+            self.log_summary()
+        if violations:
+            message = f"{view_name} over budget: {', '.join(violations)}"
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+    def snapshot(self):
+        """{view name: averaged stats}, busiest views first."""
+        with self._lock:
+            views = sorted(self._views.items(), key=lambda item: item[1].db_time, reverse=True)
+            return {name: view.as_dict() for name, view in views}
+
+    def log_summary(self, limit=5):
+        views = list(self.snapshot().items())[:limit]
+        if views:
+            logger.info('query stats since %s: %s', self.since.isoformat(timespec='seconds'), '; '.join(
+                f"{name} n={s['requests']} q={s['avg_queries']}/{s['max_queries']} db={s['avg_db_ms']}ms "
+                f"tpl={s['avg_template_ms']}ms size={s['avg_bytes']}B over={s['over_budget']}"
+                for name, s in views
+            ))
+
+
+def budgets():
+    """QUERY_BUDGETS normalized to {view name: {limit: value}}."""
+    normalized = {}
+    for name, budget in getattr(settings, 'QUERY_BUDGETS', {}).items():
+        normalized[name] = {'queries': budget} if isinstance(budget, int) else dict(budget)
+    return normalized
+
+
+def check_budget(view_name, measured, size):
+    """Return a description of each limit the request exceeded."""
+    budget = budgets().get(view_name)
+    if not budget:
+        return []
+    actual = {
+        'queries': measured.queries,
+        'db_ms': measured.db_time * 1000,
+        'template_ms': measured.template_time * 1000,
+        'bytes': size,
+    }
+    return [f'{limit} {actual[limit]:.0f} > {budget[limit]}'
+            for limit in BUDGET_LIMITS if limit in budget and actual[limit] > budget[limit]]
+
+
+def install():
+    """Hook query and template timing into Django (idempotent)."""
+    connection_created.connect(_add_execute_wrapper, dispatch_uid='parking.querystats')
+    for connection in connections.all(initialized_only=True):
+        _add_execute_wrapper(connection=connection)
+    if not getattr(Template.render, '_querystats', False):
+        _install_template_timing()
+
+
+def _execute(execute, sql, params, many, context):
+    measured = _current.get()
+    if measured is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        measured.queries += 1
+        measured.db_time += time.perf_counter() - started
+
+
+def _add_execute_wrapper(sender=None, connection=None, **kwargs):
+    if _execute not in connection.execute_wrappers:
+        # First in the list, so that temporary wrappers pushed and popped by
+        # `connection.execute_wrapper()` never remove this one
+        connection.execute_wrappers.insert(0, _execute)
+
+
+def _install_template_timing():
+    """Time top-level template renders for the request being measured."""
+    original = Template.render
+
+    def render(self, context):
+        measured = _current.get()
+        if measured is None or measured.render_depth:
+            # Not measuring, or an {% include %} inside a render already being timed
+            return original(self, context)
+        measured.render_depth += 1
+        started = time.perf_counter()
+        try:
+            return original(self, context)
+        finally:
+            measured.template_time += time.perf_counter() - started
+            measured.render_depth -= 1
+
+    render._querystats = True
+    Template.render = render
+
+
+stats = Collector()
@@ -0,0 +1,83 @@
+"""
+parking.reports
+-----------------
+Aggregations for the admin dashboards.
+
+Everything here reads the pre-aggregated `BookingRollup` rows (see
+`parking.rollups`), never raw bookings. So a report costs one grouped query
+over the rows for its date range, however much booking history exists.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.db.models import Sum
+from django.db.models.functions import ExtractHour
+from django.utils import timezone
+
+from .models import BookingRollup
+
+# Longest date range the dashboard will aggregate over
+MAX_RANGE = timedelta(days=366)
+# Dimensions `totals()` can group by
+DIMENSIONS = ('level', 'pricing_category', 'slot__slot_id')
+
+_SUMS = dict(count=Sum('bookings'), paid=Sum('paid'), failed=Sum('failed'),
+             revenue=Sum('revenue'), occupied_seconds=Sum('occupied_seconds'))
+
+
+def local_day_bounds(first, last):
+    """Aware [start, end) datetimes covering the local dates first..last inclusive."""
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(first, time.min), tz)
+    end = timezone.make_aware(datetime.combine(last + timedelta(days=1), time.min), tz)
+    return start, end
+
+
+def _rollups(period, first, last, level=None):
+    start, end = local_day_bounds(first, last)
+    rows = BookingRollup.objects.filter(period=period, period_start__gte=start, period_start__lt=end)
+    if level:
+        rows = rows.filter(level=level)
+    return rows
+
+
+def _bucket(row):
+    count, paid, failed = row.get('count') or 0, row.get('paid') or 0, row.get('failed') or 0
+    return {
+        'count': count,
+        'paid': paid,
+        'failed': failed,
+        'pending': count - paid - failed,
+        'revenue': row.get('revenue') or 0,
+        'occupied_seconds': row.get('occupied_seconds') or 0,
+    }
+
+
+def hourly_bookings(first, last, level=None):
+    """Bookings created between the local dates `first` and `last` (inclusive),
+    grouped by local hour of day.
+
+    Returns 24 dicts (hour 0-23), each with `count`, `paid`, `failed`,
+    `pending`, `revenue` (total fee of PAID bookings) and `occupied_seconds`
+    (slot time covered by PAID bookings in that hour). Pass `level` to only
+    count slots on that level.
+    """
+    rows = (_rollups(BookingRollup.PERIOD_HOUR, first, last, level)
+            .annotate(hour=ExtractHour('period_start', tzinfo=timezone.get_current_timezone()))
+            .values('hour')
+            .annotate(**_SUMS)
+            .order_by('hour'))
+    by_hour = {row['hour']: row for row in rows}
+    return [{'hour': hour, **_bucket(by_hour.get(hour, {}))} for hour in range(24)]
+
+
+def totals(first, last, by='level'):
+    """Totals for the local dates first..last from the daily rollups, grouped by
+    one of DIMENSIONS. Returns [{by: value, count, paid, ...}] ordered by revenue."""
+    if by not in DIMENSIONS:
+        raise ValueError(f'Cannot group rollups by {by!r}')
+    rows = (_rollups(BookingRollup.PERIOD_DAY, first, last)
+            .values(by)
+            .annotate(**_SUMS)
+            .order_by('-revenue', by))
+    return [{by: row[by], **_bucket(row)} for row in rows]
@@ -0,0 +1,157 @@
+"""
+parking.reservations
+----------------------
+Race-free booking creation.
+
+`reserve_slot()` checks that a slot is free, that the driver has no other
+pending/active booking, and that the requested time range does not overlap an
+existing live booking, then inserts the PENDING booking, all inside one
+transaction. Two drivers racing for the same slot (or one driver double
+submitting) can therefore never both pass the checks.
+
+Serialization:
+- On backends with `SELECT ... FOR UPDATE` the driver's user row and the slot
+  row are locked (in that order, so concurrent reservations cannot deadlock).
+- SQLite has no row locks, so reservations in a process are serialized with a
+  lock instead. SQLite allows one writer at a time anyway; the lock only makes
+  the read-check-insert sequence atomic for threads of this process.
+
+Callers get a `ReservationResult` instead of flash messages so views, tests
+and scripts can react to conflicts in their own way.
+
+`reserve_any()` books whichever free slot matches a driver's level and pricing
+category preferences, taking candidates from `parking.allocator` and running
+each through `reserve_slot()`.
+
+`expire_pending_bookings()` marks abandoned PENDING bookings FAILED so they
+stop taking part in overlap checks (run by `manage.py expire_pending`).
+"""
+
+import threading
+from contextlib import nullcontext
+from dataclasses import dataclass
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import allocator, driverstate, rollups
+from .models import Booking, ParkingSlot
+
+SLOT_NOT_FOUND = 'slot_not_found'
+SLOT_OCCUPIED = 'slot_occupied'
+USER_HAS_BOOKING = 'user_has_booking'
+TIME_OVERLAP = 'time_overlap'
+NO_FREE_SLOT = 'no_free_slot'
+
+# Candidates reserve_any() tries before giving up (others may win the race for each)
+ASSIGN_ATTEMPTS = 5
+
+_serial_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ReservationResult:
+    booking: Booking = None
+    conflict: str = None
+
+    @property
+    def ok(self):
+        return self.booking is not None
+
+
+def user_has_blocking_booking(user, now=None):
+    """True if `user` has a recent PENDING booking or a PAID booking in effect.
+
+    Only pending bookings younger than `Booking.PENDING_HOLD` block, so abandoned
+    payments do not lock a driver out. A PAID booking blocks only while it is in
+    effect (start <= now < end) and its slot is still marked occupied.
+    """
+    now = now or timezone.now()
+    bookings = Booking.objects.filter(user=user)
+    if bookings.filter(payment_status=Booking.STATUS_PENDING,
+                       created_at__gte=now - Booking.PENDING_HOLD).exists():
+        return True
+    return bookings.filter(
+        payment_status=Booking.STATUS_PAID,
+        start_time__lte=now,
+        end_time__gt=now,
+        slot__is_occupied=True,
+    ).exists()
+
+
+def reserve_slot(user, slot_id, start_time, end_time) -> ReservationResult:
+    """Atomically create a PENDING booking for `slot_id`, or report why not."""
+    row_locks = connection.features.has_select_for_update
+    with (nullcontext() if row_locks else _serial_lock):
+        with transaction.atomic():
+            slots = ParkingSlot.objects.all()
+            if row_locks:
+                get_user_model().objects.select_for_update().get(pk=user.pk)
+                slots = slots.select_for_update()
+            try:
+                slot = slots.get(slot_id=slot_id)
+            except ParkingSlot.DoesNotExist:
+                return ReservationResult(conflict=SLOT_NOT_FOUND)
+
+            if slot.is_occupied:
+                return ReservationResult(conflict=SLOT_OCCUPIED)
+            if user_has_blocking_booking(user):
+                return ReservationResult(conflict=USER_HAS_BOOKING)
+            if Booking.objects.overlapping(slot, start_time, end_time).exists():
+                return ReservationResult(conflict=TIME_OVERLAP)
+
+            # total_fee is computed in Booking.save()
+            booking = Booking.objects.create(
+                user=user,
+                slot=slot,
+                start_time=start_time,
+                end_time=end_time,
+                payment_status=Booking.STATUS_PENDING,
+            )
+    return ReservationResult(booking=booking)
+
+
+def reserve_any(user, start_time, end_time, level=None, pricing_category=None) -> ReservationResult:
+    """Reserve any free slot matching the preferences (None means any).
+
+    Candidates come from the allocator's free lists, so no slots are scanned.
+    A candidate that is taken or already booked for the time range is skipped
+    for the next one, up to `ASSIGN_ATTEMPTS`. Candidates that were not booked
+    are released, so the allocator re-checks them instead of hiding them for
+    a whole claim.
+    """
+    for _ in range(ASSIGN_ATTEMPTS):
+        slot_id = allocator.take(level, pricing_category)
+        if slot_id is None:
+            break
+        result = reserve_slot(user, slot_id, start_time, end_time)
+        if result.ok:
+            return result
+        allocator.release(slot_id)
+        if result.conflict == USER_HAS_BOOKING:
+            return result
+    return ReservationResult(conflict=NO_FREE_SLOT)
+
+
+def expire_pending_bookings(batch_size=1000, now=None) -> int:
+    """Mark PENDING bookings older than `Booking.PENDING_HOLD` as FAILED.
+
+    Works in batches of `batch_size` rows so each transaction holds its locks
+    briefly. A late payment callback can still move an expired booking to PAID.
+    Returns the number of bookings expired.
+    """
+    now = now or timezone.now()
+    expired = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Booking.objects.stale_pending(now)
+                        .values_list('pk', 'user_id', 'slot_id', 'created_at')[:batch_size])
+            if not rows:
+                return expired
+            # Re-check the status so a booking paid since the read is left alone
+            expired += (Booking.objects.filter(pk__in=[row[0] for row in rows], payment_status=Booking.STATUS_PENDING)
+                        .update(payment_status=Booking.STATUS_FAILED))
+            # PENDING bookings never occupied their slot; only the day they were created changes
+            rollups.mark({(slot_id, timezone.localdate(created_at)) for _, _, slot_id, created_at in rows})
+            driverstate.invalidate(user_id for _, user_id, _, _ in rows)
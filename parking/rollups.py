@@ -0,0 +1,205 @@
+"""
+parking.rollups
+-----------------
+Pre-aggregated booking statistics.
+
+`BookingRollup` keeps one row per slot and hour, and one per slot and local
+day. Each row holds:
+- the bookings created in that period (total, paid, failed);
+- the revenue of the paid ones;
+- the seconds of the period covered by PAID bookings, past or scheduled
+  (a booking without an end time counts up to when the row was computed).
+
+Rows whose numbers are all zero are not stored. Dashboards and reports read
+these rows (see `parking.reports`) instead of scanning bookings, so their cost
+depends on the period shown, not on how much history has accumulated.
+
+Rows are derived, never adjusted: `refresh(slot_days)` recomputes every row
+of the given (slot pk, local date) pairs from bookings and replaces them.
+Applying a change twice, or two changes out of order, gives the same result.
+
+Rows are written with an upsert on (slot, period, period_start), and only the
+rows that dropped to zero are deleted. Two refreshes of the same slot-days can
+therefore run at once without tripping the unique constraint.
+
+Booking changes call `mark()` or `mark_bookings()` with the slot-days they
+touch, both before and after the change. The marks are collected per thread
+and flushed in one `refresh()` once the surrounding transaction commits. A
+failed flush is logged and its slot-days are kept for the thread's next
+flush. The booking change has already committed, so the request does not
+fail over it.
+Changes made with raw SQL or queryset updates that bypass these hooks are
+picked up by `manage.py backfill_rollups`.
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+HOUR = timedelta(hours=1)
+# Columns a refresh recomputes for an existing row
+ROLLUP_FIELDS = ['level', 'pricing_category', 'bookings', 'paid', 'failed', 'revenue', 'occupied_seconds']
+
+logger = logging.getLogger(__name__)
+
+_pending = threading.local()
+
+
+def local_day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+
+
+def hour_starts(day):
+    """Start of every hour of the local date `day` (23 or 25 on DST changes)."""
+    start, end = local_day_start(day), local_day_start(day + timedelta(days=1))
+    hours = []
+    while start < end:
+        hours.append(start)
+        start += HOUR
+    return hours
+
+
+def booking_days(slot_id, created_at, start_time, end_time, now=None):
+    """(slot pk, local date) pairs whose rollups depend on a booking with these values."""
+    days = set()
+    if created_at is not None:
+        days.add((slot_id, timezone.localdate(created_at)))
+    if start_time is not None:
+        end = end_time or now or timezone.now()
+        day, last = timezone.localdate(start_time), timezone.localdate(max(end, start_time))
+        while day <= last:
+            days.add((slot_id, day))
+            day += timedelta(days=1)
+    return days
+
+
+def mark(slot_days):
+    """Refresh the rollups of `slot_days` once the current transaction commits."""
+    if not slot_days:
+        return
+    pending = getattr(_pending, 'slot_days', None)
+    if pending is None:
+        pending = _pending.slot_days = set()
+    pending.update(slot_days)
+    # Several marks in one transaction share a flush; later callbacks find nothing left
+    transaction.on_commit(flush)
+
+
+def mark_bookings(pks):
+    """mark() the slot-days of bookings changed through bulk updates."""
+    from .models import Booking
+    slot_days = set()
+    for row in Booking.objects.filter(pk__in=list(pks)).values_list('slot_id', 'created_at', 'start_time', 'end_time'):
+        slot_days |= booking_days(*row)
+    mark(slot_days)
+
+
+def flush():
+    slot_days = getattr(_pending, 'slot_days', None)
+    if slot_days:
+        _pending.slot_days = set()
+        try:
+            refresh(slot_days)
+        except Exception:
+            logger.exception('Refreshing rollups for %s slot-days failed; retrying on the next flush', len(slot_days))
+            _pending.slot_days |= slot_days
+
+
+def refresh(slot_days, now=None):
+    """Recompute the hourly and daily rows of the given (slot pk, local date) pairs."""
+    from .models import Booking, BookingRollup, ParkingSlot
+    slot_days = set(slot_days)
+    if not slot_days:
+        return 0
+    now = now or timezone.now()
+    slots = {pk: (level, category) for pk, level, category in
+             ParkingSlot.objects.filter(pk__in={slot for slot, _ in slot_days})
+             .values_list('pk', 'level', 'pricing_category')}
+    slot_days = {(slot, day) for slot, day in slot_days if slot in slots}
+    if not slot_days:
+        return 0
+    first = min(day for _, day in slot_days)
+    last = max(day for _, day in slot_days)
+    lo, hi = local_day_start(first), local_day_start(last + timedelta(days=1))
+    slot_ids = {slot for slot, _ in slot_days}
+
+    # Bookings created per slot and hour
+    paid = Q(payment_status=Booking.STATUS_PAID)
+    created = {}
+    for row in (Booking.objects.filter(slot_id__in=slot_ids, created_at__gte=lo, created_at__lt=hi)
+                .annotate(hour=TruncHour('created_at', tzinfo=timezone.get_current_timezone()))
+                .values('slot_id', 'hour')
+                .annotate(count=Count('pk'), paid=Count('pk', filter=paid),
+                          failed=Count('pk', filter=Q(payment_status=Booking.STATUS_FAILED)),
+                          revenue=Sum('total_fee', filter=paid))):
+        created[row['slot_id'], row['hour']] = row
+
+    # PAID intervals overlapping the range, per slot
+    intervals = defaultdict(list)
+    for slot_id, start, end in (Booking.objects.filter(paid, slot_id__in=slot_ids, start_time__lt=hi,
+                                                        start_time__gt=lo - Booking.MAX_DURATION)
+                                .filter(Q(end_time__gt=lo) | Q(end_time__isnull=True))
+                                .values_list('slot_id', 'start_time', 'end_time')):
+        intervals[slot_id].append((start, end or now))
+
+    rows = []
+    for slot_id, day in slot_days:
+        level, category = slots[slot_id]
+        totals = dict(bookings=0, paid=0, failed=0, revenue=Decimal(0), occupied_seconds=0)
+        for hour in hour_starts(day):
+            stats = created.get((slot_id, hour), {})
+            occupied = sum(max((min(end, hour + HOUR) - max(start, hour)).total_seconds(), 0)
+                           for start, end in intervals[slot_id])
+            values = dict(bookings=stats.get('count', 0), paid=stats.get('paid', 0), failed=stats.get('failed', 0),
+                          revenue=stats.get('revenue') or Decimal(0), occupied_seconds=int(occupied))
+            for key, value in values.items():
+                totals[key] += value
+            if any(values.values()):
+                rows.append(BookingRollup(period=BookingRollup.PERIOD_HOUR, period_start=hour, slot_id=slot_id,
+                                          level=level, pricing_category=category, **values))
+        if any(totals.values()):
+            rows.append(BookingRollup(period=BookingRollup.PERIOD_DAY, period_start=local_day_start(day),
+                                      slot_id=slot_id, level=level, pricing_category=category, **totals))
+
+    by_day = defaultdict(set)
+    for slot_id, day in slot_days:
+        by_day[day].add(slot_id)
+    stale = Q()
+    for day, day_slots in by_day.items():
+        stale |= Q(slot_id__in=day_slots, period_start__gte=local_day_start(day),
+                   period_start__lt=local_day_start(day + timedelta(days=1)))
+    keys = {(row.slot_id, row.period, row.period_start) for row in rows}
+    with transaction.atomic():
+        BookingRollup.objects.bulk_create(rows, batch_size=1000, update_conflicts=True,
+                                          unique_fields=['slot', 'period', 'period_start'],
+                                          update_fields=ROLLUP_FIELDS)
+        gone = [pk for pk, *key in BookingRollup.objects.filter(stale)
+                .values_list('pk', 'slot_id', 'period', 'period_start') if tuple(key) not in keys]
+        if gone:
+            BookingRollup.objects.filter(pk__in=gone).delete()
+    return len(rows)
+
+
+def rebuild(first, last, slot_ids=None, days_per_batch=7):
+    """Recompute rollups for the local dates first..last for all (or the given)
+    slots, a few days at a time. Returns the number of rows written."""
+    from .models import ParkingSlot
+    if slot_ids is None:
+        slot_ids = list(ParkingSlot.objects.values_list('pk', flat=True))
+    written = 0
+    day = first
+    while day <= last:
+        batch_end = min(day + timedelta(days=days_per_batch - 1), last)
+        batch = set()
+        while day <= batch_end:
+            batch.update((slot_id, day) for slot_id in slot_ids)
+            day += timedelta(days=1)
+        written += refresh(batch)
+    return written
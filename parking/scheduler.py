@@ -0,0 +1,125 @@
+"""
+parking.scheduler
+-------------------
+One in-process timer for delayed jobs.
+
+`scheduler.schedule(delay, fn, *args)` queues `fn(*args)` to run after `delay`
+seconds. Jobs are kept in a heap ordered by due time and run one after another
+on a single worker thread, so thousands of pending jobs cost heap entries
+rather than one OS thread each (as `threading.Timer` does). Jobs should be
+short; a slow job delays the ones behind it.
+
+Jobs live in memory only and are lost when the process exits. Callers that
+must survive a restart need to keep their own durable record. For example,
+simulated payments leave their booking PENDING, and the pending-booking
+sweeper expires it.
+
+`schedule_background()` queues maintenance jobs (such as occupancy refreshes at
+booking boundaries) that `wait_idle()` does not wait for.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    __slots__ = ('due', 'fn', 'args', 'kwargs', 'cancelled', 'background')
+
+    def __init__(self, due, fn, args, kwargs, background=False):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.background = background
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, name='parking-scheduler'):
+        self.name = name
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = 0
+
+    def schedule(self, delay, fn, *args, **kwargs) -> Job:
+        return self._push(Job(time.monotonic() + max(delay, 0), fn, args, kwargs))
+
+    def schedule_background(self, delay, fn, *args, **kwargs) -> Job:
+        """Like schedule(), but wait_idle() does not wait for the job."""
+        return self._push(Job(time.monotonic() + max(delay, 0), fn, args, kwargs, background=True))
+
+    def _push(self, job):
+        with self._cond:
+            # The sequence number keeps jobs with the same due time in FIFO order
+            heapq.heappush(self._heap, (job.due, next(self._seq), job))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            # Wake the worker in case this job is due before the one it is sleeping on
+            self._cond.notify_all()
+        return job
+
+    @property
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, job in self._heap if not job.cancelled) + self._running
+
+    def wait_idle(self, timeout=None):
+        """Block until no jobs other than background jobs are queued or running.
+        Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._running or any(not job.background and not job.cancelled for _, _, job in self._heap):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, _, job = self._heap[0]
+                    if job.cancelled:
+                        heapq.heappop(self._heap)
+                        self._cond.notify_all()
+                        continue
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+                    heapq.heappop(self._heap)
+                    if not job.background:
+                        self._running += 1
+                    break
+
+            close_old_connections()
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception:
+                logger.exception('Scheduled job %r failed', job.fn)
+            finally:
+                close_old_connections()
+                with self._cond:
+                    if not job.background:
+                        self._running -= 1
+                    self._cond.notify_all()
+
+
+scheduler = Scheduler()
@@ -1,10 +1,34 @@
-from django.test import TestCase, Client
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
+from django.db import connection, models, transaction
+from django.test.utils import CaptureQueriesContext
 from datetime import timedelta
+from io import StringIO
+from decimal import Decimal
 
-from .models import ParkingSlot, Booking
+from .models import ParkingSlot, Booking, BookingRollup, PricingRate, SlotCounter
+from .live import broker, event_stream
+from .occupancy import get_snapshot
+from . import allocator, counters, driverstate, layout, ledger, occupants, querystats, rollups
+from .scheduler import Scheduler
+from .reports import hourly_bookings
+from .reservations import (expire_pending_bookings, reserve_any, reserve_slot, NO_FREE_SLOT, SLOT_NOT_FOUND, TIME_OVERLAP,
+						   USER_HAS_BOOKING)
+from .views import _get_slot_vehicle_types
 
 
 class BookingLeaveFlowTests(TestCase):
@@ -145,3 +169,1300 @@ class BookingLeaveFlowTests(TestCase):
 		booking.refresh_from_db()
 		self.assertTrue(self.slot1.is_occupied)
 		self.assertNotIn('last_leave', self.client.session)
+
+
+class SlotStatusSnapshotTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='poller@example.com',
+			username='poller',
+			phone_number='254700000011',
+			vehicle_plate='POL-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='P-1', slot_name='P1', level='1')
+		self.client = Client()
+		self.client.force_login(self.user)
+
+	def _slot_queries(self, ctx):
+		return [q for q in ctx.captured_queries if 'parking_parkingslot' in q['sql']]
+
+	def test_repeated_polls_do_not_query_slots(self):
+		self.client.get(reverse('parking:slot_statuses_api'))
+		with CaptureQueriesContext(connection) as ctx:
+			resp = self.client.get(reverse('parking:slot_statuses_api'))
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(self._slot_queries(ctx), [])
+		self.assertEqual(resp.json()['slots'][0]['slot_id'], 'P-1')
+
+	def test_slot_save_rebuilds_snapshot(self):
+		first = self.client.get(reverse('parking:slot_statuses_api')).json()
+		self.assertFalse(first['slots'][0]['is_occupied'])
+
+		self.slot.is_occupied = True
+		with self.captureOnCommitCallbacks(execute=True):
+			self.slot.save()
+
+		second = self.client.get(reverse('parking:slot_statuses_api')).json()
+		self.assertTrue(second['slots'][0]['is_occupied'])
+		self.assertGreater(second['version'], first['version'])
+
+	def test_rolled_back_write_does_not_bump_versions(self):
+		snap = get_snapshot()
+		bays = layout.get_layout()
+		with self.captureOnCommitCallbacks(execute=True) as callbacks:
+			with self.assertRaises(RuntimeError), transaction.atomic():
+				self.slot.is_occupied = True
+				self.slot.level = '2'
+				self.slot.save()
+				# Nothing is rebuilt from the uncommitted write
+				self.assertIs(get_snapshot(), snap)
+				self.assertIs(layout.get_layout(), bays)
+				raise RuntimeError
+		self.assertEqual(callbacks, [])
+		self.assertIs(get_snapshot(), snap)
+		self.assertIs(layout.get_layout(), bays)
+
+	def test_if_none_match_returns_304_until_a_slot_changes(self):
+		url = reverse('parking:slot_statuses_api')
+		etag = self.client.get(url)['ETag']
+		resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(resp.status_code, 304)
+
+		self.slot.is_occupied = True
+		with self.captureOnCommitCallbacks(execute=True):
+			self.slot.save()
+		resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(resp.status_code, 200)
+		self.assertNotEqual(resp['ETag'], etag)
+
+	def test_since_returns_only_changed_slots(self):
+		ParkingSlot.objects.create(slot_id='P-2', slot_name='P2', level='1')
+		url = reverse('parking:slot_statuses_api')
+		first = self.client.get(url).json()
+		self.assertEqual(len(first['slots']), 2)
+		params = {'since': first['version'], 'epoch': first['epoch']}
+
+		self.assertEqual(self.client.get(url, params).status_code, 304)
+
+		self.slot.is_occupied = True
+		with self.captureOnCommitCallbacks(execute=True):
+			self.slot.save()
+		delta = self.client.get(url, params).json()
+		self.assertTrue(delta['delta'])
+		self.assertEqual([s['slot_id'] for s in delta['slots']], ['P-1'])
+
+		# Versions from another process (different epoch) get the full list
+		full = self.client.get(url, {'since': first['version'], 'epoch': 'other'}).json()
+		self.assertNotIn('delta', full)
+		self.assertEqual(len(full['slots']), 2)
+
+
+class OccupancyStreamTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='streamer@example.com',
+			username='streamer',
+			phone_number='254700000012',
+			vehicle_plate='STR-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='S-1', slot_name='S1', level='1')
+
+	async def test_broker_fans_out_published_snapshots(self):
+		subs = [broker.subscribe() for _ in range(50)]
+		try:
+			snap = await sync_to_async(get_snapshot)()
+			broker.publish(snap)
+			received = await asyncio.gather(*(s.next(timeout=2) for s in subs))
+			self.assertTrue(all(r is snap for r in received))
+		finally:
+			for s in subs:
+				broker.unsubscribe(s)
+		self.assertEqual(broker.subscriber_count, 0)
+
+	async def test_stream_pushes_slot_changes(self):
+		stream = event_stream(heartbeat=2)
+		try:
+			first = await anext(stream)
+			self.assertIn(b'"S-1"', first)
+
+			def occupy():
+				self.slot.is_occupied = True
+				with self.captureOnCommitCallbacks(execute=True):
+					self.slot.save()
+			await sync_to_async(occupy)()
+
+			event = await asyncio.wait_for(anext(stream), timeout=5)
+			data = json.loads(event.split(b'data: ', 1)[1])
+			self.assertTrue(data['delta'])
+			self.assertEqual(data['slots'], [{'slot_id': 'S-1', 'is_occupied': True, 'vehicle_type': None}])
+		finally:
+			await stream.aclose()
+
+	async def test_level_stream_only_carries_that_level(self):
+		def add_other():
+			with self.captureOnCommitCallbacks(execute=True):
+				return ParkingSlot.objects.create(slot_id='S-2', slot_name='S2', level='2')
+		other = await sync_to_async(add_other)()
+
+		def occupy(slot):
+			slot.is_occupied = True
+			with self.captureOnCommitCallbacks(execute=True):
+				slot.save()
+
+		stream = event_stream(heartbeat=0.5, slot_ids=frozenset({'S-1'}))
+		try:
+			first = await anext(stream)
+			self.assertIn(b'"S-1"', first)
+			self.assertNotIn(b'"S-2"', first)
+
+			# A change on another level sends nothing but the heartbeat
+			await sync_to_async(occupy)(other)
+			self.assertEqual(await asyncio.wait_for(anext(stream), timeout=5), b': keepalive\n\n')
+
+			await sync_to_async(occupy)(self.slot)
+			event = await asyncio.wait_for(anext(stream), timeout=5)
+			data = json.loads(event.split(b'data: ', 1)[1])
+			self.assertEqual(data['slots'], [{'slot_id': 'S-1', 'is_occupied': True, 'vehicle_type': None}])
+		finally:
+			await stream.aclose()
+
+	def test_stream_view_rejects_unknown_levels(self):
+		self.client.force_login(self.user)
+		self.assertEqual(self.client.get(reverse('parking:slot_status_stream'), {'level': 'Z9'}).status_code, 404)
+		# One stream covers several levels; any unknown one is rejected
+		ParkingSlot.objects.create(slot_id='S-2', slot_name='S2', level='2')
+		layout.reset()
+		url = reverse('parking:slot_status_stream')
+		self.assertEqual(self.client.get(url, {'level': ['1', 'Z9']}).status_code, 404)
+		self.assertEqual(self.client.get(url, {'level': ['1', '2']}).status_code, 204)
+
+	def test_stream_view_tells_wsgi_clients_to_poll(self):
+		# The test client is a WSGI request: no endless response, EventSource gives up
+		self.client.force_login(self.user)
+		resp = self.client.get(reverse('parking:slot_status_stream'))
+		self.assertEqual(resp.status_code, 204)
+		self.assertFalse(resp.streaming)
+
+	def test_stream_view_requires_login(self):
+		resp = self.client.get(reverse('parking:slot_status_stream'))
+		self.assertEqual(resp.status_code, 302)
+
+
+class SlotVehicleTypeTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		User = get_user_model()
+		self.slots = [
+			ParkingSlot.objects.create(slot_id=f'V-{i}', slot_name=f'V{i}', level='1')
+			for i in range(5)
+		]
+		now = timezone.now()
+		for i, slot in enumerate(self.slots):
+			user = User.objects.create_user(
+				email=f'v{i}@example.com',
+				username=f'v{i}',
+				phone_number=f'25470000010{i}',
+				vehicle_plate=f'VT-{i}',
+				vehicle_type='suv' if i % 2 else 'sedan',
+				password='pass'
+			)
+			Booking.objects.create(
+				user=user, slot=slot, start_time=now, end_time=now + timedelta(hours=1),
+				payment_status=Booking.STATUS_PAID
+			)
+		self.viewer = user
+
+	def test_vehicle_types_resolved_in_one_query(self):
+		with self.assertNumQueries(1):
+			mapping = _get_slot_vehicle_types()
+		self.assertEqual(mapping, {'V-0': 'sedan', 'V-1': 'suv', 'V-2': 'sedan', 'V-3': 'suv', 'V-4': 'sedan'})
+
+	def test_slot_status_api_reports_vehicle_type(self):
+		self.client.force_login(self.viewer)
+		slots = self.client.get(reverse('parking:slot_statuses_api')).json()['slots']
+		self.assertEqual(slots[1], {'slot_id': 'V-1', 'is_occupied': True, 'vehicle_type': 'suv'})
+
+
+class BookingOverlapTests(TestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='overlap@example.com',
+			username='overlap',
+			phone_number='254700000021',
+			vehicle_plate='OVL-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='O-1', slot_name='O1', level='1')
+		self.start = timezone.now() + timedelta(hours=1)
+
+	def _book(self, start, hours, status=Booking.STATUS_PENDING):
+		return Booking.objects.create(
+			user=self.user, slot=self.slot, start_time=start,
+			end_time=start + timedelta(hours=hours) if hours else None,
+			payment_status=status
+		)
+
+	def test_overlapping_matches_live_intervals_only(self):
+		self._book(self.start, 2, Booking.STATUS_PAID)
+		self._book(self.start + timedelta(hours=5), 1, Booking.STATUS_FAILED)
+		end = self.start + timedelta(hours=3)
+
+		overlapping = Booking.objects.overlapping
+		self.assertTrue(overlapping(self.slot, self.start + timedelta(hours=1), end).exists())
+		# Touching intervals do not overlap
+		self.assertFalse(overlapping(self.slot, self.start + timedelta(hours=2), end).exists())
+		# FAILED bookings never block
+		self.assertFalse(overlapping(self.slot, self.start + timedelta(hours=5), self.start + timedelta(hours=6)).exists())
+
+	def test_overlapping_matches_long_and_open_ended_bookings(self):
+		self._book(self.start, 24, Booking.STATUS_PAID)
+		later = self.start + timedelta(hours=23)
+		self.assertTrue(Booking.objects.overlapping(self.slot, later, later + timedelta(hours=1)).exists())
+
+		far = self.start + timedelta(days=10)
+		self.assertFalse(Booking.objects.overlapping(self.slot, far, far + timedelta(hours=1)).exists())
+		self._book(self.start + timedelta(days=2), None, Booking.STATUS_PAID)
+		self.assertTrue(Booking.objects.overlapping(self.slot, far, far + timedelta(hours=1)).exists())
+
+	def test_live_bookings_work_in_subqueries_and_use_the_partial_index(self):
+		other = ParkingSlot.objects.create(slot_id='O-2', slot_name='O2', level='1')
+		self._book(self.start, 1, Booking.STATUS_PAID)
+		Booking.objects.create(user=self.user, slot=other, start_time=self.start,
+							   end_time=self.start + timedelta(hours=1), payment_status=Booking.STATUS_FAILED)
+		booked = ParkingSlot.objects.filter(pk__in=Booking.objects.live().values('slot'))
+		self.assertEqual(list(booked), [self.slot])
+		live = models.Exists(Booking.objects.live().filter(slot=models.OuterRef('pk')))
+		self.assertEqual(list(ParkingSlot.objects.filter(live)), [self.slot])
+		# Inlined literals, as in the index condition
+		self.assertIn("IN ('PENDING', 'PAID')", str(Booking.objects.live().query))
+
+	def test_bookings_longer_than_max_duration_are_rejected(self):
+		booking = Booking(user=self.user, slot=self.slot, start_time=self.start,
+			end_time=self.start + Booking.MAX_DURATION + timedelta(minutes=1))
+		with self.assertRaises(ValidationError):
+			booking.full_clean()
+
+
+class ReservationRaceTests(TransactionTestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.users = [
+			User.objects.create_user(
+				email=f'racer{i}@example.com',
+				username=f'racer{i}',
+				phone_number=f'25470000030{i}',
+				vehicle_plate=f'RACE-{i}',
+				password=None
+			)
+			for i in range(8)
+		]
+		self.slots = [ParkingSlot.objects.create(slot_id=f'R-{i}', slot_name=f'R{i}', level='1') for i in range(2)]
+		self.start = timezone.now() + timedelta(hours=1)
+
+	def test_concurrent_reservations_never_double_book(self):
+		barrier = threading.Barrier(len(self.users))
+		results = []
+
+		def race(i, user):
+			try:
+				barrier.wait()
+				slot = self.slots[i % len(self.slots)]
+				results.append(reserve_slot(user, slot.slot_id, self.start, self.start + timedelta(hours=2)))
+			finally:
+				connection.close()
+
+		threads = [threading.Thread(target=race, args=(i, u)) for i, u in enumerate(self.users)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		self.assertEqual(sum(r.ok for r in results), len(self.slots))
+		self.assertTrue(all(r.conflict == TIME_OVERLAP for r in results if not r.ok))
+		for slot in self.slots:
+			self.assertEqual(Booking.objects.filter(slot=slot).count(), 1)
+
+	def test_driver_with_pending_booking_is_refused(self):
+		user = self.users[0]
+		first = reserve_slot(user, 'R-0', self.start, self.start + timedelta(hours=1))
+		second = reserve_slot(user, 'R-1', self.start, self.start + timedelta(hours=1))
+		self.assertTrue(first.ok)
+		self.assertEqual(second.conflict, USER_HAS_BOOKING)
+		self.assertEqual(reserve_slot(self.users[1], 'NOPE', self.start, self.start).conflict, SLOT_NOT_FOUND)
+
+
+class PricingRateCacheTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='payer@example.com',
+			username='payer',
+			phone_number='254700000041',
+			vehicle_plate='PAY-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='F-1', slot_name='F1', level='1', pricing_category='Premium')
+		self.rate = PricingRate.objects.create(category='Premium', rate=Decimal('80.00'))
+
+	def _booking(self):
+		start = timezone.now()
+		return Booking(user=self.user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=2))
+
+	def test_fee_calculation_uses_cached_rates(self):
+		booking = self._booking()
+		self.assertEqual(booking.calculate_fee(), 160.0)
+		with self.assertNumQueries(0):
+			self.assertEqual(booking.calculate_fee(), 160.0)
+
+	def test_saving_a_rate_invalidates_the_cache(self):
+		booking = self._booking()
+		booking.calculate_fee()
+		self.rate.rate = Decimal('90.00')
+		with self.captureOnCommitCallbacks(execute=True):
+			self.rate.save()
+		self.assertEqual(booking.calculate_fee(), 180.0)
+
+
+class AddSlotsBulkTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def _layout(self, content, suffix):
+		fd, path = tempfile.mkstemp(suffix=suffix)
+		with os.fdopen(fd, 'w') as fh:
+			fh.write(content)
+		self.addCleanup(os.remove, path)
+		return path
+
+	def test_layout_file_creates_and_updates_in_bulk(self):
+		ParkingSlot.objects.create(slot_id='A-1', slot_name='Old', level='1', is_occupied=True)
+		path = self._layout(
+			'slot_id,level,pricing_category\n'
+			'A-1,1,VIP\n'
+			'A-2,1,Premium\n'
+			'B-1,2,\n',
+			'.csv',
+		)
+		version = get_snapshot().version
+		out = StringIO()
+		with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks(execute=True):
+			call_command('addslots', layout=path, force=True, stdout=out)
+
+		slots = {s.slot_id: s for s in ParkingSlot.objects.all()}
+		self.assertEqual(set(slots), {'A-1', 'A-2', 'B-1'})
+		self.assertEqual(slots['A-1'].pricing_category, 'VIP')
+		self.assertFalse(slots['A-1'].is_occupied)
+		self.assertEqual(slots['A-2'].pricing_category, 'Premium')
+		self.assertEqual(slots['B-1'].level, '2')
+		self.assertEqual(slots['B-1'].pricing_category, 'Regular')
+		self.assertIn('slots/sec', out.getvalue())
+		# One read of existing ids, one INSERT and one UPDATE, whatever the slot count,
+		# plus one rollup relabel per new (level, category) of an updated slot
+		writes = [q for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE'))]
+		self.assertEqual(len([q for q in writes if 'parking_parkingslot' in q['sql'].split(' WHERE ')[0]]), 2)
+		self.assertEqual(len([q for q in writes if 'parking_bookingrollup' in q['sql']]), 1)
+		self.assertEqual(counters.reconcile(dry_run=True), {})
+		self.assertEqual(counters.summary().by_category, {'VIP': (1, 0), 'Premium': (1, 0), 'Regular': (1, 0)})
+		self.assertNotEqual(get_snapshot().version, version)
+
+	def test_bulk_mode_skips_existing_slots_without_force(self):
+		ParkingSlot.objects.create(slot_id='S-001', slot_name='Kept', level='L1')
+		call_command('addslots', num=5, bulk=True, stdout=StringIO())
+		self.assertEqual(ParkingSlot.objects.count(), 5)
+		self.assertEqual(ParkingSlot.objects.get(slot_id='S-001').slot_name, 'Kept')
+
+
+class SlotCounterTests(TestCase):
+	def setUp(self):
+		occupants.reset()
+		self.addCleanup(occupants.reset)
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='counter@example.com',
+			username='counter',
+			phone_number='254700000071',
+			vehicle_plate='CT-1',
+			password='pass'
+		)
+		self.slots = [ParkingSlot.objects.create(slot_id=f'K-{i}', slot_name=f'K{i}', level='B1' if i < 3 else 'B2',
+												 pricing_category='VIP' if i == 0 else 'Regular')
+					  for i in range(5)]
+
+	def assertCountersExact(self):
+		self.assertEqual(counters.reconcile(dry_run=True), {})
+
+	def test_slot_writes_keep_counters_exact(self):
+		summary = counters.summary()
+		self.assertEqual((summary.total, summary.occupied), (5, 0))
+		self.assertEqual(summary.by_level, {'B1': (3, 0), 'B2': (2, 0)})
+		self.assertEqual(summary.by_category, {'VIP': (1, 0), 'Regular': (4, 0)})
+
+		slot = self.slots[1]
+		slot.level = 'B2'
+		slot.is_occupied = True
+		slot.save()
+		self.assertEqual(counters.summary().by_level, {'B1': (2, 0), 'B2': (3, 1)})
+		self.slots[0].delete()
+		ParkingSlot.objects.filter(level='B2').update(pricing_category='Premium')
+		ParkingSlot.objects.bulk_update([ParkingSlot(pk=self.slots[2].pk, is_occupied=True)], ['is_occupied'])
+		self.assertCountersExact()
+		ParkingSlot.objects.filter(slot_id__in=['K-3', 'K-4']).delete()
+		summary = counters.summary()
+		self.assertEqual((summary.total, summary.occupied), (2, 2))
+		self.assertEqual(summary.by_category, {'Premium': (1, 1), 'Regular': (1, 1)})
+		self.assertCountersExact()
+
+	def test_occupancy_changes_move_occupied_counts(self):
+		now = timezone.now()
+		booking = Booking.objects.create(user=self.user, slot=self.slots[0], start_time=now - timedelta(minutes=5),
+										 end_time=now + timedelta(hours=1), payment_status=Booking.STATUS_PAID)
+		self.assertEqual(counters.summary().by_category['VIP'], (1, 1))
+		occupants.hold([self.slots[3].pk, self.slots[4].pk])
+		self.assertEqual(counters.summary().by_level['B2'], (2, 2))
+		occupants.release([self.slots[3].pk])
+		booking.delete()
+		summary = counters.summary()
+		self.assertEqual((summary.total, summary.occupied), (5, 1))
+		self.assertCountersExact()
+
+	def test_reconcile_repairs_drift(self):
+		SlotCounter.objects.filter(dimension=counters.LEVEL, value='B1').update(total=7, occupied=3)
+		SlotCounter.objects.filter(value='VIP').delete()
+		out = StringIO()
+		call_command('reconcile_counters', stdout=out)
+		self.assertIn('Fixed 2 counters', out.getvalue())
+		self.assertIn('level=B1: 3/7 occupied -> 0/3', out.getvalue())
+		self.assertCountersExact()
+
+	def test_stats_pages_read_counters_not_slots(self):
+		with CaptureQueriesContext(connection) as ctx:
+			response = self.client.get(reverse('home'))
+			slot_counts = [q for q in ctx.captured_queries if 'COUNT(' in q['sql'] and 'parking_parkingslot' in q['sql']]
+		self.assertEqual(slot_counts, [])
+		self.assertEqual(response.context['total_slots'], 5)
+		self.assertEqual(response.context['available_count'], 5)
+
+
+class BayLayoutTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		occupants.reset()
+		self.addCleanup(occupants.reset)
+		layout.reset()
+		self.addCleanup(layout.reset)
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='layout@example.com',
+			username='layout',
+			phone_number='254700000075',
+			vehicle_plate='LY-1',
+			password='pass'
+		)
+		for slot_id, level in (('B10-1', 'B10'), ('B2-1', 'B2'), ('B2-2', 'B2')):
+			ParkingSlot.objects.create(slot_id=slot_id, slot_name=slot_id, level=level)
+
+	def test_layout_is_reused_until_the_inventory_changes(self):
+		first = layout.get_layout()
+		self.assertEqual(first.levels, ('B2', 'B10'))
+		self.assertEqual([bay['x'] for bay in first.bays_by_level[0][1]], [260, 388])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.hold(ParkingSlot.objects.filter(slot_id='B2-2').values_list('pk', flat=True))
+		self.assertIs(layout.get_layout(), first)
+		overlay = layout.get_overlay('B2')
+		self.assertEqual([slot['is_occupied'] for slot in overlay.slots], [False, True])
+		self.assertIs(layout.get_overlay('B2'), overlay)
+		self.assertIsNone(layout.get_overlay('Z9'))
+
+		with self.captureOnCommitCallbacks(execute=True):
+			ParkingSlot.objects.create(slot_id='A1-1', slot_name='A1', level='A1')
+		self.assertEqual(layout.get_layout().levels, ('A1', 'B2', 'B10'))
+		with self.captureOnCommitCallbacks(execute=True):
+			ParkingSlot.objects.filter(slot_id='A1-1').update(level='C1')
+		self.assertEqual(layout.get_layout().levels, ('B2', 'B10', 'C1'))
+
+	def test_relabel_moves_the_layout_version_on_commit(self):
+		first = layout.get_layout()
+		with self.captureOnCommitCallbacks(execute=True):
+			ParkingSlot.objects.filter(slot_id='B10-1').update(level='B3')
+			# Until the write commits, readers keep the layout they have
+			self.assertIs(layout.get_layout(), first)
+		self.assertEqual(layout.get_layout().levels, ('B2', 'B3'))
+
+	def test_dashboard_lists_levels_without_rendering_bays(self):
+		self.client.force_login(self.user)
+		self.client.get(reverse('parking:driver_slots'))
+		occupants.hold(ParkingSlot.objects.filter(slot_id='B10-1').values_list('pk', flat=True))
+		with CaptureQueriesContext(connection) as ctx:
+			response = self.client.get(reverse('parking:driver_slots'))
+			slot_reads = [q for q in ctx.captured_queries if 'FROM "parking_parkingslot"' in q['sql']]
+		# Neither the layout nor the occupancy snapshot is needed for the first paint
+		self.assertEqual(slot_reads, [])
+		self.assertEqual([(row['level'], row['total'], row['occupied']) for row in response.context['level_summary']],
+						 [('B2', 2, 0), ('B10', 1, 1)])
+		self.assertContains(response, reverse('parking:level_slots', args=['B10']))
+		self.assertNotContains(response, 'data-slot-id="B2-1"')
+
+	def test_level_endpoint_renders_one_level_with_occupancy(self):
+		self.client.force_login(self.user)
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.hold(ParkingSlot.objects.filter(slot_id='B10-1').values_list('pk', flat=True))
+		response = self.client.get(reverse('parking:level_slots', args=['B10']))
+		self.assertContains(response, 'data-slot-id="B10-1"')
+		self.assertNotContains(response, 'data-slot-id="B2-1"')
+		self.assertTrue(response.context['slots'][0]['is_occupied'])
+		self.assertContains(response, f'data-snapshot-version="{get_snapshot().version}"')
+		self.assertEqual(self.client.get(reverse('parking:level_slots', args=['Z9'])).status_code, 404)
+
+	def test_level_names_may_contain_slashes(self):
+		ParkingSlot.objects.create(slot_id='PN-1', slot_name='PN1', level='P1/North')
+		self.client.force_login(self.user)
+		url = reverse('parking:level_slots', args=['P1/North'])
+		self.assertContains(self.client.get(reverse('parking:driver_slots')), url)
+		self.assertContains(self.client.get(url), 'data-slot-id="PN-1"')
+
+	def test_slot_statuses_can_be_filtered_by_level(self):
+		self.client.force_login(self.user)
+		url = reverse('parking:slot_statuses_api')
+		full = self.client.get(url, {'level': 'B2'}).json()
+		self.assertEqual([s['slot_id'] for s in full['slots']], ['B2-1', 'B2-2'])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.hold(ParkingSlot.objects.filter(slot_id__in=['B2-2', 'B10-1']).values_list('pk', flat=True))
+		delta = self.client.get(url, {'level': 'B2', 'since': full['version'], 'epoch': full['epoch']}).json()
+		self.assertTrue(delta['delta'])
+		self.assertEqual([s['slot_id'] for s in delta['slots']], ['B2-2'])
+		self.assertEqual(self.client.get(url, {'level': 'Z9'}).status_code, 404)
+
+
+class DriverStateTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		occupants.reset()
+		self.addCleanup(occupants.reset)
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='state@example.com',
+			username='state',
+			phone_number='254700000077',
+			vehicle_plate='ST-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='D-1', slot_name='D1', level='1')
+		self.other = ParkingSlot.objects.create(slot_id='D-2', slot_name='D2', level='1')
+		self.now = timezone.now()
+
+	def test_state_is_cached_until_the_drivers_bookings_change(self):
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=self.now + timedelta(hours=1),
+										 end_time=self.now + timedelta(hours=2))
+		get_snapshot()
+		with self.assertNumQueries(2):
+			state = driverstate.get(self.user)
+		self.assertEqual(state.pending_booking, booking)
+		self.assertEqual(state.occupancy_status, 'PENDING')
+		self.assertEqual(state.recent_bookings, (booking,))
+		with self.assertNumQueries(0):
+			self.assertEqual(driverstate.get(self.user).occupancy_status, 'PENDING')
+
+		booking.payment_status = Booking.STATUS_FAILED
+		with self.captureOnCommitCallbacks(execute=True):
+			booking.save()
+		state = driverstate.get(self.user)
+		self.assertEqual(state.occupancy_status, 'FREE')
+		self.assertEqual(state.recent_bookings[0].payment_status, Booking.STATUS_FAILED)
+
+	def test_time_and_occupancy_are_applied_on_read(self):
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=self.now - timedelta(minutes=5),
+										 end_time=self.now + timedelta(hours=1), payment_status=Booking.STATUS_PAID)
+		state = driverstate.get(self.user)
+		self.assertEqual(state.active_booking, booking)
+		self.assertTrue(state.blocks_booking)
+		self.assertEqual(driverstate.get(self.user, now=booking.end_time).occupancy_status, 'FREE')
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.release([self.slot.pk])
+		self.assertEqual(driverstate.get(self.user).occupancy_status, 'FREE')
+
+	def test_bulk_expiry_invalidates_cached_state(self):
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=self.now + timedelta(hours=1),
+										 end_time=self.now + timedelta(hours=2))
+		Booking.objects.filter(pk=booking.pk).update(created_at=self.now - Booking.PENDING_HOLD * 2)
+		self.assertEqual(driverstate.get(self.user).recent_bookings[0].payment_status, Booking.STATUS_PENDING)
+		with self.captureOnCommitCallbacks(execute=True):
+			expire_pending_bookings()
+		self.assertEqual(driverstate.get(self.user).recent_bookings[0].payment_status, Booking.STATUS_FAILED)
+
+	def test_blocked_driver_is_turned_away_before_reserving(self):
+		Booking.objects.create(user=self.user, slot=self.slot, start_time=self.now + timedelta(hours=1),
+							   end_time=self.now + timedelta(hours=2))
+		self.client.force_login(self.user)
+		driverstate.get(self.user)
+		start = timezone.localtime(self.now + timedelta(hours=3)).strftime('%Y-%m-%dT%H:%M')
+		with CaptureQueriesContext(connection) as ctx:
+			response = self.client.post(reverse('parking:initiate_booking', args=['D-2']),
+										{'start_time': start, 'duration_hours': 1})
+			savepoints = [q for q in ctx.captured_queries if q['sql'].startswith('SAVEPOINT')]
+		self.assertRedirects(response, reverse('parking:driver_slots'), fetch_redirect_response=False)
+		self.assertEqual(savepoints, [])
+		self.assertEqual(Booking.objects.filter(user=self.user).count(), 1)
+
+
+class AllocatorTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		for module in (occupants, layout, allocator):
+			module.reset()
+			self.addCleanup(module.reset)
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='assign@example.com',
+			username='assign',
+			phone_number='254700000078',
+			vehicle_plate='AS-1',
+			password='pass'
+		)
+		self.other = User.objects.create_user(
+			email='assign2@example.com',
+			username='assign2',
+			phone_number='254700000079',
+			vehicle_plate='AS-2',
+			password='pass'
+		)
+		for slot_id, level, category in (('L1-1', 'L1', 'Regular'), ('L1-2', 'L1', 'Regular'),
+										 ('L1-3', 'L1', 'VIP'), ('L2-1', 'L2', 'Regular')):
+			ParkingSlot.objects.create(slot_id=slot_id, slot_name=slot_id, level=level, pricing_category=category)
+		self.start = timezone.now() + timedelta(minutes=10)
+		self.end = self.start + timedelta(hours=2)
+
+	def test_slots_are_handed_out_once_by_preference(self):
+		self.assertEqual(allocator.take(level='L1', pricing_category='VIP'), 'L1-3')
+		self.assertEqual(allocator.take(level='L1'), 'L1-1')
+		self.assertEqual(allocator.take(level='L1'), 'L1-2')
+		self.assertIsNone(allocator.take(level='L1'))
+		self.assertEqual(allocator.take(), 'L2-1')
+		self.assertIsNone(allocator.take())
+		self.assertIsNone(allocator.take(level='Z9'))
+
+	def test_free_lists_follow_occupancy_changes(self):
+		self.assertEqual(allocator.free_count(), 4)
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.hold(ParkingSlot.objects.filter(slot_id='L1-1').values_list('pk', flat=True))
+		self.assertEqual(allocator.free_count(level='L1', pricing_category='Regular'), 1)
+		with CaptureQueriesContext(connection) as ctx:
+			self.assertEqual(allocator.take(level='L1', pricing_category='Regular'), 'L1-2')
+		# The snapshot is already current, and the free lists never read the slot table themselves
+		self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "parking_parkingslot"' in q['sql']]), 0)
+		with self.captureOnCommitCallbacks(execute=True):
+			occupants.release(ParkingSlot.objects.filter(slot_id='L1-1').values_list('pk', flat=True))
+		self.assertEqual(allocator.take(level='L1', pricing_category='Regular'), 'L1-1')
+
+	def test_reserve_any_skips_slots_booked_for_the_time_range(self):
+		reserve_slot(self.other, 'L1-1', self.start, self.end)
+		allocator.reset()
+		result = reserve_any(self.user, self.start, self.end, level='L1', pricing_category='Regular')
+		self.assertTrue(result.ok)
+		self.assertEqual(result.booking.slot.slot_id, 'L1-2')
+		self.assertEqual(reserve_any(self.user, self.start, self.end).conflict, USER_HAS_BOOKING)
+
+		third = get_user_model().objects.create_user(email='assign3@example.com', username='assign3',
+													 phone_number='254700000080', vehicle_plate='AS-3', password='pass')
+		self.assertEqual(reserve_any(third, self.start, self.end, level='L1', pricing_category='Regular').conflict,
+						 NO_FREE_SLOT)
+
+	def test_expired_claims_on_booked_slots_stay_off_the_free_lists(self):
+		User = get_user_model()
+		drivers = [User.objects.create_user(email=f'rush{i}@example.com', username=f'rush{i}',
+											phone_number=f'25471000000{i}', vehicle_plate=f'RU-{i}', password='pass')
+				   for i in range(4)]
+		booked = [reserve_any(driver, self.start, self.end).booking.slot.slot_id for driver in drivers[:3]]
+		self.assertEqual(booked, ['L1-1', 'L1-2', 'L1-3'])
+
+		# Claims run out while the bookings are still PENDING
+		with mock.patch.object(allocator, 'time') as clock:
+			clock.monotonic.return_value = time.monotonic() + allocator.CLAIM_SECONDS + 1
+			self.assertEqual(allocator.free_count(), 1)
+			result = reserve_any(drivers[3], self.start, self.end)
+		self.assertEqual(result.booking.slot.slot_id, 'L2-1')
+
+		# Once a booking expires its slot comes back
+		Booking.objects.filter(slot__slot_id='L1-1').update(created_at=timezone.now() - Booking.PENDING_HOLD * 2)
+		with mock.patch.object(allocator, 'time') as clock:
+			clock.monotonic.return_value = time.monotonic() + allocator.CLAIM_SECONDS * 3
+			self.assertEqual(allocator.take(), 'L1-1')
+
+	def test_failed_attempts_release_their_claim(self):
+		reserve_slot(self.user, 'L2-1', self.start, self.end)
+		self.assertEqual(allocator.free_count(), 3)
+		self.assertEqual(reserve_any(self.user, self.start, self.end).conflict, USER_HAS_BOOKING)
+		self.assertEqual(allocator.free_count(), 3)
+
+	def test_auto_book_view_books_a_matching_slot(self):
+		self.client.force_login(self.user)
+		start = timezone.localtime(self.start).strftime('%Y-%m-%dT%H:%M')
+		response = self.client.post(reverse('parking:auto_book'),
+									{'start_time': start, 'duration_hours': 1, 'level': 'L2', 'pricing_category': ''})
+		booking = Booking.objects.get(user=self.user)
+		self.assertEqual(booking.slot.slot_id, 'L2-1')
+		self.assertRedirects(response, reverse('parking:booking_status', args=[booking.pk]), fetch_redirect_response=False)
+
+		response = self.client.post(reverse('parking:auto_book'),
+									{'start_time': start, 'duration_hours': 1, 'level': 'L2'})
+		self.assertRedirects(response, reverse('parking:driver_slots'), fetch_redirect_response=False)
+		self.assertEqual(Booking.objects.filter(user=self.user).count(), 1)
+
+
+class SchedulerTests(TestCase):
+	def test_jobs_run_in_due_order_on_one_thread(self):
+		scheduler = Scheduler(name='test-scheduler')
+		ran = []
+		threads = set()
+
+		def job(n):
+			ran.append(n)
+			threads.add(threading.get_ident())
+
+		before = threading.active_count()
+		due = {}
+		for n in range(500):
+			due[n] = scheduler.schedule(((n * 37) % 500) / 5000, job, n).due
+		self.assertLessEqual(threading.active_count(), before + 1)
+		self.assertTrue(scheduler.wait_idle(timeout=10))
+		self.assertEqual(ran, sorted(ran, key=due.get))
+		self.assertEqual(len(ran), 500)
+		self.assertEqual(len(threads), 1)
+
+	def test_cancelled_job_does_not_run(self):
+		scheduler = Scheduler(name='test-scheduler')
+		ran = []
+		job = scheduler.schedule(0.05, ran.append, 'cancelled')
+		scheduler.schedule(0.1, ran.append, 'kept')
+		job.cancel()
+		self.assertTrue(scheduler.wait_idle(timeout=5))
+		self.assertEqual(ran, ['kept'])
+
+
+class PendingExpiryTests(TestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='sweep@example.com',
+			username='sweep',
+			phone_number='254700000051',
+			vehicle_plate='SW-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='X-1', slot_name='X1', level='1')
+
+	def _booking(self, status, age):
+		start = timezone.now() + timedelta(hours=1)
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=start,
+										 end_time=start + timedelta(hours=1), payment_status=status)
+		Booking.objects.filter(pk=booking.pk).update(created_at=timezone.now() - age)
+		return booking
+
+	def test_only_stale_pending_bookings_expire(self):
+		stale = [self._booking(Booking.STATUS_PENDING, timedelta(hours=2)) for _ in range(5)]
+		fresh = self._booking(Booking.STATUS_PENDING, timedelta(minutes=1))
+		paid = self._booking(Booking.STATUS_PAID, timedelta(hours=2))
+
+		self.assertEqual(expire_pending_bookings(batch_size=2), 5)
+		self.assertEqual(Booking.objects.filter(pk__in=[b.pk for b in stale], payment_status=Booking.STATUS_FAILED).count(), 5)
+		fresh.refresh_from_db()
+		paid.refresh_from_db()
+		self.assertEqual(fresh.payment_status, Booking.STATUS_PENDING)
+		self.assertEqual(paid.payment_status, Booking.STATUS_PAID)
+		# Expired bookings no longer block the slot's time range
+		self.assertFalse(Booking.objects.overlapping(self.slot, stale[0].start_time, stale[0].end_time)
+						 .exclude(pk__in=[fresh.pk, paid.pk]).exists())
+
+	def test_sweep_uses_status_created_index(self):
+		if connection.vendor != 'sqlite':
+			self.skipTest('SQLite query plan')
+		sql, params = Booking.objects.stale_pending().values('pk').query.sql_with_params()
+		with connection.cursor() as cursor:
+			cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+			plan = ' '.join(row[-1] for row in cursor.fetchall())
+		self.assertIn('booking_status_created_idx', plan)
+
+
+class OccupantTests(TestCase):
+	def setUp(self):
+		occupants.reset()
+		self.addCleanup(occupants.reset)
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='occupant@example.com',
+			username='occupant',
+			phone_number='254700000061',
+			vehicle_plate='OC-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='O-1', slot_name='O1', level='1')
+		self.now = timezone.now()
+
+	def _paid(self, start, hours=1):
+		return Booking.objects.create(user=self.user, slot=self.slot, start_time=start,
+									  end_time=start + timedelta(hours=hours), payment_status=Booking.STATUS_PAID)
+
+	def test_paid_booking_occupies_only_while_it_runs(self):
+		booking = self._paid(self.now + timedelta(hours=1))
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+		self.assertEqual(occupants.occupants_at(self.now + timedelta(minutes=90)), {self.slot.pk: booking.pk})
+		self.assertEqual(occupants.next_boundary(self.now), booking.start_time)
+
+		# Interval boundaries: the booking starts, then ends
+		self.assertEqual(occupants.refresh(now=booking.start_time), {self.slot.pk: booking.pk})
+		self.slot.refresh_from_db()
+		self.assertTrue(self.slot.is_occupied)
+		self.assertEqual(self.slot.current_booking_id, booking.pk)
+		self.assertEqual(occupants.refresh(now=booking.start_time), {})
+		self.assertEqual(occupants.refresh(now=booking.end_time), {self.slot.pk: None})
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+
+	def test_request_after_end_time_frees_the_slot(self):
+		booking = self._paid(self.now - timedelta(minutes=30))
+		self.slot.refresh_from_db()
+		self.assertEqual(self.slot.current_booking_id, booking.pk)
+		Booking.objects.filter(pk=booking.pk).update(end_time=self.now - timedelta(minutes=1))
+
+		occupants.reset()
+		self.client.get(reverse('parking:slot_statuses_api'))
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+		self.assertIsNone(self.slot.current_booking_id)
+
+	def test_due_refresh_runs_once_for_concurrent_requests(self):
+		barrier = threading.Barrier(8)
+		calls = []
+
+		def slow_refresh():
+			calls.append(1)
+			time.sleep(0.2)
+
+		def request():
+			barrier.wait()
+			occupants.ensure_current()
+
+		with mock.patch.object(occupants, 'refresh', side_effect=slow_refresh):
+			threads = [threading.Thread(target=request) for _ in range(8)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+		self.assertEqual(len(calls), 1)
+
+	def test_queryset_and_cascade_deletes_free_the_slot(self):
+		booking = self._paid(self.now - timedelta(minutes=10))
+		Booking.objects.filter(pk=booking.pk).delete()
+		self.slot.refresh_from_db()
+		self.assertEqual((self.slot.is_occupied, self.slot.current_booking_id), (False, None))
+
+		self._paid(self.now - timedelta(minutes=10))
+		self.slot.refresh_from_db()
+		self.assertTrue(self.slot.is_occupied)
+		self.user.delete()
+		self.slot.refresh_from_db()
+		self.assertEqual((self.slot.is_occupied, self.slot.current_booking_id), (False, None))
+		self.assertEqual(counters.reconcile(dry_run=True), {})
+
+	def test_refreshing_a_slot_frees_a_flag_without_occupant(self):
+		ParkingSlot.objects.filter(pk=self.slot.pk).update(is_occupied=True)
+		self.assertEqual(occupants.refresh_slots([self.slot.pk]), {self.slot.pk: None})
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+
+	def test_manual_hold_lasts_until_the_next_boundary(self):
+		occupants.hold([self.slot.pk])
+		occupants.refresh()
+		self.slot.refresh_from_db()
+		self.assertTrue(self.slot.is_occupied)
+
+		booking = self._paid(self.now - timedelta(minutes=10))
+		occupants.refresh(now=booking.end_time)
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+
+	def test_stale_slot_instance_does_not_overwrite_current_booking(self):
+		stale = ParkingSlot.objects.get(pk=self.slot.pk)
+		booking = self._paid(self.now - timedelta(minutes=10))
+		stale.slot_name = 'Renamed'
+		stale.save()
+		self.slot.refresh_from_db()
+		self.assertEqual(self.slot.current_booking_id, booking.pk)
+		self.assertEqual(self.slot.slot_name, 'Renamed')
+
+	def test_cancelling_a_paid_booking_frees_the_slot(self):
+		booking = self._paid(self.now - timedelta(minutes=10))
+		self.assertTrue(booking.slot.is_occupied)
+		booking.payment_status = Booking.STATUS_FAILED
+		booking.save()
+		self.assertFalse(booking.slot.is_occupied)
+		self.slot.refresh_from_db()
+		self.assertFalse(self.slot.is_occupied)
+
+
+@override_settings(QUERY_STATS=True, QUERY_BUDGET_STRICT=True)
+class QueryBudgetTests(TestCase):
+	def setUp(self):
+		querystats.stats.reset()
+		User = get_user_model()
+		self.driver = User.objects.create_user(
+			email='budget@example.com',
+			username='budget',
+			phone_number='254700000071',
+			vehicle_plate='QB-1',
+			password='pass'
+		)
+		self.staff = User.objects.create_user(
+			email='budget-admin@example.com',
+			username='budget-admin',
+			phone_number='254700000072',
+			vehicle_plate='QB-2',
+			password='pass',
+			is_staff=True
+		)
+		start = timezone.now() - timedelta(minutes=30)
+		for i in range(10):
+			slot = ParkingSlot.objects.create(slot_id=f'Q-{i}', slot_name=f'Q{i}', level='1')
+			Booking.objects.create(user=self.driver, slot=slot, start_time=start, end_time=start + timedelta(hours=1),
+								   payment_status=Booking.STATUS_PAID if i % 2 else Booking.STATUS_PENDING)
+		occupants.refresh()
+
+	def test_views_stay_within_budget(self):
+		self.client.force_login(self.driver)
+		self.client.get(reverse('parking:driver_slots'))
+		self.client.force_login(self.staff)
+		self.client.get(reverse('parking:admin_activities'))
+		self.client.get(reverse('parking:admin_booking_list'))
+		views = querystats.stats.snapshot()
+		self.assertEqual(views['parking:driver_slots']['requests'], 1)
+		self.assertGreater(views['parking:driver_slots']['avg_bytes'], 0)
+		self.assertGreater(views['parking:admin_activities']['max_queries'], 0)
+
+	def test_regression_over_budget_fails(self):
+		self.client.force_login(self.driver)
+		with override_settings(QUERY_BUDGETS={'parking:driver_slots': 1}):
+			with self.assertRaises(querystats.QueryBudgetExceeded):
+				self.client.get(reverse('parking:driver_slots'))
+		with override_settings(QUERY_BUDGET_STRICT=False, QUERY_BUDGETS={'parking:driver_slots': {'queries': 1}}):
+			with self.assertLogs('parking.querystats', 'WARNING'):
+				self.client.get(reverse('parking:driver_slots'))
+		self.assertEqual(querystats.stats.snapshot()['parking:driver_slots']['over_budget'], 2)
+
+	@override_settings(QUERY_STATS_LOG_INTERVAL=0)
+	def test_summary_is_logged_periodically(self):
+		self.client.force_login(self.driver)
+		with self.assertLogs('parking.querystats', 'INFO') as logs:
+			self.client.get(reverse('parking:driver_slots'))
+		self.assertIn('parking:driver_slots n=1', logs.output[0])
+
+	def test_stats_endpoint_is_staff_only(self):
+		self.client.force_login(self.driver)
+		self.client.get(reverse('parking:driver_slots'))
+		response = self.client.get(reverse('parking:query_stats_api'))
+		self.assertEqual(response.status_code, 302)
+
+		self.client.force_login(self.staff)
+		data = self.client.get(reverse('parking:query_stats_api')).json()
+		self.assertTrue(data['enabled'])
+		self.assertIn('parking:driver_slots', data['views'])
+		self.assertEqual(data['budgets']['parking:driver_slots'], {'queries': 15})
+		self.client.post(reverse('parking:query_stats_api'))
+		self.assertEqual(list(querystats.stats.snapshot()), ['parking:query_stats_api'])
+
+
+class HourlyBookingsTests(TestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='hourly@example.com',
+			username='hourly',
+			phone_number='254700000081',
+			vehicle_plate='HR-1',
+			password='pass'
+		)
+		self.staff = User.objects.create_user(
+			email='hourly-admin@example.com',
+			username='hourly-admin',
+			phone_number='254700000082',
+			vehicle_plate='HR-2',
+			password='pass',
+			is_staff=True
+		)
+		self.ground = ParkingSlot.objects.create(slot_id='H-1', slot_name='H1', level='G')
+		self.upper = ParkingSlot.objects.create(slot_id='H-2', slot_name='H2', level='U')
+		self.today = timezone.localdate()
+
+	def _booking(self, slot, hour, status, fee, days_ago=0):
+		booking = Booking.objects.create(user=self.user, slot=slot, payment_status=status,
+										 start_time=timezone.now() + timedelta(days=1))
+		created = timezone.make_aware(timezone.datetime.combine(self.today - timedelta(days=days_ago),
+																timezone.datetime.min.time()).replace(hour=hour))
+		Booking.objects.filter(pk=booking.pk).update(created_at=created, total_fee=fee)
+
+	def _roll_up(self):
+		# The fixtures bypass the save() hooks, so rebuild the rollups they feed
+		rollups.rebuild(self.today - timedelta(days=2), self.today + timedelta(days=2))
+
+	def test_histogram_groups_counts_revenue_and_statuses_by_hour(self):
+		self._booking(self.ground, 9, Booking.STATUS_PAID, 100)
+		self._booking(self.upper, 9, Booking.STATUS_PAID, 50)
+		self._booking(self.ground, 9, Booking.STATUS_FAILED, 70)
+		self._booking(self.ground, 17, Booking.STATUS_PENDING, 30)
+		self._booking(self.ground, 17, Booking.STATUS_PAID, 100, days_ago=1)
+		self._roll_up()
+
+		with CaptureQueriesContext(connection) as ctx:
+			hours = hourly_bookings(self.today, self.today)
+		self.assertEqual(len(ctx.captured_queries), 1)
+		self.assertEqual(len(hours), 24)
+		self.assertEqual(hours[9], {'hour': 9, 'count': 3, 'paid': 2, 'failed': 1, 'pending': 0,
+									'revenue': Decimal('150'), 'occupied_seconds': 0})
+		self.assertEqual(hours[17]['count'], 1)
+		self.assertEqual(hours[17]['pending'], 1)
+		self.assertEqual(sum(h['count'] for h in hours), 4)
+
+		self.assertEqual(hourly_bookings(self.today - timedelta(days=1), self.today)[17]['count'], 2)
+		self.assertEqual(hourly_bookings(self.today, self.today, level='U')[9]['revenue'], Decimal('50'))
+
+	def test_view_reads_rollups_only(self):
+		self._booking(self.ground, 9, Booking.STATUS_PAID, 100)
+		self._booking(self.upper, 10, Booking.STATUS_PAID, 40)
+		self._roll_up()
+		self.client.force_login(self.staff)
+		# Occupancy is current, so the middleware does not refresh it during the request
+		occupants.refresh()
+		with CaptureQueriesContext(connection) as ctx:
+			response = self.client.get(reverse('parking:admin_activities'), {'level': 'G'})
+			sql = [q['sql'] for q in ctx.captured_queries]
+		self.assertFalse([q for q in sql if '"parking_booking"' in q])
+		self.assertEqual(len([q for q in sql if '"parking_bookingrollup"' in q]), 2)
+		self.assertEqual(response.context['bookings_today'], 1)
+		self.assertEqual(response.context['revenue_today'], Decimal('100'))
+		self.assertEqual(response.context['peak_hour'], 9)
+		self.assertEqual([(row['level'], row['revenue']) for row in response.context['level_totals']],
+						 [('G', Decimal('100')), ('U', Decimal('40'))])
+
+
+class RollupTests(TestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.user = User.objects.create_user(
+			email='rollup@example.com',
+			username='rollup',
+			phone_number='254700000085',
+			vehicle_plate='RU-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='R-1', slot_name='R1', level='G', pricing_category='Premium')
+		self.other = ParkingSlot.objects.create(slot_id='R-2', slot_name='R2', level='U')
+		self.today = timezone.localdate()
+		yesterday = timezone.make_aware(timezone.datetime.combine(self.today - timedelta(days=1),
+																  timezone.datetime.min.time()))
+		self.start = yesterday.replace(hour=10, minute=30)
+
+	def _book(self, **fields):
+		with self.captureOnCommitCallbacks(execute=True):
+			return Booking.objects.create(user=self.user, slot=self.slot, start_time=self.start,
+										  end_time=self.start + timedelta(minutes=90), **fields)
+
+	def _rows(self, period=BookingRollup.PERIOD_HOUR, slot=None):
+		return {(row.period_start, row.slot_id): row
+				for row in BookingRollup.objects.filter(period=period, slot=slot or self.slot)}
+
+	def test_paid_booking_splits_occupancy_across_hours(self):
+		booking = self._book()
+		self.assertEqual(sum(row.occupied_seconds for row in self._rows().values()), 0)
+		self.assertEqual(sum(row.bookings for row in self._rows().values()), 1)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			booking.payment_status = Booking.STATUS_PAID
+			booking.save()
+		hourly = self._rows()
+		self.assertEqual(hourly[self.start.replace(minute=0), self.slot.pk].occupied_seconds, 1800)
+		self.assertEqual(hourly[self.start.replace(hour=11, minute=0), self.slot.pk].occupied_seconds, 3600)
+		daily = BookingRollup.objects.get(period=BookingRollup.PERIOD_DAY, slot=self.slot,
+										  period_start=rollups.local_day_start(self.today))
+		self.assertEqual((daily.bookings, daily.paid, daily.revenue), (1, 1, booking.total_fee))
+		self.assertEqual(daily.level, 'G')
+		self.assertEqual(daily.pricing_category, 'Premium')
+
+	def test_moving_a_booking_refreshes_its_old_slot(self):
+		booking = self._book(payment_status=Booking.STATUS_PAID)
+		with self.captureOnCommitCallbacks(execute=True):
+			booking.slot = self.other
+			booking.save()
+		self.assertEqual(self._rows(), {})
+		self.assertEqual(sum(row.occupied_seconds for row in self._rows(slot=self.other).values()), 5400)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			booking.delete()
+		self.assertFalse(BookingRollup.objects.exists())
+
+	def test_refresh_upserts_existing_rows_and_drops_emptied_ones(self):
+		self._book(payment_status=Booking.STATUS_PAID)
+		hour = self.start.replace(minute=0)
+		# As left by a concurrent refresh: a row with outdated numbers and one no longer backed by bookings
+		BookingRollup.objects.filter(period=BookingRollup.PERIOD_HOUR, period_start=hour).update(occupied_seconds=1)
+		BookingRollup.objects.create(period=BookingRollup.PERIOD_HOUR, period_start=hour.replace(hour=20),
+									 slot=self.slot, level='G', pricing_category='Premium', bookings=3)
+		rollups.refresh({(self.slot.pk, timezone.localdate(self.start))})
+		hourly = self._rows()
+		self.assertEqual(hourly[hour, self.slot.pk].occupied_seconds, 1800)
+		self.assertNotIn((hour.replace(hour=20), self.slot.pk), hourly)
+
+	def test_failed_flush_is_logged_and_kept_for_the_next_one(self):
+		with mock.patch.object(rollups, 'refresh', side_effect=RuntimeError('db down')):
+			with self.assertLogs('parking.rollups', level='ERROR'):
+				self._book()
+		self.assertFalse(BookingRollup.objects.exists())
+		self._book()
+		self.assertEqual(sum(row.bookings for row in self._rows().values()), 2)
+
+	def test_rebuild_matches_incremental_rows_and_is_idempotent(self):
+		self._book(payment_status=Booking.STATUS_PAID)
+		self._book(payment_status=Booking.STATUS_FAILED)
+		fields = ('period', 'period_start', 'slot_id', 'bookings', 'paid', 'failed', 'revenue', 'occupied_seconds')
+		incremental = sorted(BookingRollup.objects.values_list(*fields))
+		for _ in range(2):
+			rollups.rebuild(self.today - timedelta(days=1), self.today)
+			self.assertEqual(sorted(BookingRollup.objects.values_list(*fields)), incremental)
+
+	def test_bulk_expiry_marks_created_days(self):
+		booking = self._book()
+		Booking.objects.filter(pk=booking.pk).update(created_at=timezone.now() - Booking.PENDING_HOLD * 2)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.assertEqual(expire_pending_bookings(), 1)
+		daily = BookingRollup.objects.get(period=BookingRollup.PERIOD_DAY, slot=self.slot,
+										  period_start=rollups.local_day_start(self.today))
+		self.assertEqual((daily.bookings, daily.failed), (1, 1))
+
+	def test_slot_changes_relabel_rollups(self):
+		self._book(payment_status=Booking.STATUS_PAID)
+		self.slot.level = 'B1'
+		self.slot.save()
+		self.assertEqual(set(BookingRollup.objects.values_list('level', flat=True)), {'B1'})
+
+		# Occupancy-only saves leave rollups alone
+		self.slot.is_occupied = True
+		with CaptureQueriesContext(connection) as ctx:
+			self.slot.save()
+		self.assertEqual([q for q in ctx.captured_queries if 'parking_bookingrollup' in q['sql']], [])
+
+		# bulk_update (addslots --bulk) relabels as well
+		self.slot.pricing_category = 'VIP'
+		ParkingSlot.objects.bulk_update([self.slot], ['pricing_category'])
+		self.assertEqual(set(BookingRollup.objects.values_list('pricing_category', flat=True)), {'VIP'})
+
+	def test_backfill_command_rebuilds_rows(self):
+		self._book(payment_status=Booking.STATUS_PAID)
+		BookingRollup.objects.all().delete()
+		out = StringIO()
+		call_command('backfill_rollups', stdout=out)
+		# Two occupied hours and a day row yesterday, the creation hour and a day row today
+		self.assertIn('Wrote 5 rollup rows for 2 days', out.getvalue())
+		self.assertEqual(hourly_bookings(self.today, self.today)[timezone.localtime().hour]['paid'], 1)
+
+
+class BookingLedgerTests(TestCase):
+	def setUp(self):
+		User = get_user_model()
+		self.driver = User.objects.create_user(
+			email='ledger@example.com',
+			username='ledger',
+			phone_number='254700000091',
+			vehicle_plate='LG-1',
+			password='pass'
+		)
+		self.staff = User.objects.create_user(
+			email='ledger-admin@example.com',
+			username='ledger-admin',
+			phone_number='254700000092',
+			vehicle_plate='LG-2',
+			password='pass',
+			is_staff=True
+		)
+		self.slots = [ParkingSlot.objects.create(slot_id=f'L-{i}', slot_name=f'L{i}', level='1') for i in range(2)]
+		base = timezone.now() - timedelta(days=1)
+		self.bookings = []
+		for i in range(7):
+			booking = Booking.objects.create(user=self.driver, slot=self.slots[i % 2], start_time=base + timedelta(days=2),
+											 payment_status=Booking.STATUS_FAILED if i % 3 else Booking.STATUS_PENDING)
+			# Two bookings share a timestamp so the id tiebreak is exercised
+			Booking.objects.filter(pk=booking.pk).update(created_at=base + timedelta(minutes=min(i, 5)))
+			self.bookings.append(booking)
+		self.newest_first = sorted(self.bookings, key=lambda b: (min(self.bookings.index(b), 5), b.pk), reverse=True)
+		self.client.force_login(self.staff)
+		occupants.refresh()
+
+	def _walk(self, **params):
+		url = reverse('parking:admin_booking_list')
+		response = self.client.get(url, {'per_page': 3, **params})
+		pages = [response]
+		while response.context['next_url']:
+			response = self.client.get(url + response.context['next_url'])
+			pages.append(response)
+		return pages
+
+	def test_pages_cover_the_ledger_in_order_both_ways(self):
+		pages = self._walk()
+		seen = [b.pk for page in pages for b in page.context['bookings']]
+		self.assertEqual(seen, [b.pk for b in self.newest_first])
+		self.assertEqual([len(page.context['bookings']) for page in pages], [3, 3, 1])
+		self.assertIsNone(pages[0].context['prev_url'])
+
+		back = self.client.get(reverse('parking:admin_booking_list') + pages[-1].context['prev_url'])
+		self.assertEqual([b.pk for b in back.context['bookings']], [b.pk for b in pages[1].context['bookings']])
+		self.assertIsNotNone(back.context['prev_url'])
+		first = self.client.get(reverse('parking:admin_booking_list') + back.context['prev_url'])
+		self.assertEqual([b.pk for b in first.context['bookings']], [b.pk for b in pages[0].context['bookings']])
+		self.assertIsNone(first.context['prev_url'])
+
+	def test_page_query_count_does_not_grow_with_rows(self):
+		with CaptureQueriesContext(connection) as ctx:
+			self.client.get(reverse('parking:admin_booking_list'))
+			booking_queries = [q for q in ctx.captured_queries if 'parking_booking' in q['sql']]
+		self.assertEqual(len(booking_queries), 1)
+		self.assertIn('parking_parkingslot', booking_queries[0]['sql'])
+
+	def test_filters(self):
+		pages = self._walk(status=Booking.STATUS_PENDING, slot='L-0')
+		seen = {b.pk for page in pages for b in page.context['bookings']}
+		expected = {b.pk for b in self.bookings if b.payment_status == Booking.STATUS_PENDING and b.slot_id == self.slots[0].pk}
+		self.assertEqual(seen, expected)
+		response = self.client.get(reverse('parking:admin_booking_list'), {'from': (timezone.localdate() + timedelta(days=1)).isoformat()})
+		self.assertEqual(list(response.context['bookings']), [])
+
+	def test_csv_export_streams_filtered_ledger(self):
+		response = self.client.get(reverse('parking:admin_booking_list'), {'format': 'csv', 'status': Booking.STATUS_FAILED})
+		self.assertTrue(response.streaming)
+		self.assertIn('attachment;', response['Content-Disposition'])
+		lines = b''.join(response.streaming_content).decode().splitlines()
+		self.assertEqual(lines[0].split(',')[:3], ['id', 'created_at', 'slot'])
+		self.assertEqual(len(lines) - 1, sum(1 for b in self.bookings if b.payment_status == Booking.STATUS_FAILED))
+		self.assertIn('ledger@example.com', lines[1])
+
+	def test_keyset_pages_use_ledger_indexes(self):
+		if connection.vendor != 'sqlite':
+			self.skipTest('SQLite query plan')
+		cursor_value = ledger.encode_cursor(self.newest_first[2])
+		for filters, index in ((ledger.LedgerFilters(), 'booking_created_idx'),
+							   (ledger.LedgerFilters(slot='L-0'), 'booking_slot_created_idx'),
+							   (ledger.LedgerFilters(status=Booking.STATUS_FAILED), 'booking_status_created_idx')):
+			bookings = ledger.continuing(ledger.ledger_queryset(filters), ledger.decode_cursor(cursor_value))
+			sql, params = bookings.order_by('-created_at', '-pk')[:51].query.sql_with_params()
+			with connection.cursor() as cursor:
+				cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+				plan = ' '.join(row[-1] for row in cursor.fetchall())
+			# A range search starting at the cursor, already in ledger order
+			self.assertIn(f'SEARCH parking_booking USING INDEX {index}', plan)
+			self.assertNotIn('TEMP B-TREE', plan)
@@ -9,11 +9,16 @@ urlpatterns = [
     
     # URL: /parking/slots/ (View available slots, maps to the Driver Dashboard core feature)
     path('slots/', views.available_slots_view, name='driver_slots'),
+    # Bays of one level (HTML fragment the dashboard loads when a level is opened);
+    # `path` so level names containing "/" still reverse
+    path('slots/levels/<path:level>/', views.level_slots_view, name='level_slots'),
     # Slot detail (driver-facing) - shows slot info and booking form (fallback for no-JS)
     path('slots/<str:slot_id>/', views.slot_detail_view, name='slot_detail'),
     
     # URL: /parking/book/A-101/ (Initiate booking and payment for a specific slot)
     path('book/<str:slot_id>/', views.initiate_booking_view, name='initiate_booking'),
+    # URL: /parking/assign/ (Book any free slot matching level / pricing rate preferences)
+    path('assign/', views.auto_book_view, name='auto_book'),
     path('leave/', views.leave_slot_view, name='leave_slot'),
     path('leave/undo/', views.undo_leave_view, name='undo_leave'),
     
@@ -44,4 +49,8 @@ urlpatterns = [
     path('admin/bookings/<int:booking_id>/simulate_pay/', views.simulate_booking_payment, name='simulate_booking_payment'),
     # API: current status of all slots (for live dashboard updates)
     path('api/slot_statuses/', views.slot_statuses_api, name='slot_statuses_api'),
+    # API: server-sent event stream of slot status changes (push alternative to polling)
+    path('api/slot_statuses/stream/', views.slot_status_stream, name='slot_status_stream'),
+    # API (staff): per-view query counts and timings from the query stats middleware
+    path('api/query_stats/', views.query_stats_api, name='query_stats_api'),
 ]
\ No newline at end of file
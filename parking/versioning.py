@@ -0,0 +1,57 @@
+"""
+parking.versioning
+--------------------
+Version stamps for process-local caches.
+
+A ``VersionStamp`` is a monotonically increasing integer kept in Django's cache
+framework. Writers call ``bump()`` after changing the data a cache is built
+from; readers compare ``current()`` with the stamp their local copy was built
+at and rebuild when it differs. Reading a stamp is a cache lookup, never a
+database query.
+
+With the default local-memory cache every worker process has its own stamps.
+Point ``CACHES`` at a shared backend (Redis/Memcached) so that changes made in
+one worker are noticed by all of them.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+
+class VersionStamp:
+    def __init__(self, key):
+        self.key = key
+
+    def _seed(self):
+        # Seed from the wall clock rather than 1 so a stamp that was evicted
+        # from the cache never comes back with a value a reader has already seen.
+        cache.add(self.key, int(time.time() * 1000), timeout=None)
+
+    def current(self) -> int:
+        value = cache.get(self.key)
+        if value is None:
+            self._seed()
+            value = cache.get(self.key)
+        return value
+
+    def bump(self) -> int:
+        try:
+            return cache.incr(self.key)
+        except ValueError:
+            # Key missing (first write or evicted): seed it, then increment.
+            self._seed()
+            return cache.incr(self.key)
+
+    def changed(self):
+        """Bump once the current transaction commits (now, outside one).
+
+        Bumping before the commit would let a reader rebuild under the new
+        stamp from data that may still be rolled back, and nothing would
+        invalidate it afterwards.
+        """
+        if connection.in_atomic_block:
+            transaction.on_commit(self.bump)
+        else:
+            self.bump()
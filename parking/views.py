@@ -9,84 +9,44 @@ Views for the parking app including:
 The views try to keep logic thin and reuse model behaviour where possible.
 """
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.http import parse_etags
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
-from datetime import datetime
 from .models import ParkingSlot, Booking
 from .models import PricingRate
-from parkingpayments.mpesa import get_client
-from .forms import ParkingSlotForm, BookingForm
+from .occupancy import get_snapshot
+from .live import event_stream
+from . import counters, driverstate, layout, ledger, occupants, querystats, reports, reservations
+from parkingpayments.dispatch import dispatch_stk_push
+from .forms import ParkingSlotForm, BookingForm, AutoBookingForm
 from django.utils import timezone
-from django.db.models import Q, Sum
 from django.http import JsonResponse
-import re
+
+# Admin log entries listed on the activities page
+ACTIVITY_LIMIT = 200
 
 # --- Helper: Check if user is admin ---
 def is_admin(user):
     return user.is_staff or user.is_superuser
 
 
-def _get_slot_vehicle_types():
+def _get_slot_vehicle_types(slots=None):
     """Return a dict mapping slot_id -> vehicle_type for currently occupied slots.
     This helps templates render a small icon representing the occupant's vehicle.
+
+    Pass slots already loaded with `ParkingSlot.objects.with_vehicle_types()` to
+    reuse them; otherwise a single annotated query is issued.
     """
-    mapping = {}
-    occupied_slots = ParkingSlot.objects.filter(is_occupied=True)
-    for slot in occupied_slots:
-        # find the most recent PAID booking for this slot (if any)
-        booking = Booking.objects.filter(slot=slot, payment_status=Booking.STATUS_PAID).order_by('-created_at').first()
-        if booking and getattr(booking.user, 'vehicle_type', None):
-            mapping[slot.slot_id] = booking.user.vehicle_type
-    return mapping
-
-
-def _compute_svg_slots(all_slots):
-    """Given a queryset/list of slots, return a list of dicts with x/y/size/metadata
-    to render parking bays in the dashboard SVG.
-    Simple algorithm: group by `level` and lay slots horizontally per level.
-    """
-    # Convert to list to iterate multiple times
-    slots = list(all_slots)
-    # Group by level preserving first-seen order
-    groups = {}
-    order = []
-    for s in slots:
-        lvl = s.level or 'Level'
-        if lvl not in groups:
-            groups[lvl] = []
-            order.append(lvl)
-        groups[lvl].append(s)
-
-    svg_slots = []
-    # layout parameters
-    slot_w = 110
-    slot_h = 58
-    gap = 18
-    left_margin = 260
-    top_margin = 48
-    level_gap = slot_h + 48
-
-    for li, lvl in enumerate(order):
-        rowslots = groups.get(lvl, [])
-        y = top_margin + li * level_gap
-        for idx, s in enumerate(rowslots):
-            x = left_margin + idx * (slot_w + gap)
-            svg_slots.append({
-                'slot_id': s.slot_id,
-                'level': lvl,
-                'x': x,
-                'y': y,
-                'w': slot_w,
-                'h': slot_h,
-                'is_occupied': bool(s.is_occupied),
-                'vehicle_type': getattr(s, 'vehicle_type', None),
-                'cx': x + slot_w / 2,
-                'cy': y + slot_h / 2,
-            })
-
-    return svg_slots
+    if slots is None:
+        slots = ParkingSlot.objects.filter(is_occupied=True).with_vehicle_types()
+    return {s.slot_id: s.occupant_vehicle_type for s in slots if s.occupant_vehicle_type}
+
 
 # --- 1. Admin: List & Create Parking Slots ---
 @login_required
@@ -194,13 +154,16 @@ def slot_update_delete_view(request, slot_id):
 def toggle_slot_status(request, slot_id):
     """Quick toggle endpoint for administrators to flip a slot's occupied state.
     This is intended for fast corrections (e.g., freeing a slot after manual inspection).
+    The override lasts until the slot's next booking starts or ends.
     """
     slot = get_object_or_404(ParkingSlot, slot_id=slot_id)
     if request.method == 'POST':
         try:
-            slot.is_occupied = not slot.is_occupied
-            slot.save()
-            messages.success(request, f"Slot {slot_id} status updated to {'OCCUPIED' if slot.is_occupied else 'FREE'}.")
+            if slot.is_occupied:
+                occupants.release([slot.pk])
+            else:
+                occupants.hold([slot.pk])
+            messages.success(request, f"Slot {slot_id} status updated to {'FREE' if slot.is_occupied else 'OCCUPIED'}.")
         except Exception:
             messages.error(request, f"Failed to update status for slot {slot_id}.")
     return redirect('parking:admin_slot_list')
@@ -209,159 +172,229 @@ def toggle_slot_status(request, slot_id):
 @login_required
 @user_passes_test(is_admin, login_url='/accounts/login/')
 def admin_booking_list_view(request):
-    bookings = Booking.objects.all().order_by('-created_at')
+    """Booking ledger, newest first, keyset-paginated (see `parking.ledger`).
+
+    GET parameters: `status`, `slot` (slot_id), `from`/`to` (YYYY-MM-DD),
+    `before`/`after` (page cursors), `per_page`, and `format=csv` to stream the
+    whole filtered ledger as a CSV download.
+    """
+    filters = ledger.LedgerFilters.from_query(request.GET)
+    bookings = ledger.ledger_queryset(filters)
+
+    if request.GET.get('format') == 'csv':
+        response = StreamingHttpResponse(ledger.csv_rows(bookings), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="{ledger.export_filename(filters)}"'
+        return response
+
+    try:
+        per_page = int(request.GET.get('per_page', ledger.PAGE_SIZE))
+    except ValueError:
+        per_page = ledger.PAGE_SIZE
+    page = ledger.get_page(bookings, before=request.GET.get('before'), after=request.GET.get('after'), size=per_page)
+
+    # Links keep the filters and swap the cursor
+    query = request.GET.copy()
+    for key in ('before', 'after', 'format'):
+        query.pop(key, None)
+    def page_url(**cursor):
+        params = query.copy()
+        params.update(cursor)
+        return f'?{params.urlencode()}'
+
     return render(request, 'parking/admin_booking_list.html', {
-        'bookings': bookings,
+        'bookings': page.bookings,
+        'filters': filters,
+        'status_choices': Booking.PAYMENT_STATUS_CHOICES,
+        'next_url': page_url(before=page.next_cursor) if page.next_cursor else None,
+        'prev_url': page_url(after=page.prev_cursor) if page.prev_cursor else None,
+        'first_url': page_url() if page.prev_cursor else None,
+        'export_url': page_url(format='csv'),
         'header_title': 'Reservation & Revenue Tracker'
     })
 
 # --- 4. Driver: Available Slots ---
 @login_required
 def available_slots_view(request):
-    all_slots = ParkingSlot.objects.all().order_by('level', 'slot_id')
-    available_slots = ParkingSlot.objects.filter(is_occupied=False).order_by('level', 'slot_id')
     booking_form = BookingForm()
 
-    # Attach a transient `vehicle_type` attribute to occupied slot objects
-    slot_vehicle_types = _get_slot_vehicle_types()
-    for s in all_slots:
-        s.vehicle_type = slot_vehicle_types.get(s.slot_id)
-
-    # Get driver's recent bookings
-    user_bookings = Booking.objects.filter(user=request.user).order_by('-start_time')[:5]
-
-    # Get recent pending booking if any (to show cancel option)
-    pending_booking = Booking.objects.filter(
-        user=request.user,
-        payment_status=Booking.STATUS_PENDING,
-        created_at__gte=timezone.now() - timezone.timedelta(minutes=15)
-    ).first()
-
-    # Calculate parking statistics
-    total_slots = all_slots.count()
-    occupied_count = ParkingSlot.objects.filter(is_occupied=True).count()
-    available_count = total_slots - occupied_count
-    availability_percentage = (available_count / total_slots * 100) if total_slots > 0 else 0
-
-    # Determine occupancy status for the requesting user
-    now = timezone.now()
-    occupancy_status = 'FREE'
-    pending_window = now - timezone.timedelta(minutes=15)
-    if Booking.objects.filter(user=request.user, payment_status=Booking.STATUS_PENDING, created_at__gte=pending_window).exists():
-        occupancy_status = 'PENDING'
-    # Treat a user as OCCUPIED only if they have a PAID booking that is currently in effect
-    # (start_time <= now < end_time) and the slot is still marked occupied. This avoids
-    # future or past paid bookings blocking new bookings.
-    elif Booking.objects.filter(
-        user=request.user,
-        payment_status=Booking.STATUS_PAID,
-        start_time__lte=now,
-        end_time__gt=now,
-        slot__is_occupied=True
-    ).exists():
-        occupancy_status = 'OCCUPIED'
-
-    # Group slots by level in a predictable order for the template
-    slots_by_level = {}
-    order = []
-    for s in all_slots:
-        lvl = s.level or 'Level'
-        if lvl not in slots_by_level:
-            slots_by_level[lvl] = []
-            order.append(lvl)
-        slots_by_level[lvl].append(s)
-
-    # Produce an ordered list of (level, slots) tuples using a natural sort
-    # Key: split alphabetic prefix and numeric suffix (e.g. B1 -> ('B', 1))
-    def _level_sort_key(lvl):
-        if not lvl:
-            return ('', 0)
-        m = re.match(r"^([A-Za-z]+)\s*([0-9]+)$", lvl.strip())
-        if m:
-            prefix = m.group(1).upper()
-            num = int(m.group(2))
-            return (prefix, num)
-        # fallback: find first number anywhere
-        m2 = re.search(r"([0-9]+)", lvl)
-        if m2:
-            prefix = re.sub(r"[0-9]", '', lvl).strip().upper()
-            return (prefix, int(m2.group(1)))
-        return (lvl.strip().upper(), 0)
-
-    ordered_levels = sorted(list(slots_by_level.keys()), key=_level_sort_key)
-    ordered_slots_by_level = [(lvl, slots_by_level[lvl]) for lvl in ordered_levels]
+    # First paint lists the levels only (natural order, cached per slot-inventory
+    # version); each level's bays are fetched by the page from level_slots_view.
+    levels = layout.get_layout().levels
+
+    # Recent bookings, pending booking (to show cancel option) and occupancy
+    # status, cached per driver (see parking.driverstate). A driver counts as
+    # OCCUPIED only while a PAID booking is in effect and its slot is occupied.
+    state = driverstate.get(request.user)
+
+    # Parking statistics from the maintained counters (one small query)
+    slot_counts = counters.summary()
+    level_summary = []
+    for level in levels:
+        total, occupied = slot_counts.by_level.get(level, (0, 0))
+        level_summary.append({'level': level, 'total': total, 'occupied': occupied, 'available': total - occupied})
 
     return render(request, 'accounts/driver_dashboard.html', {
-        'all_slots': all_slots,
-        'available_slots': available_slots,
-        'user_bookings': user_bookings,
-        'pending_booking': pending_booking,
+        'has_slots': bool(levels),
+        'level_summary': level_summary,
+        'user_bookings': state.recent_bookings,
+        'pending_booking': state.pending_booking,
         'booking_form': booking_form,
+        'auto_booking_form': AutoBookingForm(),
         'header_title': 'Reserve Your Spot',
-        'occupancy_status': occupancy_status,
-        'total_slots': total_slots,
-        'available_count': available_count,
-        'occupied_count': occupied_count,
-        'availability_percentage': availability_percentage,
+        'occupancy_status': state.occupancy_status,
+        **slot_counts.as_context(),
+    })
+
+
+@login_required
+def level_slots_view(request, level):
+    """The bays of one level with current occupancy, as an HTML fragment.
+
+    The driver dashboard fetches this when a level is opened. The fragment
+    carries the snapshot version it was rendered from, so live updates can
+    continue from there.
+    """
+    bays = layout.get_overlay(level)
+    if bays is None:
+        raise Http404('Unknown level')
+    return render(request, 'parking/level_slots.html', {
+        'level': level,
+        'slots': bays.slots,
         # Map slot_id -> vehicle_type when occupied (used by template to render vehicle icons)
-        'slot_vehicle_types': _get_slot_vehicle_types(),
-        # Pre-computed SVG layout for parking bays (x,y,w,h) grouped by level
-        'svg_slots': _compute_svg_slots(all_slots),
-        'slots_by_level': slots_by_level,
-        'ordered_slots_by_level': ordered_slots_by_level,
+        'slot_vehicle_types': bays.slot_vehicle_types,
+        'snapshot_version': bays.snapshot_version,
+        'snapshot_epoch': bays.snapshot_epoch,
     })
 
 
 @login_required
 def slot_statuses_api(request):
     """Return JSON with current slot statuses for client-side polling.
-    Example response: [{"slot_id":"B1_01","is_occupied":true,"vehicle_type":"sedan"}, ...]
+    Example response: {"version": 12, "epoch": "3f9c...", "slots": [{"slot_id":"B1_01","is_occupied":true,"vehicle_type":"sedan"}, ...]}
+
+    Served from the process-wide occupancy snapshot (see `parking.occupancy`), so
+    polls do not touch the slot table unless something changed since the last one.
+
+    `?level=<level>` restricts the slots (full or delta) to one level of the
+    bay layout; unknown levels get a 404.
+
+    Conditional polling:
+    - `If-None-Match: <ETag>` returns 304 while the snapshot is unchanged.
+    - `?since=<version>&epoch=<epoch>` returns 304 if nothing changed, otherwise
+      only the changed slots (`"delta": true`, plus `removed` slot ids). Versions
+      this process cannot answer for fall back to the full list.
     """
-    slots = ParkingSlot.objects.all().order_by('level', 'slot_id')
-    data = []
-    for s in slots:
-        data.append({
-            'slot_id': s.slot_id,
-            'is_occupied': bool(s.is_occupied),
-            'vehicle_type': getattr(s, 'vehicle_type', None),
-        })
-    return JsonResponse({'slots': data})
+    slot_ids = None
+    level = request.GET.get('level')
+    if level:
+        slot_ids = layout.get_layout().slot_ids_by_level.get(level)
+        if slot_ids is None:
+            return JsonResponse({'error': 'unknown level'}, status=404)
+
+    snap = get_snapshot()
+
+    not_modified = HttpResponseNotModified()
+    not_modified['ETag'] = snap.etag
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and snap.etag in parse_etags(if_none_match):
+        return not_modified
+
+    payload = snap.payload_for(slot_ids)
+    since = request.GET.get('since')
+    epoch = request.GET.get('epoch')
+    if since and since.isdigit() and (not epoch or epoch == snap.epoch):
+        since = int(since)
+        if since == snap.version:
+            return not_modified
+        payload = snap.delta_since(since, slot_ids) or payload
+
+    response = HttpResponse(payload, content_type='application/json')
+    response['ETag'] = snap.etag
+    response['Cache-Control'] = 'no-cache'
+    return response
 
-# --- 5. Driver: Initiate Booking ---
 @login_required
-def initiate_booking_view(request, slot_id):
-    slot = get_object_or_404(ParkingSlot, slot_id=slot_id)
+@user_passes_test(is_admin, login_url='/accounts/login/')
+def query_stats_api(request):
+    """Per-view query counts, DB/template time and response sizes recorded by
+    the query stats middleware (see `parking.querystats`). POST resets them."""
+    if request.method == 'POST':
+        querystats.stats.reset()
+    return JsonResponse({
+        'enabled': getattr(settings, 'QUERY_STATS', False),
+        'since': querystats.stats.since.isoformat(),
+        'budgets': querystats.budgets(),
+        'views': querystats.stats.snapshot(),
+    })
 
-    if slot.is_occupied:
-        messages.error(request, f"Slot {slot_id} is no longer available.")
-        return redirect('parking:driver_slots')
+@login_required
+async def slot_status_stream(request):
+    """Server-sent event stream of occupancy changes (see `parking.live`).
+
+    Dashboards open this with `EventSource`; every event carries the same JSON
+    as `slot_statuses_api` (full first, then deltas). Reconnects resume from the
+    `Last-Event-ID` header (`<epoch>-<version>`) when the same process serves them;
+    a first connection can pass `?since=<version>&epoch=<epoch>` the same way.
+    `?level=<level>` (repeatable, so one stream covers every level a dashboard
+    has open) restricts events to those levels of the bay layout, as for
+    `slot_statuses_api`; unknown levels get a 404.
+
+    The stream needs an ASGI server: under WSGI Django would have to consume the
+    endless generator before sending anything. Non-ASGI requests get a 204
+    instead, which tells `EventSource` not to reconnect, so the dashboard falls
+    back to polling straight away.
+    """
+    slot_ids = None
+    levels = request.GET.getlist('level')
+    if levels:
+        by_level = (await sync_to_async(layout.get_layout)()).slot_ids_by_level
+        if any(level not in by_level for level in levels):
+            return JsonResponse({'error': 'unknown level'}, status=404)
+        slot_ids = frozenset().union(*(by_level[level] for level in levels))
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    since, epoch = None, None
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if not last_event_id and request.GET.get('since'):
+        last_event_id = f"{request.GET.get('epoch', '')}-{request.GET['since']}"
+    if '-' in last_event_id:
+        epoch, _, version = last_event_id.rpartition('-')
+        if version.isdigit():
+            since = int(version)
+    response = StreamingHttpResponse(event_stream(since, epoch, slot_ids=slot_ids), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Disable proxy buffering (nginx) so events are delivered as they happen
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# --- 5. Driver: Initiate Booking ---
+# User-facing explanations for `reserve_slot` conflicts
+_RESERVATION_ERRORS = {
+    reservations.SLOT_OCCUPIED: "Slot {slot_id} is no longer available.",
+    reservations.USER_HAS_BOOKING: "You already have an active or pending booking. You cannot book another slot until it completes or is cancelled.",
+    reservations.TIME_OVERLAP: "Slot {slot_id} already has a booking in that time range. Please choose another slot or time.",
+    reservations.NO_FREE_SLOT: "No free slot matches your preferences right now. Try another level or pricing rate.",
+}
+
+
+def _start_payment(request, booking):
+    """Send the STK push for a new PENDING booking and show its status page."""
+    # Initiate M-Pesa STK push (simulated or real depending on settings) in the
+    # background; the worker stores checkout_request_id when Safaricom answers
+    # Use booking.total_fee (Booking.save computed it) and cast to int for STK
+    amount = int(round(float(booking.total_fee))) if booking.total_fee else 0
+    if dispatch_stk_push(booking.id, request.user.phone_number, amount):
+        messages.success(request, f"Booking initiated for {booking.slot.slot_id}. Payment prompt sent to {request.user.phone_number} for KES {booking.total_fee}.")
+    else:
+        # The push queue was full and the booking has been marked FAILED
+        messages.error(request, f"We could not send the payment prompt for {booking.slot.slot_id} right now. Please try booking again.")
+    return redirect('parking:booking_status', booking_id=booking.id)
 
-    # Prevent a single user from booking multiple slots when they already
-    # have an active or pending booking. If the user already has a PENDING
-    # booking (awaiting payment) or a PAID booking that hasn't expired
-    # (end_time > now), block new booking attempts.
-    now = timezone.now()
-    # Consider only recent pending bookings (e.g., last 15 minutes) as blocking.
-    # This prevents very old/abandoned pending bookings from permanently blocking new bookings.
-    pending_window = now - timezone.timedelta(minutes=15)
-    has_pending = Booking.objects.filter(
-        user=request.user,
-        payment_status=Booking.STATUS_PENDING,
-        created_at__gte=pending_window
-    ).exists()
-    # Only consider a PAID booking as "active" if it is currently in effect (start <= now < end)
-    # and the linked slot is still marked occupied. This avoids future/past paid bookings from
-    # blocking new bookings.
-    has_active_paid = Booking.objects.filter(
-        user=request.user,
-        payment_status=Booking.STATUS_PAID,
-        start_time__lte=now,
-        end_time__gt=now,
-        slot__is_occupied=True
-    ).exists()
-    if has_pending or has_active_paid:
-        messages.error(request, "You already have an active or pending booking. You cannot book another slot until it completes or is cancelled.")
-        return redirect('parking:driver_slots')
+
+@login_required
+def initiate_booking_view(request, slot_id):
+    get_object_or_404(ParkingSlot, slot_id=slot_id)
 
     if request.method == 'POST':
         form = BookingForm(request.POST)
@@ -374,45 +407,56 @@ def initiate_booking_view(request, slot_id):
             if not end_time:
                 end_time = start_time + timezone.timedelta(hours=duration_hours)
 
-            # Prevent double-booking: check for time-overlap with existing PENDING/PAID bookings
-            overlap_q = Q(payment_status__in=[Booking.STATUS_PENDING, Booking.STATUS_PAID]) & Q(slot=slot) & (
-                Q(start_time__lt=end_time, end_time__gt=start_time) |
-                Q(start_time__lt=end_time, end_time__isnull=True) |
-                Q(start_time__isnull=True, end_time__gt=start_time)
-            )
-            existing = Booking.objects.filter(overlap_q)
-            if existing.exists():
-                messages.error(request, f"Slot {slot_id} already has a booking in that time range. Please choose another slot or time.")
+            # Turn away drivers who already hold a booking without opening a
+            # transaction; reserve_slot() re-checks under lock either way
+            if driverstate.get(request.user).blocks_booking:
+                messages.error(request, _RESERVATION_ERRORS[reservations.USER_HAS_BOOKING].format(slot_id=slot_id))
                 return redirect('parking:driver_slots')
 
-            # Create booking (total_fee will be computed in Booking.save())
-            booking = Booking.objects.create(
-                user=request.user,
-                slot=slot,
-                start_time=start_time,
-                end_time=end_time,
-                payment_status=Booking.STATUS_PENDING
-            )
+            # Availability, per-driver and overlap checks plus the insert run in one
+            # transaction so concurrent requests cannot double-book (see parking.reservations)
+            result = reservations.reserve_slot(request.user, slot_id, start_time, end_time)
+            if not result.ok:
+                error = _RESERVATION_ERRORS.get(result.conflict, "Slot {slot_id} is no longer available.")
+                messages.error(request, error.format(slot_id=slot_id))
+                return redirect('parking:driver_slots')
+            return _start_payment(request, result.booking)
 
-            # Initiate M-Pesa STK push (simulated or real depending on settings)
-            try:
-                client = get_client()
-                # Use booking.total_fee (Booking.save computed it) and cast to int for STK
-                amount = int(round(float(booking.total_fee))) if booking.total_fee else 0
-                checkout_id = client.stk_push(request.user.phone_number, amount, booking.id)
-                booking.checkout_request_id = checkout_id
-                booking.save()
-            except Exception:
-                booking.checkout_request_id = f"CHKT_{booking.id}_{datetime.now().strftime('%f')}"
-                booking.save()
+        messages.error(request, "Invalid booking details. Check start time and duration.")
+        return redirect('parking:driver_slots')
 
-            messages.success(request, f"Booking initiated for {slot_id}. Payment prompt sent to {request.user.phone_number} for KES {booking.total_fee}.")
-            return redirect('parking:booking_status', booking_id=booking.id)
+    return redirect('parking:driver_slots')
 
+
+@login_required
+def auto_book_view(request):
+    """Book any free slot matching the driver's level and pricing rate
+    preferences. The slot comes from the allocator's free lists (see
+    `reservations.reserve_any`), so drivers arriving together are spread over
+    different bays instead of racing for the same one."""
+    if request.method != 'POST':
+        return redirect('parking:driver_slots')
+
+    form = AutoBookingForm(request.POST)
+    if not form.is_valid():
         messages.error(request, "Invalid booking details. Check start time and duration.")
         return redirect('parking:driver_slots')
 
-    return redirect('parking:driver_slots')
+    if driverstate.get(request.user).blocks_booking:
+        messages.error(request, _RESERVATION_ERRORS[reservations.USER_HAS_BOOKING])
+        return redirect('parking:driver_slots')
+
+    result = reservations.reserve_any(
+        request.user,
+        form.cleaned_data['start_time'],
+        form.cleaned_data['end_time'],
+        level=form.cleaned_data['level'] or None,
+        pricing_category=form.cleaned_data['pricing_category'] or None,
+    )
+    if not result.ok:
+        messages.error(request, _RESERVATION_ERRORS[result.conflict])
+        return redirect('parking:driver_slots')
+    return _start_payment(request, result.booking)
 
 # --- 6. Booking Status View ---
 @login_required
@@ -450,11 +494,8 @@ def simulate_booking_payment(request, booking_id):
     if request.method == 'POST':
         booking.payment_status = Booking.STATUS_PAID
         booking.mpesa_receipt_no = f"SIM-{booking.id}-{timezone.now().strftime('%f')}"
+        # Saving a PAID booking occupies the slot for the booked interval
         booking.save()
-        # Mark slot occupied now that payment succeeded
-        slot = booking.slot
-        slot.is_occupied = True
-        slot.save()
         messages.success(request, f"Booking {booking_id} marked as PAID (simulated).")
     return redirect('parking:admin_booking_list')
 
@@ -483,39 +524,49 @@ def past_reservations_view(request):
 @login_required
 @user_passes_test(is_admin, login_url='/accounts/login/')
 def admin_activities_view(request):
-    """Show recent admin actions using Django's LogEntry model."""
+    """Show recent admin actions (Django's LogEntry) and a bookings-by-hour summary.
+
+    Optional GET parameters narrow the summary: `from` and `to` (YYYY-MM-DD,
+    default today) and `level`. The histogram and the per-level table are read
+    from the booking rollups (see `parking.reports`), one grouped query each.
+    """
     try:
         from django.contrib.admin.models import LogEntry
-        activities = LogEntry.objects.select_related('user').order_by('-action_time')[:200]
+        activities = LogEntry.objects.select_related('user').order_by('-action_time')[:ACTIVITY_LIMIT]
     except Exception:
         activities = []
-    # Compute simple booking/activity statistics for today
+
     today = timezone.localdate()
-    bookings_today_qs = Booking.objects.filter(created_at__date=today)
-    bookings_today = bookings_today_qs.count()
-    revenue_today = bookings_today_qs.filter(payment_status=Booking.STATUS_PAID).aggregate(total=Sum('total_fee'))['total'] or 0
-
-    # Bookings per hour (0-23)
-    bookings_by_hour = []
-    for h in range(24):
-        cnt = bookings_today_qs.filter(created_at__hour=h).count()
-        bookings_by_hour.append({'hour': h, 'count': cnt})
-    # Determine peak hour
-    peak_hour = None
-    peak_count = 0
-    if bookings_by_hour:
-        peak = max(bookings_by_hour, key=lambda x: x['count'])
-        peak_hour = peak.get('hour')
-        peak_count = peak.get('count', 0)
+    date_from = parse_date(request.GET.get('from') or '') or today
+    date_to = parse_date(request.GET.get('to') or '') or date_from
+    if date_to < date_from:
+        date_from, date_to = date_to, date_from
+    date_from = max(date_from, date_to - reports.MAX_RANGE)
+    level = request.GET.get('level', '').strip()
+
+    bookings_by_hour = reports.hourly_bookings(date_from, date_to, level=level)
+    bookings_today = sum(b['count'] for b in bookings_by_hour)
+    revenue_today = sum(b['revenue'] for b in bookings_by_hour)
+    # Determine peak hour (the earliest one on ties)
+    peak = max(bookings_by_hour, key=lambda b: b['count'])
+    peak_hour = peak['hour'] if peak['count'] else None
+    peak_count = peak['count']
 
     context = {
         'activities': activities,
         'header_title': 'Admin Activities',
         'bookings_today': bookings_today,
         'revenue_today': revenue_today,
+        'paid_count': sum(b['paid'] for b in bookings_by_hour),
+        'failed_count': sum(b['failed'] for b in bookings_by_hour),
         'bookings_by_hour': bookings_by_hour,
         'peak_hour': peak_hour,
         'peak_count': peak_count,
+        'date_from': date_from,
+        'date_to': date_to,
+        'is_today': date_from == date_to == today,
+        'level': level,
+        'level_totals': reports.totals(date_from, date_to, by='level'),
     }
     return render(request, 'parking/admin_activities.html', context)
 
@@ -561,13 +612,13 @@ def leave_slot_view(request):
             'timestamp': now.isoformat()
         }
 
-        # Mark booking as ended now and free the slot
+        # Mark booking as ended now; that frees the slot it occupied. Release it
+        # explicitly too, in case it was only held by hand.
         booking.end_time = now
         booking.save()
 
         slot = booking.slot
-        slot.is_occupied = False
-        slot.save()
+        occupants.release([slot.pk])
 
         messages.success(request, f"You have left slot {slot.slot_id}. You can undo this action briefly from the dashboard.")
     return redirect('parking:driver_slots')
@@ -576,7 +627,8 @@ def leave_slot_view(request):
 @login_required
 def undo_leave_view(request):
     """Restore the most recent leave action saved in session (if any).
-    This will reapply the previous booking end_time and mark the slot occupied.
+    This will reapply the previous booking end_time, which occupies the slot again
+    if the booking is still running.
     """
     last = request.session.get('last_leave')
     if not last:
@@ -598,12 +650,12 @@ def undo_leave_view(request):
     else:
         booking.end_time = None
     booking.save()
-
     slot = booking.slot
-    slot.is_occupied = True
-    slot.save()
 
     # Clear the session undo record
     request.session.pop('last_leave', None)
-    messages.success(request, f"Leave action undone. Slot {slot.slot_id} is marked occupied again.")
+    if slot.current_booking_id == booking.pk:
+        messages.success(request, f"Leave action undone. Slot {slot.slot_id} is marked occupied again.")
+    else:
+        messages.success(request, f"Leave action undone. Booking #{booking.pk} has already ended, so slot {slot.slot_id} stays free.")
     return redirect('parking:driver_slots')
@@ -0,0 +1,117 @@
+"""
+parkingpayments.callbacks
+---------------------------
+Parse M-Pesa STK callbacks and apply them to bookings.
+
+Daraja identifies a payment by the CheckoutRequestID it returned from the STK
+push, which `MpesaClient.stk_push` stores on `Booking.checkout_request_id`
+(a unique, indexed column). Older clients and the test helpers post the
+booking's numeric id instead, so a reference that is all digits is also
+matched against the primary key.
+
+`apply_callback()` applies a single callback with one indexed read and one
+conditional UPDATE. The update only matches bookings that are not already in
+the target state, so a callback Safaricom delivers twice changes nothing the
+second time. The webhook queues callbacks instead, and `parkingpayments.inbox`
+applies them in batches with the same transitions.
+"""
+
+from dataclasses import dataclass
+
+from django.db import transaction
+from django.db.models import Q
+
+from parking import driverstate, occupants, rollups
+from parking.models import Booking
+
+# Outcomes of apply_callback()
+NOT_FOUND = 'not_found'
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+
+
+@dataclass(frozen=True)
+class CallbackData:
+    reference: str = None
+    receipt: str = None
+    success: bool = False
+
+
+def parse_callback(payload) -> CallbackData:
+    """Extract the booking reference, receipt number and result from a callback payload."""
+    reference = None
+    receipt = None
+    status = None
+
+    # Direct top-level keys
+    if isinstance(payload, dict):
+        reference = payload.get('booking_id') or payload.get('CheckoutRequestID') or payload.get('MerchantRequestID')
+        receipt = payload.get('receipt') or payload.get('MpesaReceiptNumber')
+        status = payload.get('status') or payload.get('ResultCode')
+
+    # Common Daraja STK callback structure: { "Body": { "stkCallback": { ... }}}
+    try:
+        body = payload.get('Body') if isinstance(payload, dict) else None
+        if body:
+            stk = body.get('stkCallback') or body.get('stkcallback')
+            if stk:
+                status = stk.get('ResultCode') if stk.get('ResultCode') is not None else status
+                # MerchantRequestID / CheckoutRequestID may be present
+                reference = reference or stk.get('CheckoutRequestID') or stk.get('MerchantRequestID')
+                # Result parameters hold MpesaReceiptNumber
+                result = stk.get('CallbackMetadata') or stk.get('Callback') or {}
+                if isinstance(result, dict):
+                    # CallbackMetadata has 'Item' list with Name/Value
+                    items = result.get('Item') or result.get('Items') or []
+                    for it in items:
+                        name = it.get('Name') or it.get('name')
+                        if name and name.lower() in ('mpesareceiptnumber', 'mpesareceipt'):
+                            receipt = it.get('Value') or receipt
+    except Exception:
+        # ignore nested parsing errors and fall back to top-level values
+        pass
+
+    success = False
+    if status in (0, '0'):
+        success = True
+    elif isinstance(status, str) and status.lower() in ('success', 'ok'):
+        success = True
+
+    return CallbackData(
+        reference=str(reference) if reference not in (None, '') else None,
+        receipt=receipt,
+        success=success,
+    )
+
+
+def booking_lookup(reference) -> Q:
+    """Filter matching a callback reference by CheckoutRequestID, or by booking id if numeric."""
+    lookup = Q(checkout_request_id=reference)
+    if reference.isdigit():
+        lookup |= Q(pk=int(reference))
+    return lookup
+
+
+def apply_callback(data: CallbackData):
+    """Record a payment result on its booking. Returns (outcome, booking_id)."""
+    row = (Booking.objects.filter(booking_lookup(data.reference))
+           .values_list('pk', 'user_id', 'slot_id', 'created_at', 'start_time', 'end_time').first())
+    if row is None:
+        return NOT_FOUND, None
+    booking_id, user_id, slot_id = row[:3]
+
+    with transaction.atomic():
+        if data.success:
+            updated = (Booking.objects.filter(pk=booking_id).exclude(payment_status=Booking.STATUS_PAID)
+                       .update(payment_status=Booking.STATUS_PAID,
+                               mpesa_receipt_no=data.receipt or f"MPESA-{booking_id}"))
+            if updated:
+                # What Booking.save() does for PAID bookings, without reloading the slot
+                occupants.refresh_slots([slot_id])
+        else:
+            updated = (Booking.objects.filter(pk=booking_id, payment_status=Booking.STATUS_PENDING)
+                       .update(payment_status=Booking.STATUS_FAILED))
+        if updated:
+            rollups.mark(rollups.booking_days(*row[2:]))
+            driverstate.invalidate([user_id])
+    return (APPLIED if updated else DUPLICATE), booking_id
@@ -0,0 +1,203 @@
+"""
+parkingpayments.dispatch
+--------------------------
+Send STK pushes off the request thread.
+
+`dispatch_stk_push()` hands a booking's push to a bounded pool of worker
+threads once the current transaction commits, so the booking view can redirect
+to the status page straight away instead of waiting for OAuth and
+processrequest. A worker writes the returned CheckoutRequestID back to the
+booking.
+
+Only failures where the gateway cannot have accepted the push are retried,
+with exponential backoff: connection errors, connect timeouts and 5xx
+answers. If every attempt fails, the worker stores a placeholder id, as the
+booking view did before. A read timeout is different: Daraja may already
+have sent the prompt. Re-sending it would prompt the driver twice, and would
+replace the CheckoutRequestID the first callback carries. So the outcome is
+left to the payment callback, and the stored id is not touched.
+
+The pool is bounded. When `MPESA_PUSH_QUEUE_SIZE` pushes are already queued
+or running, the booking is marked FAILED straight away, and the driver can
+book again from the status page. The request thread never sends the push
+itself.
+
+Settings:
+- MPESA_PUSH_ASYNC (default True): False sends pushes inline, with retries.
+- MPESA_PUSH_WORKERS (default 4): worker threads.
+- MPESA_PUSH_QUEUE_SIZE (default 100): queued plus in-flight pushes.
+- MPESA_PUSH_RETRIES (default 3): retries after the first attempt.
+- MPESA_PUSH_BACKOFF (default 1.0): seconds before the first retry (doubles each retry).
+
+Worker threads live in the web process. Pushes still queued when the process
+exits are lost, and the booking keeps its PENDING status until the pending
+hold expires.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+from parking.models import Booking
+from .mpesa import get_client
+
+logger = logging.getLogger(__name__)
+
+
+class StkDispatcher:
+    def __init__(self, workers=4, queue_size=100, retries=3, backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stk-push')
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, booking_id, phone_number, amount):
+        """Queue a push; fail the booking when the pool is full. Returns the Future, or None if rejected."""
+        if not self._slots.acquire(blocking=False):
+            logger.error('STK push queue full; failing booking %s', booking_id)
+            self._fail(booking_id)
+            return None
+        future = self._executor.submit(self._run, booking_id, phone_number, amount)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    @staticmethod
+    def _fail(booking_id):
+        booking = Booking.objects.filter(pk=booking_id, payment_status=Booking.STATUS_PENDING).first()
+        if booking is not None:
+            # save() so driver state, occupancy and rollups follow
+            booking.payment_status = Booking.STATUS_FAILED
+            booking.save()
+
+    def _run(self, booking_id, phone_number, amount):
+        close_old_connections()
+        try:
+            return self.push(booking_id, phone_number, amount)
+        finally:
+            close_old_connections()
+
+    def push(self, booking_id, phone_number, amount):
+        """Send the push with retries and store the resulting CheckoutRequestID."""
+        checkout_id = None
+        for attempt in range(self.retries + 1):
+            try:
+                checkout_id = get_client().stk_push(phone_number, amount, booking_id)
+                break
+            except requests.RequestException as exc:
+                if isinstance(exc, requests.Timeout) and not isinstance(exc, requests.ConnectTimeout):
+                    # Sent but unanswered: the prompt may be on the phone already
+                    logger.warning('STK push for booking %s timed out; outcome left to the callback', booking_id)
+                    return None
+                response = getattr(exc, 'response', None)
+                if response is not None and response.status_code < 500:
+                    # Rejected by the gateway (bad credentials, bad request); retrying will not help
+                    logger.exception('STK push for booking %s rejected', booking_id)
+                    break
+                if response is None and not isinstance(exc, requests.ConnectionError):
+                    # Invalid URL, bad response body and the like: retrying will not help
+                    logger.exception('STK push for booking %s failed', booking_id)
+                    break
+                if attempt == self.retries:
+                    logger.exception('STK push for booking %s failed after %s attempts', booking_id, attempt + 1)
+                    break
+                self._backoff(attempt)
+            except Exception:
+                logger.exception('STK push for booking %s failed', booking_id)
+                break
+
+        if not checkout_id:
+            checkout_id = f"CHKT_{booking_id}_{timezone.now().strftime('%f')}"
+        # update() rather than save() so a callback that already landed is not overwritten
+        Booking.objects.filter(pk=booking_id).update(checkout_request_id=checkout_id)
+        return checkout_id
+
+    def _backoff(self, attempt):
+        delay = self.backoff * (2 ** attempt)
+        # Jitter so retries from a burst of failures do not hit the gateway together
+        time.sleep(delay + random.uniform(0, delay / 2))
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def drain(self, timeout=None):
+        """Wait for queued pushes to finish. Returns True if none are left."""
+        with self._lock:
+            pending = list(self._pending)
+        done, not_done = wait(pending, timeout=timeout)
+        return not not_done
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = StkDispatcher(
+                    workers=getattr(settings, 'MPESA_PUSH_WORKERS', 4),
+                    queue_size=getattr(settings, 'MPESA_PUSH_QUEUE_SIZE', 100),
+                    retries=getattr(settings, 'MPESA_PUSH_RETRIES', 3),
+                    backoff=getattr(settings, 'MPESA_PUSH_BACKOFF', 1.0),
+                )
+    return _dispatcher
+
+
+def reset_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None:
+        dispatcher.shutdown(wait=True)
+
+
+@receiver(setting_changed)
+def _reset_on_push_setting_change(setting, **kwargs):
+    if setting.startswith('MPESA_PUSH_'):
+        reset_dispatcher()
+
+
+def dispatch_stk_push(booking_id, phone_number, amount):
+    """Send the STK push for `booking_id` once the current transaction commits.
+
+    Returns False if the push was refused because the queue is full (the
+    booking is FAILED by then), True otherwise. Inside a transaction the push
+    is only queued on commit, so True then means "not refused yet".
+    """
+    refused = []
+
+    def send():
+        dispatcher = get_dispatcher()
+        if getattr(settings, 'MPESA_PUSH_ASYNC', True):
+            if dispatcher.submit(booking_id, phone_number, amount) is None:
+                refused.append(booking_id)
+        else:
+            dispatcher.push(booking_id, phone_number, amount)
+
+    transaction.on_commit(send)
+    return not refused
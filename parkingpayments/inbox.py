@@ -0,0 +1,207 @@
+"""
+parkingpayments.inbox
+-----------------------
+Durable, batched M-Pesa callback ingestion.
+
+The webhook calls `enqueue()`, which appends the raw callback body to the
+`PaymentCallback` table and returns. `drain()` applies queued callbacks in
+batches:
+
+1. Read a batch of unprocessed callbacks (oldest first).
+2. Parse them and collapse deliveries for the same CheckoutRequestID.
+   Safaricom retries callbacks, and a success beats a failure for the same
+   payment.
+3. Read the matching bookings in one query.
+4. Apply the status transitions with a few bulk statements: PAID bookings
+   (with their receipts), FAILED bookings, the paid slots' occupants, and the
+   callbacks' outcomes.
+
+Transitions are the same as `callbacks.apply_callback()`. A booking that is
+already PAID is never changed again, and only PENDING bookings can fail.
+Replaying the inbox is therefore harmless.
+
+Draining runs in `manage.py drain_callbacks` (once, or continuously with
+--loop). With MPESA_CALLBACK_AUTODRAIN (default True), a background thread in
+the web process also drains shortly after callbacks arrive, coalescing
+bursts into a single pass.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from parking import driverstate, occupants, rollups
+from parking.models import Booking, PaymentCallback
+from .callbacks import parse_callback
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+_drain_lock = threading.Lock()
+
+
+def enqueue(body: str) -> PaymentCallback:
+    """Store a raw callback body for the next drain."""
+    callback = PaymentCallback.objects.create(payload=body)
+    if getattr(settings, 'MPESA_CALLBACK_AUTODRAIN', True):
+        transaction.on_commit(autodrain.wake)
+    return callback
+
+
+def drain_batch(batch_size=BATCH_SIZE) -> dict:
+    """Apply up to `batch_size` queued callbacks. Returns {outcome: count}."""
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    # Without row locks concurrent drains in this process take turns instead
+    with (nullcontext() if skip_locked else _drain_lock):
+        with transaction.atomic():
+            pending = PaymentCallback.objects.filter(processed_at__isnull=True).order_by('id')
+            if skip_locked:
+                pending = pending.select_for_update(skip_locked=True)
+            rows = list(pending.values_list('id', 'payload')[:batch_size])
+            if not rows:
+                return {}
+            return _apply(rows)
+
+
+def drain(batch_size=BATCH_SIZE) -> dict:
+    """Drain the inbox until it is empty. Returns {outcome: count} over all batches."""
+    totals = {}
+    while True:
+        counts = drain_batch(batch_size)
+        if not counts:
+            return totals
+        for outcome, count in counts.items():
+            totals[outcome] = totals.get(outcome, 0) + count
+
+
+def _apply(rows):
+    # reference -> (success, receipt); a success wins over failures for the same payment
+    results = {}
+    outcomes = {}
+    callback_refs = {}
+    for callback_id, body in rows:
+        try:
+            data = parse_callback(json.loads(body))
+        except ValueError:
+            data = None
+        if data is None or not data.reference:
+            outcomes[callback_id] = PaymentCallback.OUTCOME_INVALID
+            continue
+        callback_refs[callback_id] = data.reference
+        previous = results.get(data.reference)
+        if previous is None or (data.success and not previous[0]):
+            results[data.reference] = (data.success, data.receipt)
+
+    bookings, rollup_days, drivers = {}, {}, {}
+    if results:
+        numeric = [int(ref) for ref in results if ref.isdigit()]
+        lookup = Q(checkout_request_id__in=list(results))
+        if numeric:
+            lookup |= Q(pk__in=numeric)
+        matches = Booking.objects.filter(lookup)
+        if connection.features.has_select_for_update:
+            matches = matches.select_for_update()
+        for pk, user_id, slot_id, checkout_id, status, *times in matches.values_list(
+                'pk', 'user_id', 'slot_id', 'checkout_request_id', 'payment_status',
+                'created_at', 'start_time', 'end_time'):
+            booking = (pk, slot_id, status)
+            rollup_days[pk] = rollups.booking_days(slot_id, *times)
+            drivers[pk] = user_id
+            if checkout_id:
+                bookings[checkout_id] = booking
+            bookings.setdefault(str(pk), booking)
+
+    paid, failed, applied = {}, set(), set()
+    for ref, (success, receipt) in results.items():
+        booking = bookings.get(ref)
+        if booking is None:
+            continue
+        pk, slot_id, status = booking
+        if success and status != Booking.STATUS_PAID and pk not in paid:
+            paid[pk] = Booking(pk=pk, slot_id=slot_id, payment_status=Booking.STATUS_PAID,
+                               mpesa_receipt_no=receipt or f"MPESA-{pk}")
+            applied.add(ref)
+        elif not success and status == Booking.STATUS_PENDING:
+            failed.add(pk)
+            applied.add(ref)
+
+    # bulk_update/update() skip Booking.save(); slot occupants and rollups are refreshed here
+    if paid:
+        Booking.objects.bulk_update(paid.values(), ['payment_status', 'mpesa_receipt_no'])
+        occupants.refresh_slots({b.slot_id for b in paid.values()})
+    if failed:
+        Booking.objects.filter(pk__in=failed, payment_status=Booking.STATUS_PENDING).update(
+            payment_status=Booking.STATUS_FAILED)
+    rollups.mark(set().union(*(rollup_days[pk] for pk in (*paid, *failed))))
+    driverstate.invalidate(drivers[pk] for pk in (*paid, *failed))
+
+    for callback_id, ref in callback_refs.items():
+        if ref not in bookings:
+            outcomes[callback_id] = PaymentCallback.OUTCOME_NOT_FOUND
+        elif ref in applied:
+            outcomes[callback_id] = PaymentCallback.OUTCOME_APPLIED
+            # Later deliveries of the same payment in this batch are duplicates
+            applied.discard(ref)
+        else:
+            outcomes[callback_id] = PaymentCallback.OUTCOME_DUPLICATE
+
+    now = timezone.now()
+    PaymentCallback.objects.bulk_update(
+        [PaymentCallback(pk=callback_id, processed_at=now, outcome=outcome) for callback_id, outcome in outcomes.items()],
+        ['processed_at', 'outcome'],
+    )
+
+    counts = {}
+    for outcome in outcomes.values():
+        counts[outcome] = counts.get(outcome, 0) + 1
+    return counts
+
+
+class AutoDrainer:
+    """Background thread that drains the inbox after callbacks arrive.
+
+    `wake()` is cheap and can be called once per callback: a burst of
+    callbacks that arrive while a drain is running is picked up by the next
+    pass instead of starting a drain each.
+    """
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mpesa-callback-drain', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # Give a burst a moment to land so it is applied in one batch.
+            # Callbacks are stored before their wake(), so clearing right
+            # before the drain reads the inbox covers every wake so far;
+            # later ones start the next pass.
+            time.sleep(self.delay)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                drain()
+            except Exception:
+                logger.exception('Draining M-Pesa callbacks failed')
+            finally:
+                close_old_connections()
+
+
+autodrain = AutoDrainer()
@@ -2,14 +2,17 @@ import base64
 import uuid
 import threading
 import time
-from datetime import timedelta
 import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils import timezone
 import logging
 import re
 
 from parking.models import Booking
+from .simulator import schedule_confirmation
 
 
 class MpesaClient:
@@ -17,8 +20,9 @@ class MpesaClient:
 
     Behavior summary:
     - Reads credentials from Django `settings` (typically via `.env`).
-    - When `MPESA_SIMULATE=True` the client schedules a small background task
-      that marks a booking PAID after a delay; no external HTTP calls are made.
+    - When `MPESA_SIMULATE=True` the client schedules a simulated callback
+      (see `parkingpayments.simulator`) that pays or fails the booking after
+      a delay; no external HTTP calls are made.
     - When `MPESA_SIMULATE=False` the client performs OAuth against the
       Daraja sandbox/production endpoint and posts an STK push request. All
       outgoing requests and responses are logged for easier debugging.
@@ -28,8 +32,17 @@ class MpesaClient:
       `_normalize_phone()` before being sent to Safaricom.
     - The client attempts to save `checkout_request_id` to the Booking record
       (best-effort) so the UI and webhooks can correlate results.
+    - One client is shared by the whole process (see `get_client()`). It keeps
+      a pooled `requests.Session`, so pushes reuse kept-alive connections, and
+      an OAuth token that all threads share. The token is refreshed
+      `TOKEN_REFRESH_MARGIN` seconds before it expires; while one thread
+      refreshes, the others keep using the still-valid token, and so does
+      the refreshing thread if the refresh fails.
     """
 
+    TOKEN_REFRESH_MARGIN = 60
+    POOL_SIZE = 10
+
     def __init__(self):
         self.consumer_key = getattr(settings, 'MPESA_CONSUMER_KEY', '')
         self.consumer_secret = getattr(settings, 'MPESA_CONSUMER_SECRET', '')
@@ -39,24 +52,56 @@ class MpesaClient:
         self.api_base = getattr(settings, 'MPESA_API_BASE', 'https://sandbox.safaricom.co.ke')
         self.callback_url = getattr(settings, 'MPESA_CALLBACK_URL', '')
 
-        # Token cache
+        pool_size = getattr(settings, 'MPESA_HTTP_POOL_SIZE', self.POOL_SIZE)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Token cache (shared by all threads using this client)
         self._token = None
         self._token_expiry = 0
+        self._token_lock = threading.Lock()
 
     def _get_oauth_token(self) -> str:
-        # Return cached token when valid
-        if self._token and time.time() < self._token_expiry - 10:
-            return self._token
+        # Return cached token when valid and not yet due for refresh
+        token, expiry = self._token, self._token_expiry
+        now = time.monotonic()
+        if token and now < expiry - self.TOKEN_REFRESH_MARGIN:
+            return token
 
+        if token and now < expiry:
+            # Due for refresh but still valid: only one thread refreshes
+            if not self._token_lock.acquire(blocking=False):
+                return token
+        else:
+            self._token_lock.acquire()
+        try:
+            # Another thread may have refreshed while we waited for the lock
+            if self._token and time.monotonic() < self._token_expiry - self.TOKEN_REFRESH_MARGIN:
+                return self._token
+            try:
+                return self._fetch_oauth_token()
+            except Exception:
+                # An early refresh that fails must not fail the push while
+                # the current token is still valid; the next call retries.
+                if self._token and time.monotonic() < self._token_expiry:
+                    logging.warning('M-Pesa OAuth refresh failed; using the current token until it expires')
+                    return self._token
+                raise
+        finally:
+            self._token_lock.release()
+
+    def _fetch_oauth_token(self) -> str:
         url = f"{self.api_base}/oauth/v1/generate?grant_type=client_credentials"
         try:
-            resp = requests.get(url, auth=(self.consumer_key, self.consumer_secret), timeout=10)
+            resp = self.session.get(url, auth=(self.consumer_key, self.consumer_secret), timeout=10)
             resp.raise_for_status()
             data = resp.json()
             token = data.get('access_token')
             expires_in = int(data.get('expires_in', 0))
+            self._token_expiry = time.monotonic() + expires_in
             self._token = token
-            self._token_expiry = time.time() + expires_in
             return token
         except Exception:
             logging.exception('Failed to fetch M-Pesa OAuth token from %s', url)
@@ -101,23 +146,7 @@ class MpesaClient:
 
         if self.simulate:
             # schedule a local confirmation so the UI flow can be tested
-            def _confirm():
-                try:
-                    b = Booking.objects.get(pk=booking_id)
-                    b.payment_status = Booking.STATUS_PAID
-                    b.mpesa_receipt_no = f"SIM-{booking_id}-{int(time.time())}"
-                    if not b.end_time:
-                        b.end_time = timezone.now() + timedelta(hours=1)
-                    b.save()
-                    slot = b.slot
-                    slot.is_occupied = True
-                    slot.save()
-                except Exception:
-                    logging.exception('Simulated confirmation failed for booking %s', booking_id)
-
-            t = threading.Timer(5.0, _confirm)
-            t.daemon = True
-            t.start()
+            schedule_confirmation(booking_id)
 
             logging.info('MPESA simulate mode active: scheduled simulated confirmation for booking %s', booking_id)
             return checkout_request_id
@@ -155,7 +184,7 @@ class MpesaClient:
 
         try:
             logging.info('Sending STK push to %s (booking %s) via %s', norm_phone, booking_id, url)
-            resp = requests.post(url, json=payload, headers=headers, timeout=15)
+            resp = self.session.post(url, json=payload, headers=headers, timeout=15)
             resp.raise_for_status()
             data = resp.json()
             logging.info('STK push response: %s', data)
@@ -166,16 +195,40 @@ class MpesaClient:
         # Expected keys: 'ResponseCode','ResponseDescription','CheckoutRequestID' in Daraja
         checkout_request_id = data.get('CheckoutRequestID') or data.get('MerchantRequestID') or checkout_request_id
 
-        # Save to booking asynchronously (best-effort)
+        # Save to booking (best-effort). update() so a callback that already
+        # landed is not overwritten by a stale copy of the booking.
         try:
-            b = Booking.objects.get(pk=booking_id)
-            b.checkout_request_id = checkout_request_id
-            b.save()
+            Booking.objects.filter(pk=booking_id).update(checkout_request_id=checkout_request_id)
         except Exception:
             logging.exception('Failed to save checkout_request_id to Booking %s', booking_id)
 
         return checkout_request_id
 
 
+_client = None
+_client_lock = threading.Lock()
+
+
 def get_client():
-    return MpesaClient()
+    """Return the process-wide `MpesaClient`, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MpesaClient()
+    return _client
+
+
+def reset_client():
+    """Drop the shared client so the next `get_client()` rereads settings."""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.session.close()
+
+
+@receiver(setting_changed)
+def _reset_on_mpesa_setting_change(setting, **kwargs):
+    if setting.startswith('MPESA_'):
+        reset_client()
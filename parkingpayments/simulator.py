@@ -0,0 +1,66 @@
+"""
+parkingpayments.simulator
+---------------------------
+Simulated Safaricom responses for MPESA_SIMULATE mode.
+
+`schedule_confirmation()` uses the shared `parking.scheduler` to deliver a
+Daraja-style STK callback for a booking after a delay. The callback goes into
+the callback inbox, so a simulated payment takes the same path as a real one:
+inbox, drain, booking PAID or FAILED, slot occupied.
+
+Settings:
+- MPESA_SIMULATE_DELAY (default 5.0): seconds until the callback arrives.
+- MPESA_SIMULATE_DELAY_JITTER (default 0.0): the delay is drawn uniformly
+  from DELAY +/- JITTER.
+- MPESA_SIMULATE_FAILURE_RATE (default 0.0): share of payments the "customer"
+  cancels, or that time out or lack funds.
+"""
+
+import json
+import random
+import time
+
+from django.conf import settings
+
+from parking.scheduler import scheduler
+from .inbox import enqueue
+
+# Daraja result codes for payments that did not go through
+FAILURE_CODES = (
+    (1032, 'Request cancelled by user'),
+    (1037, 'DS timeout user cannot be reached'),
+    (1, 'The balance is insufficient for the transaction'),
+)
+
+
+def confirmation_delay():
+    delay = getattr(settings, 'MPESA_SIMULATE_DELAY', 5.0)
+    jitter = getattr(settings, 'MPESA_SIMULATE_DELAY_JITTER', 0.0)
+    return max(0.0, random.uniform(delay - jitter, delay + jitter))
+
+
+def simulated_callback(booking_id, success):
+    """Daraja STK callback body for `booking_id`, matched by its numeric id."""
+    stk = {'MerchantRequestID': f'SIM-{booking_id}', 'CheckoutRequestID': str(booking_id)}
+    if success:
+        stk.update({
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'MpesaReceiptNumber', 'Value': f'SIM-{booking_id}-{int(time.time())}'},
+            ]},
+        })
+    else:
+        code, description = random.choice(FAILURE_CODES)
+        stk.update({'ResultCode': code, 'ResultDesc': description})
+    return json.dumps({'Body': {'stkCallback': stk}})
+
+
+def schedule_confirmation(booking_id):
+    """Deliver a simulated payment result for `booking_id` after the configured delay."""
+    success = random.random() >= getattr(settings, 'MPESA_SIMULATE_FAILURE_RATE', 0.0)
+    return scheduler.schedule(confirmation_delay(), _deliver, booking_id, success)
+
+
+def _deliver(booking_id, success):
+    enqueue(simulated_callback(booking_id, success))
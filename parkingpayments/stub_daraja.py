@@ -0,0 +1,134 @@
+"""
+parkingpayments.stub_daraja
+-----------------------------
+A minimal local stand-in for the Safaricom Daraja API, for tests and load
+tests. It answers the two endpoints `MpesaClient` uses:
+
+- GET  /oauth/v1/generate              -> {"access_token", "expires_in"}
+- POST /mpesa/stkpush/v1/processrequest -> {"CheckoutRequestID", ...}
+
+and counts requests per endpoint and the TCP connections they arrived on, so
+callers can check token reuse and connection keep-alive. `delay` adds latency
+to every STK push to mimic a slow gateway, and the first `failures` pushes are
+answered with 503 to exercise retries.
+
+Usage:
+    with StubDaraja() as stub:
+        settings.MPESA_API_BASE = stub.url
+        ...
+        stub.counts['oauth'], stub.counts['stkpush'], len(stub.connections)
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stub._record_connection(self.client_address)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.path.startswith('/oauth/v1/generate'):
+            stub._count('oauth')
+            self._send_json(200, {'access_token': f'stub-{uuid.uuid4().hex}',
+                                  'expires_in': str(stub.token_ttl)})
+        else:
+            self._send_json(404, {'errorMessage': 'Not found'})
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+            stub._count('stkpush')
+            if stub.delay:
+                time.sleep(stub.delay)
+            if stub._take_failure():
+                self._send_json(503, {'errorMessage': 'Service unavailable'})
+                return
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                self._send_json(401, {'errorMessage': 'Invalid Access Token'})
+                return
+            stub.payloads.append(payload)
+            self._send_json(200, {
+                'MerchantRequestID': uuid.uuid4().hex[:12],
+                'CheckoutRequestID': f'ws_CO_{uuid.uuid4().hex[:20]}',
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing',
+            })
+        else:
+            self._send_json(404, {'errorMessage': 'Not found'})
+
+
+class StubDaraja:
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, token_ttl=3599, failures=0):
+        self.delay = delay
+        self.failures = failures
+        self.token_ttl = token_ttl
+        self.counts = Counter()
+        self.connections = set()
+        self.payloads = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] += 1
+
+    def _take_failure(self):
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+
+    def _record_connection(self, address):
+        with self._lock:
+            self.connections.add(address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,336 @@
+import json
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import requests
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from parking.models import ParkingSlot, Booking, PaymentCallback
+from .dispatch import StkDispatcher, dispatch_stk_push, get_dispatcher
+from .inbox import AutoDrainer, drain
+from parking.scheduler import scheduler
+from .mpesa import get_client, reset_client
+from .stub_daraja import StubDaraja
+
+
+class MpesaClientReuseTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.stub = StubDaraja().start()
+		self.addCleanup(self.stub.stop)
+		settings_override = override_settings(
+			MPESA_SIMULATE=False,
+			MPESA_API_BASE=self.stub.url,
+			MPESA_CONSUMER_KEY='key',
+			MPESA_CONSUMER_SECRET='secret',
+			MPESA_SHORTCODE='174379',
+			MPESA_PASSKEY='passkey',
+		)
+		settings_override.enable()
+		self.addCleanup(settings_override.disable)
+		self.addCleanup(reset_client)
+
+		user = get_user_model().objects.create_user(
+			email='mpesa@example.com',
+			username='mpesa',
+			phone_number='0712345678',
+			vehicle_plate='MP-1',
+			password='pass'
+		)
+		slot = ParkingSlot.objects.create(slot_id='M-1', slot_name='M1', level='1')
+		start = timezone.now()
+		self.booking = Booking.objects.create(user=user, slot=slot, start_time=start, end_time=start + timedelta(hours=1))
+
+	def test_one_oauth_call_and_connection_across_many_pushes(self):
+		self.assertIs(get_client(), get_client())
+		for _ in range(1000):
+			checkout_id = get_client().stk_push('0712345678', 100, self.booking.pk)
+		self.assertEqual(self.stub.counts['stkpush'], 1000)
+		self.assertEqual(self.stub.counts['oauth'], 1)
+		self.assertEqual(len(self.stub.connections), 1)
+		self.booking.refresh_from_db()
+		self.assertEqual(self.booking.checkout_request_id, checkout_id)
+
+	def test_token_shared_across_threads(self):
+		client = get_client()
+		barrier = threading.Barrier(8)
+		tokens = []
+
+		def fetch():
+			barrier.wait()
+			tokens.append(client._get_oauth_token())
+
+		threads = [threading.Thread(target=fetch) for _ in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(len(set(tokens)), 1)
+		self.assertEqual(self.stub.counts['oauth'], 1)
+
+	def test_token_refreshed_before_expiry(self):
+		client = get_client()
+		first = client._get_oauth_token()
+		# Inside the refresh margin but not yet expired
+		client._token_expiry = time.monotonic() + client.TOKEN_REFRESH_MARGIN - 1
+		second = client._get_oauth_token()
+		self.assertNotEqual(first, second)
+		self.assertEqual(self.stub.counts['oauth'], 2)
+
+	def test_failed_early_refresh_keeps_the_current_token(self):
+		client = get_client()
+		first = client._get_oauth_token()
+		client._token_expiry = time.monotonic() + client.TOKEN_REFRESH_MARGIN - 1
+		with mock.patch.object(client.session, 'get', side_effect=requests.ConnectionError('down')):
+			with self.assertLogs(level='WARNING'):
+				self.assertEqual(client._get_oauth_token(), first)
+		# Once it has expired there is nothing to fall back on
+		client._token_expiry = time.monotonic() - 1
+		with mock.patch.object(client.session, 'get', side_effect=requests.ConnectionError('down')):
+			with self.assertLogs(level='ERROR'):
+				with self.assertRaises(requests.ConnectionError):
+					client._get_oauth_token()
+
+
+class StkDispatchTests(TransactionTestCase):
+	def setUp(self):
+		cache.clear()
+		self.stub = StubDaraja(delay=0.2).start()
+		self.addCleanup(self.stub.stop)
+		settings_override = override_settings(
+			MPESA_SIMULATE=False,
+			MPESA_API_BASE=self.stub.url,
+			MPESA_CONSUMER_KEY='key',
+			MPESA_CONSUMER_SECRET='secret',
+			MPESA_SHORTCODE='174379',
+			MPESA_PASSKEY='passkey',
+			MPESA_PUSH_ASYNC=True,
+			MPESA_PUSH_BACKOFF=0.01,
+		)
+		settings_override.enable()
+		self.addCleanup(settings_override.disable)
+
+		self.user = get_user_model().objects.create_user(
+			email='push@example.com',
+			username='push',
+			phone_number='0712345678',
+			vehicle_plate='PU-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='P-1', slot_name='P1', level='1')
+		self.client.force_login(self.user)
+
+	def test_booking_request_does_not_wait_for_gateway(self):
+		start = (timezone.now() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M')
+		t0 = time.perf_counter()
+		response = self.client.post(reverse('parking:initiate_booking', args=['P-1']), {'start_time': start, 'duration_hours': 1})
+		elapsed = time.perf_counter() - t0
+		booking = Booking.objects.get(slot=self.slot)
+		self.assertRedirects(response, reverse('parking:booking_status', args=[booking.id]), fetch_redirect_response=False)
+		self.assertLess(elapsed, self.stub.delay)
+
+		self.assertTrue(get_dispatcher().drain(timeout=10))
+		booking.refresh_from_db()
+		self.assertTrue(booking.checkout_request_id.startswith('ws_CO_'))
+
+	def test_failed_pushes_are_retried(self):
+		self.stub.failures = 2
+		start = timezone.now()
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=1))
+		with self.assertLogs(level='ERROR'):
+			dispatch_stk_push(booking.id, self.user.phone_number, 100)
+			self.assertTrue(get_dispatcher().drain(timeout=10))
+		booking.refresh_from_db()
+		self.assertEqual(self.stub.counts['stkpush'], 3)
+		self.assertTrue(booking.checkout_request_id.startswith('ws_CO_'))
+
+
+	def test_read_timeouts_are_not_resent(self):
+		start = timezone.now()
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=1),
+										 checkout_request_id='ws_CO_first')
+		with mock.patch('parkingpayments.dispatch.get_client') as client:
+			client.return_value.stk_push.side_effect = requests.ReadTimeout()
+			with self.assertLogs('parkingpayments.dispatch', level='WARNING'):
+				self.assertIsNone(StkDispatcher(backoff=0.01).push(booking.id, self.user.phone_number, 100))
+		self.assertEqual(client.return_value.stk_push.call_count, 1)
+		booking.refresh_from_db()
+		self.assertEqual(booking.checkout_request_id, 'ws_CO_first')
+
+	def test_connection_errors_are_retried(self):
+		start = timezone.now()
+		booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=1))
+		with mock.patch('parkingpayments.dispatch.get_client') as client:
+			client.return_value.stk_push.side_effect = [requests.ConnectTimeout(), requests.ConnectionError(), 'ws_CO_third']
+			self.assertEqual(StkDispatcher(backoff=0.01).push(booking.id, self.user.phone_number, 100), 'ws_CO_third')
+		self.assertEqual(client.return_value.stk_push.call_count, 3)
+
+	def test_full_queue_fails_the_booking_without_pushing_inline(self):
+		dispatcher = StkDispatcher(workers=1, queue_size=1, backoff=0.01)
+		self.addCleanup(dispatcher.shutdown)
+		start = timezone.now()
+		first, second = [Booking.objects.create(user=self.user, slot=self.slot, start_time=start + timedelta(hours=i),
+												end_time=start + timedelta(hours=i + 1)) for i in (1, 3)]
+		self.assertIsNotNone(dispatcher.submit(first.id, self.user.phone_number, 100))
+		t0 = time.perf_counter()
+		with self.assertLogs('parkingpayments.dispatch', level='ERROR'):
+			self.assertIsNone(dispatcher.submit(second.id, self.user.phone_number, 100))
+		self.assertLess(time.perf_counter() - t0, self.stub.delay)
+		self.assertTrue(dispatcher.drain(timeout=10))
+		self.assertEqual(self.stub.counts['stkpush'], 1)
+		second.refresh_from_db()
+		self.assertEqual(second.payment_status, Booking.STATUS_FAILED)
+
+
+	@override_settings(MPESA_PUSH_QUEUE_SIZE=0)
+	def test_booking_view_reports_a_refused_push(self):
+		start = (timezone.now() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M')
+		with self.assertLogs('parkingpayments.dispatch', level='ERROR'):
+			response = self.client.post(reverse('parking:initiate_booking', args=['P-1']),
+										{'start_time': start, 'duration_hours': 1}, follow=True)
+		booking = Booking.objects.get(slot=self.slot)
+		self.assertEqual(booking.payment_status, Booking.STATUS_FAILED)
+		self.assertContains(response, 'could not send the payment prompt')
+		self.assertNotContains(response, 'Payment prompt sent')
+		self.assertEqual(self.stub.counts['stkpush'], 0)
+
+
+class AutoDrainerTests(TestCase):
+	def test_burst_is_drained_in_one_batch(self):
+		drained = threading.Event()
+		with mock.patch('parkingpayments.inbox.drain', side_effect=drained.set) as drain_mock:
+			drainer = AutoDrainer(delay=0.2)
+			for _ in range(20):
+				drainer.wake()
+				time.sleep(0.005)
+			self.assertTrue(drained.wait(timeout=5))
+			time.sleep(0.3)
+		self.assertEqual(drain_mock.call_count, 1)
+
+
+@override_settings(MPESA_CALLBACK_AUTODRAIN=False)
+class MpesaCallbackTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		self.user = get_user_model().objects.create_user(
+			email='callback@example.com',
+			username='callback',
+			phone_number='0712345679',
+			vehicle_plate='CB-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='C-1', slot_name='C1', level='1')
+		start = timezone.now()
+		self.booking = Booking.objects.create(user=self.user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=1),
+											  checkout_request_id='ws_CO_191220191020363925')
+
+	def _post(self, result_code=0, checkout_id='ws_CO_191220191020363925', receipt='NLJ7RT61SV'):
+		stk = {'MerchantRequestID': '29115-34620561-1', 'CheckoutRequestID': checkout_id, 'ResultCode': result_code,
+			   'ResultDesc': 'The service request is processed successfully.'}
+		if result_code == 0:
+			stk['CallbackMetadata'] = {'Item': [{'Name': 'Amount', 'Value': 1.0}, {'Name': 'MpesaReceiptNumber', 'Value': receipt}]}
+		return self.client.post(reverse('parking:parkingpayments:callback'), json.dumps({'Body': {'stkCallback': stk}}),
+								content_type='application/json')
+
+	def test_webhook_only_queues_the_callback(self):
+		response = self._post()
+		self.assertEqual(response.json(), {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+		self.assertEqual(PaymentCallback.objects.filter(processed_at__isnull=True).count(), 1)
+		self.booking.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PENDING)
+
+	def test_drain_applies_daraja_callback_by_checkout_request_id(self):
+		self._post()
+		self.assertEqual(drain(), {PaymentCallback.OUTCOME_APPLIED: 1})
+		self.booking.refresh_from_db()
+		self.slot.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PAID)
+		self.assertEqual(self.booking.mpesa_receipt_no, 'NLJ7RT61SV')
+		self.assertTrue(self.slot.is_occupied)
+		self.assertFalse(PaymentCallback.objects.filter(processed_at__isnull=True).exists())
+
+	def test_burst_is_deduplicated_and_applied_in_bulk(self):
+		slot = ParkingSlot.objects.create(slot_id='C-2', slot_name='C2', level='1')
+		start = timezone.now()
+		other = Booking.objects.create(user=self.user, slot=slot, start_time=start, end_time=start + timedelta(hours=1),
+									   checkout_request_id='ws_CO_other')
+		self._post(result_code=1032, checkout_id='ws_CO_other')
+		for _ in range(3):
+			self._post()
+		self._post(checkout_id='ws_CO_unknown')
+
+		with CaptureQueriesContext(connection) as ctx:
+			counts = drain()
+		# Batch read, booking read, PAID update, slot occupant refresh (occupants, slots, slot
+		# update with its counter upkeep: locked state read, state re-read, counter read and
+		# update; next start, next end), FAILED update, inbox update, empty read
+		queries = [q['sql'] for q in ctx.captured_queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+		self.assertEqual(len(queries), 15)
+		self.assertEqual(counts, {'applied': 2, 'duplicate': 2, 'not_found': 1})
+		self.booking.refresh_from_db()
+		other.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PAID)
+		self.assertEqual(other.payment_status, Booking.STATUS_FAILED)
+		# Redelivery after the drain changes nothing
+		self._post(result_code=1032)
+		self.assertEqual(drain(), {'duplicate': 1})
+		self.booking.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PAID)
+
+	def test_numeric_booking_id_fallback(self):
+		self.client.post(reverse('parking:parkingpayments:callback'),
+						 json.dumps({'booking_id': self.booking.pk, 'status': 'success', 'receipt': 'R-1'}), content_type='application/json')
+		drain()
+		self.booking.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PAID)
+		self.assertEqual(self.booking.mpesa_receipt_no, 'R-1')
+
+	def test_callback_without_reference_is_rejected(self):
+		response = self.client.post(reverse('parking:parkingpayments:callback'), json.dumps({'status': 'success'}),
+									content_type='application/json')
+		self.assertEqual(response.status_code, 400)
+		self.assertFalse(PaymentCallback.objects.exists())
+
+
+@override_settings(MPESA_SIMULATE=True, MPESA_SIMULATE_DELAY=0.05, MPESA_CALLBACK_AUTODRAIN=False)
+class SimulatedPaymentTests(TransactionTestCase):
+	def setUp(self):
+		cache.clear()
+		self.addCleanup(reset_client)
+		user = get_user_model().objects.create_user(
+			email='sim@example.com',
+			username='sim',
+			phone_number='0712345670',
+			vehicle_plate='SIM-1',
+			password='pass'
+		)
+		self.slot = ParkingSlot.objects.create(slot_id='S-1', slot_name='S1', level='1')
+		start = timezone.now()
+		self.booking = Booking.objects.create(user=user, slot=self.slot, start_time=start, end_time=start + timedelta(hours=1))
+
+	def test_simulated_payment_flows_through_the_inbox(self):
+		get_client().stk_push('0712345670', 100, self.booking.pk)
+		self.assertTrue(scheduler.wait_idle(timeout=5))
+		drain()
+		self.booking.refresh_from_db()
+		self.slot.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_PAID)
+		self.assertTrue(self.booking.mpesa_receipt_no.startswith('SIM-'))
+		self.assertTrue(self.slot.is_occupied)
+
+	@override_settings(MPESA_SIMULATE_FAILURE_RATE=1.0)
+	def test_failure_rate(self):
+		get_client().stk_push('0712345670', 100, self.booking.pk)
+		self.assertTrue(scheduler.wait_idle(timeout=5))
+		drain()
+		self.booking.refresh_from_db()
+		self.assertEqual(self.booking.payment_status, Booking.STATUS_FAILED)
@@ -4,7 +4,9 @@ from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
 import json
 
-from parking.models import Booking, ParkingSlot
+from parking.models import Booking
+from .callbacks import parse_callback
+from .inbox import enqueue
 from django.conf import settings
 
 @login_required
@@ -26,45 +28,16 @@ def payment_failed_view(request, booking_id):
 def mpesa_callback(request):
     """Webhook endpoint for MPesa sandbox callbacks.
     In production, secure this endpoint (validate payload, use HTTPS, verify signatures).
+
+    The callback is only stored here and acknowledged; parkingpayments.inbox
+    applies it to the booking in a later batch.
     """
     if request.method != 'POST':
         return JsonResponse({'error': 'method not allowed'}, status=405)
 
     try:
-        payload = json.loads(request.body.decode('utf-8'))
-
-        # Safaricom sandbox/Daraja formats vary: try to extract common fields from nested structures
-        booking_id = None
-        receipt = None
-        status = None
-
-        # Direct top-level keys
-        if isinstance(payload, dict):
-            booking_id = payload.get('booking_id') or payload.get('CheckoutRequestID') or payload.get('MerchantRequestID')
-            receipt = payload.get('receipt') or payload.get('MpesaReceiptNumber')
-            status = payload.get('status') or payload.get('ResultCode')
-
-        # Common Daraja STK callback structure: { "Body": { "stkCallback": { ... }}}
-        try:
-            body = payload.get('Body') if isinstance(payload, dict) else None
-            if body:
-                stk = body.get('stkCallback') or body.get('stkcallback')
-                if stk:
-                    status = stk.get('ResultCode') or status
-                    # MerchantRequestID / CheckoutRequestID may be present
-                    booking_id = booking_id or stk.get('CheckoutRequestID') or stk.get('MerchantRequestID')
-                    # Result parameters hold MpesaReceiptNumber
-                    result = stk.get('CallbackMetadata') or stk.get('Callback') or {}
-                    if isinstance(result, dict):
-                        # CallbackMetadata has 'Item' list with Name/Value
-                        items = result.get('Item') or result.get('Items') or []
-                        for it in items:
-                            name = it.get('Name') or it.get('name')
-                            if name and name.lower() in ('mpesareceiptnumber', 'mpesareceiptnumber', 'mpesareceipt'):
-                                receipt = it.get('Value') or receipt
-        except Exception:
-            # ignore nested parsing errors and fall back to top-level values
-            pass
+        body = request.body.decode('utf-8')
+        payload = json.loads(body)
 
         # Validate optional callback secret
         secret = getattr(settings, 'MPESA_CALLBACK_SECRET', '')
@@ -73,31 +46,13 @@ def mpesa_callback(request):
             if not header_secret or header_secret != secret:
                 return JsonResponse({'error': 'forbidden'}, status=403)
 
-        if not booking_id:
+        data = parse_callback(payload)
+        if not data.reference:
             return JsonResponse({'error': 'missing booking_id'}, status=400)
 
-        booking = Booking.objects.get(pk=booking_id)
-
-        success = False
-        if status in (0, '0'):
-            success = True
-        elif isinstance(status, str) and status.lower() in ('success', 'ok'):
-            success = True
-
-        if success:
-            booking.payment_status = Booking.STATUS_PAID
-            booking.mpesa_receipt_no = receipt or f"MPESA-{booking_id}"
-            booking.save()
-            slot = booking.slot
-            slot.is_occupied = True
-            slot.save()
-            return JsonResponse({'ok': True})
-
-        booking.payment_status = Booking.STATUS_FAILED
-        booking.save()
-        return JsonResponse({'ok': False})
+        enqueue(body)
+        # Acknowledge in the format Daraja expects
+        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
-    except Booking.DoesNotExist:
-        return JsonResponse({'error': 'booking not found'}, status=404)
     except Exception as exc:
         return JsonResponse({'error': str(exc)}, status=500)